@@ -0,0 +1,299 @@
+"""
+Benchmarks for the grid pipeline.
+
+Times each benchmark and records the peak memory traced by tracemalloc, which includes NumPy arrays but not memory
+allocated inside GEOS.
+
+Record a baseline, then compare a later run against it:
+
+    python benchmarks/run.py --save benchmarks/baseline.json
+    python benchmarks/run.py --compare benchmarks/baseline.json --threshold 1.25
+
+The comparison exits with status 1 if any benchmark is slower, or uses more memory, than threshold times its
+baseline. Baselines depend on the machine, so only compare runs made on the same machine.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import shapely
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nzshm_grid_loc.geography import Regions  # noqa: E402
+from nzshm_grid_loc.grid import Grid  # noqa: E402
+from nzshm_grid_loc.io import load_grid, load_polygon_file, write_attr_grid, write_grid  # noqa: E402
+from nzshm_grid_loc.mask import clear_mask_cache  # noqa: E402
+
+STEPS = (0.5, 0.2, 0.1, 0.05, 0.01)
+
+# the bounds used by generate_grid
+NZ_BOUNDS = (-48, -34, 166, 179)
+
+# a benchmark returns the function to time, after doing any setup that should not be timed
+Benchmark = Callable[[float, str], Callable[[], Any]]
+
+
+class _Inputs:
+    """
+    Inputs shared between benchmarks, created the first time they are used.
+    """
+
+    def __init__(self):
+        self._grids: Dict[Tuple[str, float], Grid] = {}
+
+    def region(self, region: Regions):
+        return region.load()
+
+    def nz_grid(self, step: float) -> Grid:
+        key = ('nz', step)
+        if key not in self._grids:
+            self._grids[key] = Grid.for_polygon(step, self.region(Regions.NZ_SMALL))
+        return self._grids[key]
+
+    def annotated_grid(self, step: float) -> Grid:
+        key = ('annotated', step)
+        if key not in self._grids:
+            grid = self.nz_grid(step).add_neighbours()
+            self._grids[key] = grid.annotate("backarc", "0").annotate("wlg", "1", clip=self.region(Regions.WLG))
+        return self._grids[key]
+
+
+inputs = _Inputs()
+
+
+def for_bounds(step: float, tmp_dir: str) -> Callable[[], Any]:
+    return lambda: Grid.for_bounds(*NZ_BOUNDS, step)
+
+
+def for_polygon(step: float, tmp_dir: str) -> Callable[[], Any]:
+    nz = inputs.region(Regions.NZ_SMALL)
+    return lambda: Grid.for_polygon(step, nz)
+
+
+def add_neighbours(step: float, tmp_dir: str) -> Callable[[], Any]:
+    grid = inputs.nz_grid(step)
+    return lambda: grid.add_neighbours()
+
+
+def annotate_backarc(step: float, tmp_dir: str) -> Callable[[], Any]:
+    grid = inputs.nz_grid(step).add_neighbours()
+    backarc = inputs.region(Regions.BACKARC)
+    return lambda: grid.annotate("backarc", "0").annotate("backarc", "1", clip=backarc)
+
+
+def write_attr_grid_csv(step: float, tmp_dir: str) -> Callable[[], Any]:
+    grid = inputs.annotated_grid(step)
+    file_name = os.path.join(tmp_dir, 'attr_grid.csv')
+    return lambda: write_attr_grid(grid, file_name, ["lon", "lat", "backarc", "wlg"])
+
+
+def load_grid_csv(step: float, tmp_dir: str) -> Callable[[], Any]:
+    file_name = os.path.join(tmp_dir, f'grid_{step}.csv')
+    write_grid(inputs.nz_grid(step), file_name)
+    return lambda: load_grid(file_name)
+
+
+def load_grid_binary(step: float, tmp_dir: str) -> Callable[[], Any]:
+    file_name = os.path.join(tmp_dir, f'grid_{step}.nzgrid')
+    write_grid(inputs.annotated_grid(step), file_name)
+    return lambda: load_grid(file_name)
+
+
+def load_nz_small(step: float, tmp_dir: str) -> Callable[[], Any]:
+    return lambda: load_polygon_file(Regions.NZ_SMALL.value)
+
+
+def load_nz_small_sidecar(step: float, tmp_dir: str) -> Callable[[], Any]:
+    load_polygon_file(Regions.NZ_SMALL.value, sidecar=True)
+    return lambda: load_polygon_file(Regions.NZ_SMALL.value, sidecar=True)
+
+
+def import_package(step: float, tmp_dir: str) -> Callable[[], Any]:
+    # includes the start up time of the interpreter
+    code = 'import nzshm_grid_loc.nzshm_grid_loc'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return lambda: subprocess.run([sys.executable, '-c', code], cwd=root, check=True)
+
+
+# benchmarks that take a step are run once per step, the others once
+STEP_BENCHMARKS: Dict[str, Benchmark] = {
+    'for_bounds': for_bounds,
+    'for_polygon': for_polygon,
+    'add_neighbours': add_neighbours,
+    'annotate_backarc': annotate_backarc,
+    'for_polygon_warm': for_polygon,
+    'annotate_backarc_warm': annotate_backarc,
+    'write_attr_grid': write_attr_grid_csv,
+    'load_grid_csv': load_grid_csv,
+    'load_grid_binary': load_grid_binary,
+}
+BENCHMARKS: Dict[str, Benchmark] = {
+    'import': import_package,
+    'load_polygon_file': load_nz_small,
+    'load_polygon_file_sidecar': load_nz_small_sidecar,
+}
+
+# functions that are called before each run of a benchmark, without timing them. The region masks of for_polygon and
+# annotate are cached per process, so without clearing the cache only the first run would rasterize the region. The
+# _warm benchmarks time the cached masks.
+RESETS: Dict[str, Callable[[], None]] = {
+    'for_polygon': clear_mask_cache,
+    'annotate_backarc': clear_mask_cache,
+}
+
+
+def measure(run: Callable[[], Any], repeat: int, reset: Optional[Callable[[], None]] = None) -> Dict[str, float]:
+    """
+    Runs a benchmark repeat times and once more with tracemalloc, which slows it down.
+    :param run: the function to measure
+    :param repeat: the number of timed runs
+    :param reset: a function that is called before each run and not timed, e.g. to clear caches
+    :return: the fastest time in seconds and the peak traced memory in bytes
+    """
+    reset = reset or (lambda: None)
+    times = []
+    for _ in range(repeat):
+        reset()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    reset()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'peak_bytes': peak}
+
+
+def run_benchmarks(steps=STEPS, repeat: int = 3, select: Optional[List[str]] = None) -> Iterator[Tuple[str, dict]]:
+    """
+    Runs the benchmarks.
+    :param steps: the grid steps to run the step benchmarks for
+    :param repeat: the number of timed runs per benchmark
+    :param select: names of the benchmarks to run, or None for all
+    :return: an iterator of benchmark name and result. The result has an 'error' instead if the benchmark failed
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for key, name, benchmark, step in _cases(steps, select):
+            try:
+                result = measure(benchmark(step, tmp_dir), repeat, RESETS.get(name))
+            except Exception as e:
+                result = {'error': f'{type(e).__name__}: {e}'}
+            yield key, result
+
+
+def _cases(steps, select: Optional[List[str]]) -> List[Tuple[str, str, Benchmark, Optional[float]]]:
+    """
+    Returns the result key, name, function and step of the selected benchmarks.
+    """
+    cases = [(name, benchmark, None) for name, benchmark in BENCHMARKS.items()]
+    cases += [(name, benchmark, step) for step in steps for name, benchmark in STEP_BENCHMARKS.items()]
+    return [
+        (name if step is None else f'{name}[{step}]', name, benchmark, step)
+        for name, benchmark, step in cases
+        if not select or name in select
+    ]
+
+
+def compare(
+    results: Dict[str, dict], baseline: Dict[str, dict], threshold: float, min_seconds: float
+) -> List[Tuple[str, str]]:
+    """
+    Finds benchmarks that regressed. Benchmarks that failed in this run, and benchmarks of the baseline that are
+    missing from this run, are regressions too.
+    :param results: the results of this run
+    :param baseline: the results of the baseline run, only with the benchmarks that were selected for this run
+    :param threshold: the allowed ratio of result to baseline
+    :param min_seconds: times are only compared if the baseline is at least this long, shorter runs are too noisy
+    :return: a list of benchmark name and description of each regression
+    """
+    regressions = [(key, 'is missing') for key in baseline if key not in results]
+    for key, result in results.items():
+        base = baseline.get(key)
+        if 'error' in result:
+            regressions.append((key, f"failed: {result['error']}"))
+            continue
+        if base is None or 'error' in base:
+            continue
+        for measure_name, minimum in (('seconds', min_seconds), ('peak_bytes', 1)):
+            if base[measure_name] >= minimum and result[measure_name] > threshold * base[measure_name]:
+                ratio = result[measure_name] / base[measure_name]
+                regressions.append((key, f"{measure_name} is {ratio:.2f} times the baseline"))
+    return regressions
+
+
+def environment() -> Dict[str, str]:
+    return {
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'numpy': np.__version__,
+        'shapely': shapely.__version__,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--steps', type=float, nargs='+', default=STEPS, help='the grid steps to benchmark')
+    parser.add_argument(
+        '--select', nargs='+', help='the benchmarks to run: ' + ', '.join([*BENCHMARKS, *STEP_BENCHMARKS])
+    )
+    parser.add_argument('--repeat', type=int, default=3, help='the number of timed runs, the fastest one is recorded')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results with this JSON baseline')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=float(os.environ.get('NZSHM_GRID_LOC_BENCHMARK_THRESHOLD', 1.5)),
+        help='fail if a result is more than this times its baseline (default 1.5)',
+    )
+    parser.add_argument('--min-seconds', type=float, default=0.01, help='do not compare times below this baseline')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    print(f"{'benchmark':32} {'seconds':>10} {'peak MiB':>10} {'vs base':>8}")
+    for key, result in run_benchmarks(args.steps, args.repeat, args.select):
+        results[key] = result
+        if 'error' in result:
+            print(f"{key:32} {result['error']}")
+            continue
+        base = (baseline or {}).get(key, {})
+        ratio = f"{result['seconds'] / base['seconds']:.2f}x" if base.get('seconds') else ''
+        print(f"{key:32} {result['seconds']:10.4f} {result['peak_bytes'] / (1 << 20):10.1f} {ratio:>8}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+
+    if baseline is not None:
+        selected = {key for key, *_ in _cases(args.steps, args.select)}
+        baseline = {key: base for key, base in baseline.items() if key in selected}
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        for key, description in regressions:
+            print(f"regression: {key} {description}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
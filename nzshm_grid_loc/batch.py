@@ -0,0 +1,293 @@
+"""
+Builds the grid products listed in a manifest file.
+
+A manifest is a TOML or YAML file with a list of products and optional defaults for all of them:
+
+    [defaults]
+    region = "NZ_SMALL"
+    neighbours = 1
+
+    [[products]]
+    output = "backarc2_01deg_1n.csv"
+    step = 0.1
+    columns = ["lon", "lat", "backarc"]
+    annotations = [
+        { name = "backarc", value = "0" },
+        { name = "backarc", value = "1", clip = "BACKARC" },
+    ]
+
+Regions and annotation clips are Regions member names or polygon files. Relative file names are relative to the
+manifest. The output format is csv, parquet or nzgrid, by default taken from the output file extension. CSV files
+without columns are written without a header, like write_grid.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from nzshm_grid_loc.cache import GridCache, cached_grid
+from nzshm_grid_loc.geography import Regions
+from nzshm_grid_loc.grid import Grid
+from nzshm_grid_loc.io import GRID_FILE_EXTENSION, write_attr_grid, write_binary_grid, write_grid
+from nzshm_grid_loc.nzshm_grid_loc import build_grid_inputs, load_region
+
+FORMATS = ('csv', 'parquet', 'nzgrid')
+
+_PRODUCT_KEYS = {
+    'name',
+    'output',
+    'step',
+    'region',
+    'neighbours',
+    'annotations',
+    'columns',
+    'format',
+    'float_precision',
+}
+
+Region = Union[Regions, str]
+
+
+class Product(NamedTuple):
+    """
+    A grid product of a manifest.
+    """
+
+    name: str
+    output: str
+    step: float
+    region: Region
+    neighbours: int = 1
+    annotations: Tuple[Tuple[str, Any, Optional[Region]], ...] = ()
+    columns: Optional[Tuple[str, ...]] = None
+    format: str = 'csv'
+    float_precision: Optional[int] = None
+
+
+def load_manifest(file_name: str) -> List[Product]:
+    """
+    Reads the products of a TOML or YAML manifest. YAML manifests need PyYAML, TOML manifests need tomli before Python
+    3.11.
+    :param file_name: the manifest file name, ending with .toml, .yaml or .yml
+    :return: the products in manifest order
+    """
+    if file_name.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError as e:
+                raise ImportError("reading TOML manifests before Python 3.11 requires tomli") from e
+        with open(file_name, 'rb') as f:
+            manifest = tomllib.load(f)
+    elif file_name.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError as e:
+            raise ImportError("reading YAML manifests requires PyYAML") from e
+        with open(file_name) as f:
+            manifest = yaml.safe_load(f) or {}
+    else:
+        raise ValueError(f"unsupported manifest format {file_name}, use .toml, .yaml or .yml")
+
+    base = os.path.dirname(os.path.abspath(file_name))
+    defaults = manifest.get('defaults', {})
+    products = [_product({**defaults, **entry}, base) for entry in manifest.get('products', [])]
+    names = [product.name for product in products]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"duplicate product names: {', '.join(duplicates)}")
+    return products
+
+
+def _product(entry: Dict[str, Any], base: str) -> Product:
+    unknown = set(entry) - _PRODUCT_KEYS
+    if unknown:
+        raise ValueError(f"unknown product keys: {', '.join(sorted(unknown))}")
+    if 'output' not in entry or 'step' not in entry:
+        raise ValueError(f"products need an output and a step: {entry}")
+    output = os.path.join(base, entry['output'])
+    format = entry.get('format') or _format_of(output)
+    if format not in FORMATS:
+        raise ValueError(f"unsupported format {format}")
+    annotations = tuple(
+        (annotation['name'], annotation['value'], _region(annotation.get('clip'), base))
+        for annotation in entry.get('annotations', [])
+    )
+    columns = entry.get('columns')
+    return Product(
+        name=entry.get('name') or os.path.basename(entry['output']),
+        output=output,
+        step=entry['step'],
+        region=_region(entry.get('region', Regions.NZ_SMALL.name), base),
+        neighbours=entry.get('neighbours', 1),
+        annotations=annotations,
+        columns=None if columns is None else tuple(columns),
+        format=format,
+        float_precision=entry.get('float_precision'),
+    )
+
+
+def _region(region: Optional[str], base: str) -> Optional[Region]:
+    if region is None:
+        return None
+    if region in Regions.__members__:
+        return Regions[region]
+    return os.path.join(base, region)
+
+
+def _format_of(file_name: str) -> str:
+    if file_name.endswith(GRID_FILE_EXTENSION):
+        return 'nzgrid'
+    if file_name.endswith('.parquet'):
+        return 'parquet'
+    return 'csv'
+
+
+def plan(products: Sequence[Product]) -> List[List[Product]]:
+    """
+    Groups products that share intermediate grids. All products of a group have the same region and step, so they
+    share the clipped grid and every grid with the same neighbours and leading annotations. Groups do not share
+    anything and can be built in parallel.
+    :param products: the products
+    :return: the groups, finest step first, as they take longest
+    """
+    groups: Dict[Tuple[Region, float], List[Product]] = {}
+    for product in products:
+        groups.setdefault((product.region, product.step), []).append(product)
+    return sorted(groups.values(), key=lambda group: group[0].step)
+
+
+class _GroupBuilder:
+    """
+    Builds the grids of a group, keeping the intermediate grids that products share.
+    """
+
+    def __init__(self, region: Region, step: float):
+        self.region = region
+        self.step = step
+        self.grids: Dict[tuple, Grid] = {}
+
+    def grid(self, neighbours: int, annotations: tuple) -> Grid:
+        key = (neighbours, annotations)
+        if key not in self.grids:
+            if annotations:
+                name, value, clip = annotations[-1]
+                parent = self.grid(neighbours, annotations[:-1])
+                self.grids[key] = parent.annotate(name, value, clip=None if clip is None else load_region(clip))
+            elif neighbours:
+                self.grids[key] = self.grid(0, ()).add_neighbours(rings=neighbours)
+            else:
+                self.grids[key] = Grid.for_polygon(self.step, load_region(self.region))
+        return self.grids[key]
+
+
+def build_group(group: Sequence[Product], cache: Union[bool, GridCache] = True) -> Iterator[Tuple[Product, Grid]]:
+    """
+    Builds the grids of a group of products from plan, computing shared intermediate grids once.
+    Products are cached like build_grid, so a product that build_grid has made before, or that an earlier run has
+    made, is loaded from the cache and its intermediates are not built.
+    :param group: products with the same region and step
+    :param cache: False to always build the grids, True to use the default GridCache, or a GridCache
+    :return: an iterator of product and grid, in group order
+    """
+    builder = _GroupBuilder(group[0].region, group[0].step)
+    for product in group:
+        inputs = build_grid_inputs(product.step, product.region, product.neighbours, product.annotations)
+        grid = cached_grid(lambda: builder.grid(product.neighbours, product.annotations), cache, **inputs)
+        yield product, grid
+
+
+def _build_group_list(group: Sequence[Product], cache: Union[bool, GridCache]) -> List[Tuple[Product, Grid]]:
+    return list(build_group(group, cache))
+
+
+def write_product(product: Product, grid: Grid) -> int:
+    """
+    Writes the grid of a product to its output file, creating its directory if needed.
+    :param product: the product
+    :param grid: its grid
+    :return: the number of points written
+    """
+    directory = os.path.dirname(product.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if product.format == 'nzgrid':
+        write_binary_grid(grid, product.output)
+    elif product.columns is None and product.format == 'csv':
+        write_grid(grid, product.output)
+    else:
+        columns = product.columns or ('lon', 'lat')
+        write_attr_grid(grid, product.output, columns, format=product.format, float_precision=product.float_precision)
+    return len(grid)
+
+
+def build_products(
+    products: Sequence[Product], workers: int = 1, cache: Union[bool, GridCache] = True
+) -> Iterator[Tuple[Product, int]]:
+    """
+    Builds and writes products. Outputs are written in a background thread while the next grids are built. With more
+    than one worker, the groups of plan are built in a process pool. Each process loads a region once for all the
+    groups it builds.
+    :param products: the products
+    :param workers: the number of processes
+    :param cache: False to always build the grids, True to use the default GridCache, or a GridCache
+    :return: an iterator of product and number of points, in the order the products are written
+    """
+    groups = plan(products)
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        writes: List[Future] = []
+        if workers <= 1 or len(groups) <= 1:
+            for group in groups:
+                for product, grid in build_group(group, cache):
+                    writes.append(writer.submit(_write, product, grid))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                builds = [executor.submit(_build_group_list, group, cache) for group in groups]
+                for build in as_completed(builds):
+                    for product, grid in build.result():
+                        writes.append(writer.submit(_write, product, grid))
+        # writes finish in submission order
+        for write in writes:
+            yield write.result()
+
+
+def _write(product: Product, grid: Grid) -> Tuple[Product, int]:
+    return product, write_product(product, grid)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='nzshm-grid-loc', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('manifest', help='a TOML or YAML manifest file')
+    parser.add_argument('--workers', type=int, default=1, help='the number of processes building grids')
+    parser.add_argument('--select', nargs='+', help='only build the products with these names')
+    parser.add_argument('--no-cache', action='store_true', help='build all grids, without the grid cache')
+    parser.add_argument('--dry-run', action='store_true', help='print the products and how they are grouped')
+    args = parser.parse_args(argv)
+
+    products = load_manifest(args.manifest)
+    if args.select:
+        unknown = set(args.select) - {product.name for product in products}
+        if unknown:
+            parser.error(f"unknown products: {', '.join(sorted(unknown))}")
+        products = [product for product in products if product.name in args.select]
+
+    if args.dry_run:
+        for group in plan(products):
+            region = group[0].region.name if isinstance(group[0].region, Regions) else group[0].region
+            print(f"{region} {group[0].step}")
+            for product in group:
+                print(f"    {product.name} -> {product.output}")
+        return 0
+
+    for product, count in build_products(products, args.workers, cache=not args.no_cache):
+        print(f"{product.name}: {count} points written to {product.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import warnings
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+from nzshm_grid_loc.grid import Grid, _is_instance
+from nzshm_grid_loc.io import GRID_FILE_EXTENSION, load_binary_grid, write_binary_grid
+
+# change this when a change to the grid algorithms makes cached grids invalid
+CACHE_VERSION = 1
+
+# environment variable to set the cache directory
+CACHE_DIR_VARIABLE = 'NZSHM_GRID_LOC_CACHE'
+
+DEFAULT_MAX_BYTES = 1 << 30
+
+# file digests, keyed by real path and modification time
+_file_digests: Dict[Tuple[str, int], str] = {}
+_file_digests_lock = threading.Lock()
+
+
+def default_cache_dir() -> pathlib.Path:
+    """
+    Returns the cache directory from the NZSHM_GRID_LOC_CACHE environment variable, or a directory in the user's cache
+    directory.
+    :return: the directory path
+    """
+    if os.environ.get(CACHE_DIR_VARIABLE):
+        return pathlib.Path(os.environ[CACHE_DIR_VARIABLE])
+    base = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+    return pathlib.Path(base, 'nzshm-grid-loc')
+
+
+class GridCache:
+    """
+    A content-addressed directory of generated grids, stored as binary grid files.
+    Entries are keyed by a hash of the inputs that produced them. When the directory grows over max_bytes, the least
+    recently used entries are removed.
+    """
+
+    def __init__(self, directory: Union[str, pathlib.Path, None] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Creates a GridCache instance.
+        :param directory: the cache directory, see default_cache_dir
+        :param max_bytes: the maximum total size of the cached grids
+        """
+        self.directory = pathlib.Path(directory) if directory is not None else default_cache_dir()
+        self.max_bytes = max_bytes
+
+    def key(self, **inputs: Any) -> str:
+        """
+        Creates a cache key from the inputs of a grid product.
+        Regions and GeoDataFrames are hashed by content, other values must be JSON serializable. Pass polygon file names
+        through region_digest, so that the key changes when the file changes.
+        :param inputs: the inputs
+        :return: the key
+        """
+        canonical = json.dumps({'version': CACHE_VERSION, **inputs}, sort_keys=True, default=region_digest)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Grid]:
+        """
+        Returns the cached grid for a key.
+        :param key: a key created with key()
+        :return: the grid, or None if it is not cached
+        """
+        path = self._path(key)
+        try:
+            grid = load_binary_grid(str(path))
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return grid
+
+    def put(self, key: str, grid: Grid) -> None:
+        """
+        Stores a grid in the cache.
+        :param key: a key created with key()
+        :param grid: the grid
+        :return: None
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so that other processes never see a partly written entry
+        handle, temp_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(handle)
+        try:
+            write_binary_grid(grid, temp_name)
+            os.replace(temp_name, self._path(key))
+        finally:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+        self._evict()
+
+    def clear(self) -> None:
+        """
+        Removes all cached grids.
+        :return: None
+        """
+        for path in self.directory.glob('*' + GRID_FILE_EXTENSION):
+            _remove(path)
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / (key + GRID_FILE_EXTENSION)
+
+    def _evict(self) -> None:
+        entries = []
+        for path in self.directory.glob('*' + GRID_FILE_EXTENSION):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+
+
+def cached_grid(build: Callable[[], Grid], cache: Union[bool, GridCache] = True, **inputs: Any) -> Grid:
+    """
+    Returns the cached grid for the inputs, or builds and caches it.
+    If the inputs can't be turned into a key, or the grid can't be written to the cache, for example because an
+    attribute value can't be serialized, a warning is issued and the built grid is returned.
+    :param build: a function that builds the grid
+    :param cache: False to always build the grid, True to use a GridCache in the default directory, or a GridCache
+    :param inputs: everything the grid depends on, see GridCache.key
+    :return: the grid
+    """
+    if cache is False:
+        return build()
+    if cache is True:
+        cache = GridCache()
+    try:
+        key = cache.key(**inputs)
+    except (TypeError, ValueError) as e:
+        warnings.warn(f"could not create a grid cache key, the grid is not cached: {e}")
+        return build()
+    grid = cache.get(key)
+    if grid is None:
+        grid = build()
+        try:
+            cache.put(key, grid)
+        except (OSError, TypeError, ValueError) as e:
+            warnings.warn(f"could not write grid to cache {cache.directory}: {e}")
+    return grid
+
+
+def region_digest(region: Any) -> str:
+    """
+    Returns a content hash of a region.
+    :param region: a Regions member, the file name of a polygon file or a GeoDataFrame
+    :return: the hash
+    """
+    if _is_instance(region, 'geopandas', 'GeoDataFrame'):
+        import shapely
+
+        wkb = shapely.to_wkb(region.geometry.values, hex=True)
+        return hashlib.sha256('\n'.join(str(value) for value in wkb).encode()).hexdigest()
+    if hasattr(region, 'value') and isinstance(region.value, str):
+        region = region.value
+    if isinstance(region, (str, pathlib.Path)):
+        return file_digest(str(region))
+    raise TypeError(f"cannot hash {type(region).__name__} for a cache key")
+
+
+def file_digest(file_name: str) -> str:
+    """
+    Returns the SHA-256 hash of a file. The hash is computed once per process, unless the file is modified.
+    :param file_name: a path to a file
+    :return: the hash
+    """
+    path = os.path.realpath(file_name)
+    key = (path, os.stat(path).st_mtime_ns)
+    with _file_digests_lock:
+        digest = _file_digests.get(key)
+    if digest is None:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with _file_digests_lock:
+            _file_digests[key] = digest
+    return digest
+
+
+def _remove(path: pathlib.Path) -> None:
+    try:
+        path.unlink()
+    except OSError:
+        # another process removed it first, or it is still open on a platform that does not allow that
+        pass
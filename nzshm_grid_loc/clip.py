@@ -0,0 +1,108 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+import shapely
+from geopandas import GeoDataFrame
+from shapely import STRtree
+
+from nzshm_grid_loc.profiling import count_predicates, instrument
+
+# the number of points that are turned into shapely geometries at a time for the STRtree query
+CHUNK_SIZE = 1 << 20
+
+# the number of partitions per worker process, so that workers finishing early can pick up more work
+PARTITIONS_PER_WORKER = 4
+
+# the region index of a worker process, set up once by _init_worker
+_worker_index: Optional['_RegionIndex'] = None
+
+
+class _RegionIndex:
+    """
+    Prepared region geometries and an STRtree over them.
+    """
+
+    def __init__(self, geometries: np.ndarray):
+        self.geometries = geometries
+        shapely.prepare(self.geometries)
+        self.tree = STRtree(self.geometries)
+
+    def contains(self, lons: np.ndarray, lats: np.ndarray, chunk_size: int = CHUNK_SIZE) -> np.ndarray:
+        mask = np.zeros(len(lons), dtype=bool)
+        if not len(self.geometries):
+            return mask
+        for start in range(0, len(lons), chunk_size):
+            x = lons[start : start + chunk_size]
+            y = lats[start : start + chunk_size]
+            # bounding box candidates from the tree, then an exact test of each candidate pair
+            point_index, geometry_index = self.tree.query(shapely.points(x, y))
+            count_predicates(len(point_index))
+            hits = shapely.contains_xy(self.geometries[geometry_index], x[point_index], y[point_index])
+            mask[start + point_index[hits]] = True
+        return mask
+
+
+def region_geometries(gdf: GeoDataFrame) -> np.ndarray:
+    """
+    Returns the non-empty geometries of a GeoDataFrame as a shapely geometry array.
+    :param gdf: a GeoDataFrame of polygons
+    :return: an array of geometries
+    """
+    geometries = np.asarray(gdf.geometry.values, dtype=object)
+    geometries = geometries[~shapely.is_missing(geometries)]
+    return geometries[~shapely.is_empty(geometries)]
+
+
+@instrument()
+def contains_mask(
+    gdf: GeoDataFrame, lons: np.ndarray, lats: np.ndarray, chunk_size: int = CHUNK_SIZE, workers: int = 1
+) -> np.ndarray:
+    """
+    Tests which points are inside any polygon of gdf.
+    Points on a polygon boundary are not inside, the same as shapely's contains.
+    :param gdf: a GeoDataFrame of polygons
+    :param lons: the longitudes of the points
+    :param lats: the latitudes of the points
+    :param chunk_size: the number of points to test at a time
+    :param workers: the number of processes to use. With more than one worker, the points are split into strips
+        that are tested in a process pool. The result is the same as with one worker.
+    :return: a boolean array that is True for points inside gdf
+    """
+    return _contains(region_geometries(gdf), lons, lats, chunk_size, workers)
+
+
+def _contains(
+    geometries: np.ndarray, lons: np.ndarray, lats: np.ndarray, chunk_size: int = CHUNK_SIZE, workers: int = 1
+) -> np.ndarray:
+    """
+    Implementation of contains_mask for a shapely array of region geometries, see region_geometries.
+    """
+    if not len(lons) or not len(geometries):
+        return np.zeros(len(lons), dtype=bool)
+    if workers <= 1:
+        return _RegionIndex(geometries).contains(lons, lats, chunk_size)
+
+    # grid coordinates are sorted by longitude, so contiguous partitions are spatial strips
+    edges = np.linspace(0, len(lons), min(workers * PARTITIONS_PER_WORKER, len(lons)) + 1).astype(int)
+    partitions = [slice(start, end) for start, end in zip(edges[:-1], edges[1:])]
+    # the geometries are pickled once per worker, not once per partition
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(geometries,)) as executor:
+        masks = executor.map(
+            _worker_contains,
+            [lons[p] for p in partitions],
+            [lats[p] for p in partitions],
+            [chunk_size] * len(partitions),
+        )
+        # map returns the results in partition order, so the merged mask does not depend on scheduling
+        return np.concatenate(list(masks))
+
+
+def _init_worker(geometries: np.ndarray) -> None:
+    global _worker_index
+    _worker_index = _RegionIndex(geometries)
+
+
+def _worker_contains(lons: np.ndarray, lats: np.ndarray, chunk_size: int) -> np.ndarray:
+    assert _worker_index is not None
+    return _worker_index.contains(lons, lats, chunk_size)
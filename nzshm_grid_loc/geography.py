@@ -1,13 +1,20 @@
 import os
 import pathlib
+import threading
 from enum import Enum
-
-from geopandas import GeoDataFrame
+from typing import TYPE_CHECKING, Dict, Tuple
 
 from nzshm_grid_loc.io import load_polygon_file
 
+if TYPE_CHECKING:
+    from geopandas import GeoDataFrame
+
 RESOURCES_FOLDER = pathlib.Path(pathlib.PurePath(os.path.realpath(__file__)).parent, 'resources')
 
+# loaded polygon files, keyed by real path and modification time
+_region_cache: Dict[Tuple[str, int], 'GeoDataFrame'] = {}
+_region_cache_lock = threading.Lock()
+
 
 class Regions(Enum):
     """
@@ -21,9 +28,50 @@ class Regions(Enum):
     WLG = str(RESOURCES_FOLDER) + '/wellington.geojson'  # Oakley just made this as a test
     BACKARC = str(RESOURCES_FOLDER) + '/backarc.geojson'
 
-    def load(self) -> GeoDataFrame:
+    def load(self) -> 'GeoDataFrame':
         """
         Loads the GeoDataFrame associated with this region.
+        The file is only read the first time it is used in a process, see load_cached_polygon_file, and from its
+        GeoParquet sidecar if there is one, see load_polygon_file.
         :return: a GeoDataFrame
         """
-        return load_polygon_file(self.value)
+        return load_cached_polygon_file(self.value, sidecar=True)
+
+    @staticmethod
+    def clear_cache() -> None:
+        """
+        Removes all loaded regions from the cache.
+        :return: None
+        """
+        clear_region_cache()
+
+
+def load_cached_polygon_file(file_name: str, sidecar: bool = False) -> 'GeoDataFrame':
+    """
+    Loads a polygon file like load_polygon_file, but only reads the file again if it has been modified since it was
+    last loaded in this process.
+    The returned GeoDataFrame is a shallow copy: columns can be replaced, but the geometries are shared with the cache
+    and must not be modified in place.
+    :param file_name: path to a geometry file
+    :param sidecar: whether to use a GeoParquet sidecar file, see load_polygon_file
+    :return: a GeoDataFrame
+    """
+    path = os.path.realpath(file_name)
+    key = (path, os.stat(path).st_mtime_ns)
+    with _region_cache_lock:
+        gdf = _region_cache.get(key)
+        if gdf is None:
+            gdf = load_polygon_file(file_name, sidecar=sidecar)
+            for stale in [k for k in _region_cache if k[0] == path]:
+                del _region_cache[stale]
+            _region_cache[key] = gdf
+    return gdf.copy(deep=False)
+
+
+def clear_region_cache() -> None:
+    """
+    Removes all files loaded by load_cached_polygon_file from the cache.
+    :return: None
+    """
+    with _region_cache_lock:
+        _region_cache.clear()
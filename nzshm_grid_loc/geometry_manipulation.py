@@ -1,65 +1,184 @@
-from typing import Any, Union
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple, Union
 
-from geopandas import GeoDataFrame, read_file
+import numpy as np
+import shapely
+from geopandas import GeoDataFrame, GeoSeries, read_file
 from shapely.geometry import MultiPolygon, Polygon
 
+from nzshm_grid_loc.cache import region_digest
+from nzshm_grid_loc.clip import PARTITIONS_PER_WORKER
+from nzshm_grid_loc.geography import RESOURCES_FOLDER
 from nzshm_grid_loc.io import gdf_to_wkt_zip, load_polygon_file
-from nzshm_grid_loc.plot_grid import Plot
+
+# the box that regions are clipped to, it excludes the Chatham Islands and the sub-Antarctic islands
+NZ_BBOX = str(RESOURCES_FOLDER) + '/nz_bbox.geojson'
+
+# intermediate results that do not depend on the tolerance, so that tolerance sweeps only compute them once.
+# Keyed by the content hash of the input GeoDataFrame, or the real path, modification time and max_rows of a shapefile.
+_intermediates: Dict[Tuple, Any] = {}
+_intermediates_lock = threading.Lock()
 
 
 def remove_holes(geom: Union[Polygon, MultiPolygon, GeoDataFrame]) -> Any:
-    if isinstance(geom, Polygon):
-        if geom.interiors:
-            return Polygon(list(geom.exterior.coords))
-        else:
-            return geom
-    elif isinstance(geom, MultiPolygon):
-        return MultiPolygon([remove_holes(poly) for poly in geom.geoms])
-    elif isinstance(geom, GeoDataFrame):
-        geom['geometry'] = [remove_holes(poly) for poly in geom.geometry]
+    """
+    Removes the interior rings of polygons.
+    :param geom: a Polygon, a MultiPolygon or a GeoDataFrame, whose geometry column is replaced
+    :return: the geometry, or the GeoDataFrame
+    """
+    if isinstance(geom, GeoDataFrame):
+        geom['geometry'] = GeoSeries(_remove_holes(geom.geometry.values), index=geom.index, crs=geom.crs)
         return geom
+    if isinstance(geom, (Polygon, MultiPolygon)):
+        return _remove_holes(np.array([geom], dtype=object))[0]
 
 
-def remove_holes_from_nz(nz: GeoDataFrame) -> GeoDataFrame:
-    # remove holes to ensure valid geometry in NZ Small (oops)
-    nz = remove_holes(nz)
-    # merge all polygons into one
-    nz = nz.dissolve()
-    # As merge artifacts, we can have what is visually a hole but it's not actually an "interior" polygon. This happens
-    # around fjords, deltas, etc. Intersect with a giant rectangle to turn the visual holes into "proper" holes
-    nz['geometry'][0] = load_polygon_file('resources/nz_bbox.geojson').geometry[0].intersection(nz.geometry[0])
-    # remove those last holes
-    return remove_holes(nz)
+def _remove_holes(geometries: np.ndarray) -> np.ndarray:
+    """
+    Removes the interior rings of all polygons and multipolygons of a geometry array. Other geometries are kept.
+    """
+    geometries = np.array(geometries, dtype=object)
+    types = shapely.get_type_id(geometries)
+    polygons = (types == shapely.GeometryType.POLYGON) & ~shapely.is_empty(geometries)
+    geometries[polygons] = shapely.polygons(shapely.get_exterior_ring(geometries[polygons]))
+    multi = (types == shapely.GeometryType.MULTIPOLYGON) & ~shapely.is_empty(geometries)
+    if multi.any():
+        parts, index = shapely.get_parts(geometries[multi], return_index=True)
+        geometries[multi] = shapely.multipolygons(shapely.polygons(shapely.get_exterior_ring(parts)), indices=index)
+    return geometries
 
 
-def simplify_shape(file_in: str, tolerance=0.01, max_rows=50, visual_check=True) -> None:
+def remove_holes_from_nz(nz: GeoDataFrame, workers: int = 1) -> GeoDataFrame:
+    """
+    Merges the polygons of a region into one polygon without holes, clipped to NZ_BBOX.
+    The merged polygon is kept for the process, keyed by the content of nz, so calling this again with the same region
+    does not repeat the union.
+    :param nz: a GeoDataFrame of polygons
+    :param workers: the number of processes that make the polygons valid, remove their holes and merge parts of them
+    :return: a GeoDataFrame with one row, with the other columns of the first row of nz
+    """
+    key = ('remove_holes_from_nz', region_digest(nz))
+    with _intermediates_lock:
+        merged = _intermediates.get(key)
+    if merged is None:
+        # remove holes to ensure valid geometry in NZ Small (oops), and merge all polygons into one
+        unions = _map_partitions(_union_without_holes, nz.geometry.values, workers)
+        merged = shapely.union_all(np.array([union for _, union in unions], dtype=object))
+        # As merge artifacts, we can have what is visually a hole but it's not actually an "interior" polygon. This
+        # happens around fjords, deltas, etc. Intersect with a giant rectangle to turn the visual holes into "proper"
+        # holes. The intersection can have lines where the rectangle touches a polygon, only the polygons are kept.
+        merged = shapely.intersection(load_polygon_file(NZ_BBOX).geometry.values[0], merged)
+        # remove those last holes
+        merged = shapely.multipolygons(_remove_holes(_polygon_parts(np.array([merged], dtype=object))))
+        with _intermediates_lock:
+            _intermediates[key] = merged
+    columns = nz.drop(columns=nz.geometry.name).iloc[:1].reset_index(drop=True)
+    return GeoDataFrame(columns, geometry=[merged], crs=nz.crs)
+
+
+def simplify_shape(
+    file_in: str,
+    tolerance=0.01,
+    max_rows=50,
+    visual_check=True,
+    file_out: str = "small-nz.wkt.csv",
+    workers: int = 1,
+) -> GeoDataFrame:
     """
     Loads a shapefile and creates a simpler version.
     This function is made especially for grid filters, and the resulting polygons will be slightly larger than the
     original ones.
+    The largest shapes, made valid and clipped to NZ_BBOX, are kept for the process, so calling this again for the
+    same file with other tolerances only buffers and simplifies them.
     :param file_in: path ot a shapefile
     :param tolerance: This is in the units of the shapefile and is used to create a buffer and then simplify the shape
     :param max_rows: if the shapefile has more than one shape in it, take only the "max_rows" largest ones.
     :param visual_check: if True, show a plot of the old and new shapes.
-    :return: None
+    :param file_out: the name of the WKT CSV file, which is written zipped to file_out + ".zip"
+    :param workers: the number of processes that buffer and simplify the shapes
+    :return: the simplified shapes
     """
-    original = read_file(file_in)
-    original['Area'] = original['geometry'].area
-    df = original.sort_values(by=['Area'], ascending=False)[:max_rows]
-    df = df.drop(['Area'], axis=1)
-    df = df.reset_index(drop=True)
-    clip_box = load_polygon_file('resources/nz_bbox.geojson')
-    df = df.clip(clip_box)
-    df['geometry'] = df.geometry.buffer(tolerance)
-    df['geometry'] = df.geometry.simplify(tolerance=tolerance)
-
-    file_out = "small-nz.wkt.csv"
+    original, df = _largest_shapes(file_in, max_rows)
+    geometries = np.empty(len(df), dtype=object)
+    for partition, simplified in _map_partitions(_buffer_simplify, df.geometry.values, workers, tolerance):
+        geometries[partition] = simplified
+    df = df.set_geometry(GeoSeries(geometries, index=df.index, crs=df.crs))
+
     gdf_to_wkt_zip(df, file_out, tolerance)
 
     if visual_check:
+        from nzshm_grid_loc.plot_grid import Plot
+
         zgdf = load_polygon_file(file_out + '.zip')
         plot = Plot()
         plot.add_geoDataFrame(original, color='r')
         plot.add_geoDataFrame(df, color='g')
         plot.add_geoDataFrame(zgdf, color='b')
         plot.show()
+    return df
+
+
+def _largest_shapes(file_in: str, max_rows: int) -> Tuple[GeoDataFrame, GeoDataFrame]:
+    """
+    Reads a shapefile and returns it, and its max_rows largest shapes made valid and clipped to NZ_BBOX.
+    """
+    path = os.path.realpath(file_in)
+    key = ('largest_shapes', path, os.stat(path).st_mtime_ns, max_rows)
+    with _intermediates_lock:
+        shapes = _intermediates.get(key)
+    if shapes is None:
+        original = read_file(file_in)
+        largest = np.argsort(-shapely.area(original.geometry.values), kind='stable')[:max_rows]
+        df = original.iloc[largest].reset_index(drop=True)
+        df = df.set_geometry(GeoSeries(shapely.make_valid(df.geometry.values), index=df.index, crs=df.crs))
+        shapes = original, df.clip(load_polygon_file(NZ_BBOX))
+        with _intermediates_lock:
+            _intermediates[key] = shapes
+    return shapes[0], shapes[1].copy()
+
+
+def clear_cache() -> None:
+    """
+    Removes the intermediate results of remove_holes_from_nz and simplify_shape.
+    :return: None
+    """
+    with _intermediates_lock:
+        _intermediates.clear()
+
+
+def _polygon_parts(geometries: np.ndarray) -> np.ndarray:
+    """
+    Returns the polygons of a geometry array, including the polygons in multipolygons and geometry collections.
+    """
+    # make_valid can return collections of multipolygons and lines, so collections are taken apart twice
+    parts = shapely.get_parts(shapely.get_parts(geometries))
+    return parts[shapely.get_type_id(parts) == shapely.GeometryType.POLYGON]
+
+
+def _union_without_holes(geometries: np.ndarray) -> Any:
+    return shapely.union_all(_remove_holes(_polygon_parts(shapely.make_valid(geometries))))
+
+
+def _buffer_simplify(geometries: np.ndarray, tolerance: float) -> np.ndarray:
+    return shapely.simplify(shapely.buffer(geometries, tolerance), tolerance)
+
+
+def _map_partitions(
+    fn: Callable[..., Any], geometries: np.ndarray, workers: int, *args: Any
+) -> List[Tuple[np.ndarray, Any]]:
+    """
+    Splits geometries into partitions and applies fn to the geometry array of each, in a process pool if there is
+    more than one worker. Geometries are dealt out to the partitions in turn, so that the largest ones, which usually
+    come first, are spread over the workers.
+    :return: the index of the geometries of each partition and the result of fn for them, in partition order
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    count = min(workers * PARTITIONS_PER_WORKER, len(geometries)) if workers > 1 else 1
+    partitions = [np.arange(start, len(geometries), max(count, 1)) for start in range(max(count, 1))]
+    if count <= 1:
+        return [(partitions[0], fn(geometries, *args))]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(fn, [geometries[p] for p in partitions], *[[arg] * count for arg in args])
+        return list(zip(partitions, results))
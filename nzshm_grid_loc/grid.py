@@ -1,46 +1,161 @@
-from typing import Any, Callable, Iterable, Union
+import sys
+import warnings
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 import numpy as np
-from geopandas import GeoDataFrame
-from shapely.geometry import Point
+
+from nzshm_grid_loc.profiling import instrument
+
+# geopandas, pandas and shapely are imported when they are first needed, so that grids can be used with NumPy only
+if TYPE_CHECKING:
+    from geopandas import GeoDataFrame, GeoSeries
+    from shapely.geometry import Point
+
+# Points are stored as int64 keys. A key packs the lon and lat of a point, both expressed as an integer number of
+# 10^-precision degrees, so that sorting the keys sorts the points by (lon, lat).
+_Y_OFFSET = 1 << 31
+_Y_MASK = (1 << 32) - 1
+_COORDINATE_LIMIT = 1 << 31
+
+# the maximum number of decimal places of grid coordinates, coordinates with more are rounded
+MAX_PRECISION = 6
+
+# coordinates that rounding to the lattice changes by more than this, in degrees, are reported. Smaller changes are
+# floating point noise, e.g. 0.1 + 0.2 == 0.30000000000000004.
+_ROUNDING_TOLERANCE = 1e-9
+
+# add_neighbours uses an occupancy raster if it has at most this many cells per grid point
+_RASTER_DENSITY = 64
+
+
+class AttributeColumn(NamedTuple):
+    """
+    The values of one attribute for all points of a grid, in the same order as the points.
+    codes holds the index into categories of the value of each point, or -1 where the attribute is not set.
+    """
+
+    codes: np.ndarray
+    categories: tuple
+
+    def take(self, index: np.ndarray) -> 'AttributeColumn':
+        """
+        Selects the values of a subset of points.
+        :param index: a boolean mask or an index array
+        :return: the new column
+        """
+        return AttributeColumn(self.codes[index], self.categories)
+
+    def with_value(self, value: Any, mask: np.ndarray) -> 'AttributeColumn':
+        """
+        Sets the value for the points selected by mask.
+        :param value: the new value
+        :param mask: a boolean mask or an index array
+        :return: the new column
+        """
+        code, categories = _category_code(self.categories, value)
+        codes = self.codes.copy()
+        codes[mask] = code
+        return AttributeColumn(codes, categories)
+
+    def values(self, default: Any = None) -> np.ndarray:
+        """
+        Returns the value of each point as an object array.
+        :param default: the value for points where the attribute is not set
+        :return: the values
+        """
+        lookup = np.empty(len(self.categories) + 1, dtype=object)
+        for i, category in enumerate(self.categories):
+            lookup[i] = category
+        lookup[-1] = default
+        return lookup[self.codes]
+
+
+class GridDelta(NamedTuple):
+    """
+    The changes from an old grid to a new grid, see Grid.delta.
+    Each field is a float array of shape (n, 2) with lon/lat rows, in the same order as iterating over a grid.
+    added and removed are the points that are only in the new or only in the old grid. Points in both grids are either
+    unchanged, or changed if the value of any attribute differs.
+    """
+
+    added: np.ndarray
+    removed: np.ndarray
+    unchanged: np.ndarray
+    changed: np.ndarray
 
 
 class Grid:
     """
     An immutable collection of grid points.
     Iterating over a grid will result in shapely.geometry.Point objects.
+
+    Internally, the points are stored as a sorted array of int64 keys on a lattice of 10^-precision degrees.
+    The precision is at most MAX_PRECISION (6) decimal places, coordinates with more are rounded with a warning.
+    Coordinates are only decoded to floats when they are needed. Attributes are stored as one AttributeColumn per
+    attribute name.
     """
 
     step: float
     precision: int
-    points: set = set()
-    attributes: dict = {}
 
-    def __init__(self, step: float, points: Union[set, list, Iterable], attributes: dict = {}):
+    def __init__(self, step: float, points: Union[set, list, Iterable, np.ndarray], attributes: dict = {}):
         """
         Creates a Grid instance.
         :param step: the step distance
-        :param points: either a set of lat/lon tuples or a sequence of Points
+        :param points: either a set of lon/lat tuples, a sequence of Points or an array of shape (n, 2)
+        :param attributes: a dictionary of point tuple to a dictionary of attributes
         """
-        self.step = step
-        self.precision = get_precision(step)
-        self.attributes = attributes
-        if not points:
-            self.points = set()
-        elif isinstance(points, set):
-            self.points = points
+        coordinates = _to_coordinate_array(points)
+        precision = max(_step_precision(step), infer_precision(coordinates))
+        if coordinates.size:
+            x, y = _quantize(coordinates[:, 0], precision), _quantize(coordinates[:, 1], precision)
+            _warn_if_rounded(coordinates, x, y, precision)
+            keys = _unique_sorted(_encode(x, y))
         else:
-            points = list(points)
-            if isinstance(points[0], Point):
-                self.points = set()
-                for p in points:
-                    self.points.add((p.x, p.y))
-            elif isinstance(points[0], tuple):
-                self.points = set(points)
-            else:
-                assert False
+            keys = np.empty(0, dtype=np.int64)
+        self._set_state(step, precision, keys, {})
+        if attributes:
+            self._columns = self._columns_from_dict(attributes)
 
     @classmethod
+    def _from_keys(
+        cls, step: float, precision: int, keys: np.ndarray, columns: Dict[str, AttributeColumn] = {}
+    ) -> 'Grid':
+        """
+        Creates a Grid directly from lattice keys without validation.
+        :param step: the step distance
+        :param precision: the number of decimal places of the lattice the keys are based on
+        :param keys: a sorted array of unique keys
+        :param columns: the attribute columns, aligned with keys
+        :return: the grid
+        """
+        grid = cls.__new__(cls)
+        grid._set_state(step, precision, keys, columns)
+        return grid
+
+    def _set_state(self, step: float, precision: int, keys: np.ndarray, columns: Dict[str, AttributeColumn]) -> None:
+        self.step = step
+        self.precision = precision
+        self._keys = keys
+        self._keys.flags.writeable = False
+        self._columns = dict(columns)
+        # the origin is computed lazily, None is a valid origin, so a flag marks whether it has been computed
+        self._origin: Optional[Tuple[float, float]] = None
+        self._origin_known = False
+        self._lonlat: Optional[np.ndarray] = None
+        self._points: Optional[frozenset] = None
+
+    def _subset(self, index: np.ndarray) -> 'Grid':
+        """
+        Creates a grid with a subset of the points of this grid and their attributes.
+        :param index: a boolean mask or a sorted index array
+        :return: the new grid
+        """
+        columns = {name: column.take(index) for name, column in self._columns.items()}
+        return Grid._from_keys(self.step, self.precision, self._keys[index], columns)
+
+    @classmethod
+    @instrument()
     def for_bounds(cls, lat_min: float, lat_max: float, lon_min: float, lon_max: float, step: float) -> 'Grid':
         """
         Creates a new grid based on a bounding box.
@@ -52,117 +167,501 @@ class Grid:
         :param step: distance between points in degrees
         :return: the grid
         """
-        precision = get_precision(step)
+        precision = _step_precision(step)
 
-        points = set()
-        for lat in np.arange(lat_min, lat_max, step):
-            for lon in np.arange(lon_min, lon_max, step):
-                points.add((round(lon, precision), round(lat, precision)))
+        # quantizing np.arange values gives the same lattice as calling round() on each np.float64 element
+        lats = _quantize(np.arange(lat_min, lat_max, step), precision)
+        lons = _quantize(np.arange(lon_min, lon_max, step), precision)
+        lon_grid, lat_grid = np.meshgrid(lons, lats, indexing='ij')
 
-        return cls(step, points)
+        return cls._from_keys(step, precision, _unique_sorted(_encode(lon_grid.ravel(), lat_grid.ravel())))
 
     @classmethod
-    def for_polygon(cls, step: float, gdf: GeoDataFrame) -> 'Grid':
+    @instrument()
+    def for_polygon(cls, step: float, gdf: 'GeoDataFrame', workers: int = 1) -> 'Grid':
         """
         Creates a new grid with a gdf as the bounds.
         :param step: distance between grid points in degrees
         :param gdf: a GeoDataFrame with polygons
+        :param workers: the number of processes used to clip the grid, see Grid.intersection
         :return: the grid
         """
         bounds = [int(value / step) * step for value in gdf.total_bounds]
-        return cls.for_bounds(bounds[1], bounds[3] + step, bounds[0], bounds[2] + step, step).intersection(gdf)
+        grid = cls.for_bounds(bounds[1], bounds[3] + step, bounds[0], bounds[2] + step, step)
+        return grid.intersection(gdf, workers=workers)
+
+    @property
+    def points(self) -> frozenset:
+        """
+        The grid points as a set of lon/lat tuples.
+        The set is built on first access and kept by the grid. Use contains_points to test many sites without it.
+        """
+        if self._points is None:
+            lons, lats = self._coordinates()
+            self._points = frozenset(zip(lons.tolist(), lats.tolist()))
+        return self._points
+
+    @property
+    def attributes(self) -> dict:
+        """
+        The attributes as a dictionary of lon/lat tuple to a dictionary of attribute name to value.
+        Only contains points that have at least one attribute. This is built from the attribute columns on each
+        access, use column() for bulk access.
+        """
+        lons, lats = self._coordinates()
+        points = list(zip(lons.tolist(), lats.tolist()))
+        attributes: dict = {}
+        for name, column in self._columns.items():
+            for index in np.flatnonzero(column.codes >= 0).tolist():
+                attributes.setdefault(points[index], {})[name] = column.categories[column.codes[index]]
+        return attributes
+
+    @property
+    def attribute_names(self) -> list:
+        """
+        The names of all attributes of this grid.
+        """
+        return list(self._columns)
+
+    @property
+    def origin(self) -> Optional[Tuple[float, float]]:
+        """
+        The lon/lat offset of the grid lattice from (0, 0), in the range [0, step).
+        None if the points do not lie on a common lattice with spacing step.
+        """
+        if not self._origin_known:
+            self._origin = self._find_origin()
+            self._origin_known = True
+        return self._origin
+
+    def _find_origin(self) -> Optional[Tuple[float, float]]:
+        step = _step_units(self.step, self.precision)
+        if not step:
+            return None
+        if not len(self):
+            return 0.0, 0.0
+        x, y = _decode(self._keys)
+        if not _on_lattice(x, y, step):
+            return None
+        scale = 10**self.precision
+        return float(x[0] % step) / scale, float(y[0] % step) / scale
+
+    def _coordinates(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the lon and lat arrays of the points, in the same order as iterating over the grid.
+        The keys are only decoded the first time, the arrays are read-only.
+        :return: a tuple of lon and lat float arrays
+        """
+        if self._lonlat is None:
+            x, y = _decode(self._keys)
+            scale = 10**self.precision
+            lonlat = np.empty((2, len(self._keys)))
+            np.divide(x, scale, out=lonlat[0])
+            np.divide(y, scale, out=lonlat[1])
+            lonlat.flags.writeable = False
+            self._lonlat = lonlat
+        return self._lonlat[0], self._lonlat[1]
+
+    def to_numpy(self) -> np.ndarray:
+        """
+        Returns the points as a read-only array of shape (n, 2) with lon/lat rows, in the same order as iterating over
+        the grid. The array is a view of coordinates that are cached by the grid, not a copy.
+        :return: the coordinate array
+        """
+        self._coordinates()
+        return self._lonlat.T
+
+    def to_geoseries(self) -> 'GeoSeries':
+        """
+        Returns the points as a GeoSeries of shapely Points in EPSG:4326, in the same order as iterating over the grid.
+        :return: a GeoSeries
+        """
+        from geopandas import GeoSeries, points_from_xy
+
+        return GeoSeries(points_from_xy(*self._coordinates()), crs='epsg:4326')
+
+    def to_geodataframe(self) -> 'GeoDataFrame':
+        """
+        Returns the points and their attributes as a GeoDataFrame with lon, lat and geometry columns and one column
+        per attribute. Attribute columns are pandas Categoricals where possible, missing values are NaN.
+        :return: a GeoDataFrame
+        """
+        from geopandas import GeoDataFrame, points_from_xy
+        from pandas import Categorical
+
+        lons, lats = self._coordinates()
+        data: Dict[str, Any] = {'lon': lons, 'lat': lats}
+        for name, column in self._columns.items():
+            try:
+                data[name] = Categorical.from_codes(column.codes, categories=list(column.categories))
+            except (TypeError, ValueError):
+                # categories that pandas considers equal, like 1 and True
+                data[name] = column.values()
+        return GeoDataFrame(data, geometry=points_from_xy(lons, lats), crs='epsg:4326')
+
+    def _index_of(self, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        Finds points of this grid.
+        :param lons: longitudes
+        :param lats: latitudes
+        :return: the index of each point in this grid, or -1 for points that are not in this grid
+        """
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        scale = 10**self.precision
+        with np.errstate(invalid='ignore'):
+            x = _quantize(lons, self.precision)
+            y = _quantize(lats, self.precision)
+        return self._lookup(x, y, (x / scale == lons) & (y / scale == lats))
+
+    def _lookup(self, x: np.ndarray, y: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        """
+        Finds quantized points in this grid.
+        :param x: quantized longitudes
+        :param y: quantized latitudes
+        :param valid: False for entries of x and y that should not be looked up
+        :return: the index of each point in this grid, or -1 for points that are not in this grid or not valid
+        """
+        valid = valid & (np.abs(x) < _COORDINATE_LIMIT) & (np.abs(y) < _COORDINATE_LIMIT)
+        index = _positions(_encode(np.where(valid, x, 0), np.where(valid, y, 0)), self._keys)
+        index[~valid] = -1
+        return index
+
+    def snap(self, lons: np.ndarray, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Moves sites to the nearest point of the lattice of this grid, defined by its step and origin.
+        Sites exactly halfway between lattice points move to the larger coordinate. The snapped points are not
+        necessarily in this grid, use contains_points to check.
+        :param lons: the longitudes of the sites
+        :param lats: the latitudes of the sites
+        :return: arrays of the snapped longitudes and latitudes, NaN for sites that are not finite
+        """
+        x, y, valid = self._snap_units(lons, lats)
+        scale = 10**self.precision
+        return np.where(valid, x / scale, np.nan), np.where(valid, y / scale, np.nan)
+
+    def contains_points(self, lons: np.ndarray, lats: np.ndarray, snap: bool = False) -> np.ndarray:
+        """
+        Tests which sites are points of this grid.
+        :param lons: the longitudes of the sites
+        :param lats: the latitudes of the sites
+        :param snap: if True, tests the nearest lattice point of each site, see snap
+        :return: a boolean array that is True for sites that are in this grid
+        """
+        if not snap:
+            return self._index_of(lons, lats) >= 0
+        return self._lookup(*self._snap_units(lons, lats)) >= 0
+
+    def _snap_units(self, lons: np.ndarray, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the quantized coordinates of the nearest lattice points, and a mask of the sites that could be snapped.
+        """
+        origin = self.origin
+        if origin is None:
+            raise ValueError("Can only snap to grids with a known step whose points are on a common lattice")
+        step = _step_units(self.step, self.precision)
+        scale = 10**self.precision
+        snapped = []
+        valid = True
+        for values, offset in zip((lons, lats), (int(round(value * scale)) for value in origin)):
+            units = np.floor((np.asarray(values, dtype=float) * scale - offset) / step + 0.5)
+            in_range = np.abs(units) < _COORDINATE_LIMIT
+            valid = valid & in_range
+            snapped.append(np.where(in_range, units, 0).astype(np.int64) * step + offset)
+        return snapped[0], snapped[1], valid
 
     def __iter__(self):
-        for p in sorted(self.points):
-            yield Point(p[0], p[1])
+        from shapely.geometry import Point
+
+        lons, lats = self._coordinates()
+        for lon, lat in zip(lons.tolist(), lats.tolist()):
+            yield Point(lon, lat)
 
     def __len__(self):
-        return len(self.points)
+        return len(self._keys)
 
-    def add_neighbours(self) -> 'Grid':
+    @instrument()
+    def add_neighbours(self, rings: int = 1, connectivity: int = 8) -> 'Grid':
         """
-        Ensures that each grid point is surrounded by 8 grid neighbours.
+        Ensures that each grid point is surrounded by grid neighbours.
+        Adding several rings gives the same result as calling add_neighbours once per ring. Neighbours are on the
+        lattice of the grid's precision, so points that are not on the lattice of the step keep their offset.
+        :param rings: the number of rings of neighbours to add
+        :param connectivity: 8 to add all surrounding points, 4 to only add the points above, below, left and right
         :return: the new grid
         """
-        points = set()
+        if connectivity not in (4, 8):
+            raise ValueError("connectivity must be 4 or 8")
+        if rings < 0:
+            raise ValueError("rings must not be negative")
+        if rings == 0 or not len(self):
+            return Grid._from_keys(self.step, self.precision, self._keys, self._columns)
 
-        def add_point(lat: float, lon: float) -> None:
-            points.add((round(lat, self.precision), round(lon, self.precision)))
+        step = _step_units(abs(self.step), self.precision)
+        x, y = _decode(self._keys)
+        keys = None
+        if _on_lattice(x, y, step):
+            columns = (x - x.min()) // step
+            rows = (y - y.min()) // step
+            cells = (int(columns.max()) + 1 + 2 * rings) * (int(rows.max()) + 1 + 2 * rings)
+            if cells <= _RASTER_DENSITY * len(x):
+                columns, rows = _dilate_raster(columns, rows, rings, connectivity)
+                keys = _encode(x.min() + columns * step, y.min() + rows * step)
+        if keys is None:
+            keys = _dilate_keys(self._keys, step, rings, connectivity)
 
-        def neighbours(lat: float, lon: float) -> None:
-            add_point(lat - self.step, lon + self.step)
-            add_point(lat - self.step, lon)
-            add_point(lat - self.step, lon - self.step)
+        attributes = _merge_columns(len(keys), [(np.searchsorted(keys, self._keys), self._columns)])
+        return Grid._from_keys(self.step, self.precision, keys, attributes)
 
-            add_point(lat, lon + self.step)
-            add_point(lat, lon)
-            add_point(lat, lon - self.step)
+    def _region_grid(self, gdf: 'GeoDataFrame') -> 'Grid':
+        """
+        Returns the points of this grid's lattice that are inside gdf. Only the lattice points in the bounding box of
+        gdf are tested. If the points of this grid are not on a lattice, this is Grid.for_polygon.
+        :param gdf: a GeoDataFrame of polygons
+        :return: the grid
+        """
+        step = _step_units(self.step, self.precision)
+        if self.origin is None or not len(gdf):
+            return Grid.for_polygon(self.step, gdf)
+        x0, y0 = (int(value[0] % step) for value in _decode(self._keys[:1])) if len(self) else (0, 0)
+        scale = 10**self.precision
+        min_x, min_y, max_x, max_y = gdf.total_bounds * scale
+        xs = np.arange(np.ceil((min_x - x0) / step), np.floor((max_x - x0) / step) + 1, dtype=np.int64) * step + x0
+        ys = np.arange(np.ceil((min_y - y0) / step), np.floor((max_y - y0) / step) + 1, dtype=np.int64) * step + y0
+        x, y = np.meshgrid(xs, ys, indexing='ij')
+        grid = Grid._from_keys(self.step, self.precision, _unique_sorted(_encode(x.ravel(), y.ravel())))
+        return grid.intersection(gdf)
 
-            add_point(lat + self.step, lon + self.step)
-            add_point(lat + self.step, lon)
-            add_point(lat + self.step, lon - self.step)
+    def _aligned_keys(self, other: 'Grid') -> Tuple[np.ndarray, np.ndarray, int]:
+        """
+        Returns the keys of this grid and the other grid at a common precision.
+        :param other: a grid
+        :return: this grid's keys, the other grid's keys and their common precision
+        """
+        precision = max(self.precision, other.precision)
+        return (
+            _rescale(self._keys, self.precision, precision),
+            _rescale(other._keys, other.precision, precision),
+            precision,
+        )
 
-        for point in self.points:
-            neighbours(point[0], point[1])
+    @instrument()
+    def union(self, other: Union['Grid', 'GeoDataFrame']) -> 'Grid':
+        """
+        Creates a grid that is the union of this grid and the other grid.
+        Points that have attributes in the other grid take all their attributes from the other grid.
+        If other is a GeoDataFrame, the points of this grid's lattice that are inside it are added.
+        :param other: a grid or a GeoDataFrame of polygons
+        :return: the new grid
+        """
+        if _is_instance(other, 'geopandas', 'GeoDataFrame'):
+            other = self._region_grid(other)
+        keys_a, keys_b, precision = self._aligned_keys(other)
+        keys = _unique_sorted(np.concatenate((keys_a, keys_b)))
+        columns = _merge_columns(
+            len(keys),
+            [(np.searchsorted(keys, keys_a), self._columns), (np.searchsorted(keys, keys_b), other._columns)],
+        )
+        return Grid._from_keys(self.step, precision, keys, columns)
 
-        return Grid(self.step, points, self.attributes)
+    @classmethod
+    @instrument()
+    def union_all(cls, grids: Sequence['Grid']) -> 'Grid':
+        """
+        Creates the union of many grids in one pass.
+        The result is the same as grids[0].union(grids[1]).union(grids[2])..., so a point that has attributes in
+        several grids takes all its attributes from the last of them.
+        The grids must have the same step and lattice origin.
+        :param grids: a sequence of grids
+        :return: the new grid
+        """
+        precision, keys = _compatible_keys(grids)
+        merged = _unique_sorted(np.concatenate(keys))
+        columns = _merge_columns(
+            len(merged), [(np.searchsorted(merged, k), grid._columns) for grid, k in zip(grids, keys)]
+        )
+        return Grid._from_keys(grids[0].step, precision, merged, columns)
 
-    def union(self, other: Union['Grid', GeoDataFrame]) -> 'Grid':
+    @classmethod
+    @instrument()
+    def intersect_all(cls, grids: Sequence['Grid']) -> 'Grid':
         """
-        Creates a grid that is the union of this grid and the other grid.
-        :param other: a grid
+        Creates the intersection of many grids in one pass.
+        The result is the same as grids[0].intersection(grids[1]).intersection(grids[2])..., so the attributes are
+        taken from the first grid.
+        The grids must have the same step and lattice origin.
+        :param grids: a sequence of grids
         :return: the new grid
         """
-        if isinstance(other, GeoDataFrame):
-            other = Grid.for_polygon(self.step, other)
-        return Grid(self.step, self.points.union(other.points), {**self.attributes, **other.attributes})
+        precision, keys = _compatible_keys(grids)
+        # the keys of each grid are unique, so a key that occurs once per grid is in all of them
+        merged = np.sort(np.concatenate(keys))
+        starts = np.flatnonzero(np.concatenate(([True], merged[1:] != merged[:-1])))
+        counts = np.diff(np.append(starts, len(merged)))
+        common = merged[starts[counts == len(grids)]]
+        return grids[0]._subset(_isin_sorted(keys[0], common))
 
-    def intersection(self, other: Union['Grid', GeoDataFrame]) -> 'Grid':
+    @instrument()
+    def intersection(self, other: Union['Grid', 'GeoDataFrame'], workers: int = 1) -> 'Grid':
         """
         Creates a grid that us the intersection of this grid and the other grid.
+        If other is a GeoDataFrame and the points are on a lattice, the region is usually rasterized on the lattice, see
+        mask.RegionMask, and only points close to its edges are tested exactly.
         :param other: a grid
+        :param workers: the number of processes used if other is a GeoDataFrame. They test the points close to the
+            edges of a rasterized region, which is only done once per process for a region and lattice, or else all
+            points, see clip.contains_mask.
         :return: the new grid
         """
-        if isinstance(other, GeoDataFrame):
-            return self.__clip(other, True)
-        return Grid(self.step, self.points.intersection(other.points), self.attributes)
+        if _is_instance(other, 'geopandas', 'GeoDataFrame'):
+            return self.__clip(other, True, workers)
+        keys_a, keys_b, _ = self._aligned_keys(other)
+        return self._subset(_isin_sorted(keys_a, keys_b))
 
-    def difference(self, other: Union['Grid', GeoDataFrame]) -> 'Grid':
+    @instrument()
+    def difference(self, other: Union['Grid', 'GeoDataFrame'], workers: int = 1) -> 'Grid':
         """
         Creates a grid that is the difference of this grid and the other grid.
         :param other: a grid
+        :param workers: the number of processes used if other is a GeoDataFrame, see Grid.intersection
         :return: the new grid
         """
-        if isinstance(other, GeoDataFrame):
-            return self.__clip(other, False)
-        return Grid(self.step, self.points.difference(other.points), self.attributes)
+        if _is_instance(other, 'geopandas', 'GeoDataFrame'):
+            return self.__clip(other, False, workers)
+        keys_a, keys_b, _ = self._aligned_keys(other)
+        return self._subset(~_isin_sorted(keys_a, keys_b))
 
-    def filter(self, fn: Callable[[Point], bool]) -> 'Grid':
+    def filter(self, fn: Callable[['Point'], bool]) -> 'Grid':
         """
         Only keeps the points for which fn(point) is True.
         :param fn: the filter function
         :return: the new grid
         """
-        return Grid(self.step, filter(fn, self), self.attributes)
+        return self._subset(np.fromiter((bool(fn(p)) for p in self), dtype=bool, count=len(self)))
+
+    @instrument()
+    def decimate(self, k: int) -> 'Grid':
+        """
+        Keeps every k-th lattice point in each direction, counted from the lattice origin. For example, decimating a
+        0.01 degree grid with k=5 gives its points on the 0.05 degree lattice.
+        :param k: the decimation factor
+        :return: a new grid with step k * step
+        """
+        if k < 1:
+            raise ValueError("k must be positive")
+        if self.origin is None:
+            raise ValueError("only grids with points on a lattice can be decimated")
+        step = _step_units(self.step, self.precision)
+        x, y = _decode(self._keys)
+        subset = self._subset((x // step % k == 0) & (y // step % k == 0))
+        return Grid._from_keys(round(self.step * k, self.precision), self.precision, subset._keys, subset._columns)
+
+    def snap_to_lattice(self, step: Optional[float] = None, origin: Optional[Tuple[float, float]] = None) -> 'Grid':
+        """
+        Moves the points to the nearest point of a lattice, like snap. Use this for grids loaded from CSV files, which
+        have step -1. Points that snap to the same lattice point are merged, keeping the attributes of the first.
+        :param step: the step of the lattice. By default the step of this grid or, if it has none, the most common
+            distance between neighbouring longitudes and latitudes of the points. Pass the step if the coordinates
+            are noisy, as the distances are then mostly noise.
+        :param origin: the lon/lat origin of the lattice, see Grid.origin. By default the most common origin of the
+            points.
+        :return: a new grid with the given or inferred step
+        """
+        step = step if step is not None else self.step if self.step > 0 else None
+        precision = max(self.precision, infer_precision(np.array([step]))) if step is not None else self.precision
+        x, y = _decode(_rescale(self._keys, self.precision, precision))
+        if step is not None:
+            units = _step_units(step, precision)
+        else:
+            units = _infer_step_units(x, y)
+            if not units:
+                raise ValueError("the lattice of a grid with less than two distinct coordinates can't be inferred")
+            step = round(units / 10**precision, precision)
+        if origin is None:
+            offsets = (_most_common(x % units), _most_common(y % units))
+        else:
+            offsets = (int(_quantize(origin[0], precision)), int(_quantize(origin[1], precision)))
+        # floor division rounds halfway points to the larger coordinate, like snap
+        x = (x - offsets[0] + units // 2) // units * units + offsets[0]
+        y = (y - offsets[1] + units // 2) // units * units + offsets[1]
+        keys, first = np.unique(_encode(x, y), return_index=True)
+        columns = {name: column.take(first) for name, column in self._columns.items()}
+        return Grid._from_keys(step, precision, keys, columns)
+
+    @instrument()
+    def delta(self, other: 'Grid', step: Optional[float] = None) -> GridDelta:
+        """
+        Compares this grid, the old grid, with other, the new grid, e.g. to only recompute the sites that changed.
+        If one of the grids has step -1, e.g. because it was loaded from a CSV file, it is snapped to the lattice of
+        the other grid. If both have step -1, both are snapped to the lattice inferred from all their points, see
+        snap_to_lattice.
+        :param other: the new grid
+        :param step: the step of the lattice that grids with step -1 are snapped to, instead of the step of the other
+            grid or the inferred step
+        :return: the added, removed, unchanged and changed points
+        """
+        old, new = _on_common_lattice(self, other, step)
+        keys_old, keys_new, precision = old._aligned_keys(new)
+        in_new = _isin_sorted(keys_old, keys_new)
+        in_old = _isin_sorted(keys_new, keys_old)
+        # the keys of both grids are sorted, so the common points are in the same order in both
+        common_old = np.flatnonzero(in_new)
+        common_new = np.flatnonzero(in_old)
+
+        changed = np.zeros(len(common_old), dtype=bool)
+        for name in {**old._columns, **new._columns}:
+            codes_old, categories_old = old._columns.get(name, AttributeColumn(np.full(len(old), -1), ()))
+            codes_new, categories_new = new._columns.get(name, AttributeColumn(np.full(len(new), -1), ()))
+            # the code of each old value in the new column, or a code that no new point has
+            recode = np.full(len(categories_old) + 1, -1, dtype=np.int64)
+            for i, value in enumerate(categories_old):
+                recode[i] = _category_code(categories_new, value)[0]
+            changed |= recode[codes_old[common_old]] != codes_new[common_new]
+
+        return GridDelta(
+            added=_to_lonlat(keys_new[~in_old], precision),
+            removed=_to_lonlat(keys_old[~in_new], precision),
+            unchanged=_to_lonlat(keys_old[common_old[~changed]], precision),
+            changed=_to_lonlat(keys_old[common_old[changed]], precision),
+        )
 
-    def __clip(self, gdf: GeoDataFrame, inside: bool) -> 'Grid':
+    def __clip(self, gdf: 'GeoDataFrame', inside: bool, workers: int = 1) -> 'Grid':
         """
         Returns a new Grid with all points of this Grid that are inside gdf
         Implementation of intersection
         :param gdf: a GeoDataFrame of polygons
+        :param workers: the number of processes to use, see Grid.intersection
         :return: the clipped Grid
         """
-        gs = gdf.geometry
+        mask = self._contains_mask(gdf, workers=workers)
+        return self._subset(mask if inside else ~mask)
 
-        def predicate(p: Point) -> bool:
-            for g in gs:
-                if g.contains(p):
-                    return inside
-            return not inside
+    @instrument()
+    def _contains_mask(self, gdf: 'GeoDataFrame', workers: int = 1) -> np.ndarray:
+        """
+        Tests which points are inside gdf, see clip.contains_mask.
+        If the points are on a lattice and the region is not much bigger than the grid, the region is rasterized on
+        the lattice, see mask.RegionMask, and only points close to its edges are tested exactly.
+        :param gdf: a GeoDataFrame of polygons
+        :param workers: the number of processes that test points exactly
+        :return: a boolean array that is True for points inside gdf
+        """
+        from nzshm_grid_loc.clip import contains_mask
+        from nzshm_grid_loc.mask import region_mask
 
-        return self.filter(predicate)
+        step = _step_units(self.step, self.precision)
+        if len(self) and self.origin is not None:
+            x, y = _decode(self._keys)
+            origin = (int(x[0] % step), int(y[0] % step))
+            mask = region_mask(
+                gdf, self.precision, step, origin, max_cells=_RASTER_DENSITY * len(self), workers=workers
+            )
+            if mask is not None:
+                return mask.contains(x, y)
+        return contains_mask(gdf, *self._coordinates(), workers=workers)
 
-    def annotate(self, name: str, value: Any, clip: GeoDataFrame = None) -> 'Grid':
+    @instrument()
+    def annotate(self, name: str, value: Any, clip: Optional['GeoDataFrame'] = None) -> 'Grid':
         """
         Adds an attribute with the specified name and value to each point.
         If clip is specified, only sets the attribute for points in the clip polygons.
@@ -171,25 +670,402 @@ class Grid:
         :param clip: optional clip polygons
         :return: a new grid with the new attribute
         """
-        ps = self if clip is None else self.intersection(clip)
-        attributes = dict(self.attributes)
-        for p in ps:
-            attrs = self.get_attributes(p)
-            attrs[name] = value
-            attributes[(p.x, p.y)] = attrs
-        return Grid(self.step, list(self), attributes)
+        mask = slice(None) if clip is None else self._contains_mask(clip)
+        column = self._columns.get(name, AttributeColumn(np.full(len(self), -1, dtype=np.int32), ()))
+        return Grid._from_keys(
+            self.step, self.precision, self._keys, {**self._columns, name: column.with_value(value, mask)}
+        )
+
+    def column(self, name: str, default: Any = None) -> np.ndarray:
+        """
+        Returns the values of an attribute for all points, in the same order as iterating over the grid.
+        :param name: the name of the attribute
+        :param default: the value for points where the attribute is not set
+        :return: an object array of values
+        """
+        if name not in self._columns:
+            return np.full(len(self), default, dtype=object)
+        return self._columns[name].values(default)
 
-    def get_attributes(self, point: Union[tuple, Point]):
+    def column_codes(self, name: str) -> AttributeColumn:
+        """
+        Returns an attribute for all points as category codes and categories, see AttributeColumn. Use this instead of
+        column() to process each distinct value once. The codes must not be modified.
+        :param name: the name of the attribute
+        :return: the attribute column, with all codes -1 if no point has the attribute
+        """
+        if name not in self._columns:
+            return AttributeColumn(np.full(len(self), -1, dtype=np.int32), ())
+        return self._columns[name]
+
+    def get_attributes(self, point: Union[tuple, 'Point']):
         """
         Returns a copy of a dictionary of all attributes for the specified point
         :param point: a point
         :return: a copy af the attributes dictionary
         """
-        if isinstance(point, Point):
+        if _is_instance(point, 'shapely.geometry', 'Point'):
             point = (point.x, point.y)
-        return dict(self.attributes.get(point, {}))
+        index = int(self._index_of([point[0]], [point[1]])[0])
+        if index < 0:
+            return {}
+        return {
+            name: column.categories[column.codes[index]]
+            for name, column in self._columns.items()
+            if column.codes[index] >= 0
+        }
+
+    def _columns_from_dict(self, attributes: dict) -> Dict[str, AttributeColumn]:
+        """
+        Converts a dictionary of point tuple to attribute dictionary into attribute columns.
+        """
+        points = list(attributes)
+        indices = self._index_of([p[0] for p in points], [p[1] for p in points]).tolist()
+        columns: Dict[str, AttributeColumn] = {}
+        for point, index in zip(points, indices):
+            if index < 0:
+                continue
+            for name, value in attributes[point].items():
+                column = columns.get(name, AttributeColumn(np.full(len(self), -1, dtype=np.int32), ()))
+                code, categories = _category_code(column.categories, value)
+                column.codes[index] = code
+                columns[name] = AttributeColumn(column.codes, categories)
+        return columns
+
+
+def _is_instance(value: Any, module: str, name: str) -> bool:
+    """
+    Tests if value is an instance of a class of an optional dependency without importing it. If the module has not been
+    imported, no instances of its classes can exist.
+    """
+    loaded = sys.modules.get(module)
+    return loaded is not None and isinstance(value, getattr(loaded, name))
 
 
 def get_precision(step: float) -> int:
     s = str(step)
     return len(s) - s.find('.') - 1
+
+
+def _step_precision(step: float) -> int:
+    """
+    Returns the number of decimal places of a step, at most MAX_PRECISION. Warns if the step has more.
+    """
+    if step <= 0:
+        return 0
+    # get_precision does not count the decimal places of steps in scientific notation, such as 1e-07
+    precision = max(get_precision(step), infer_precision(np.array([step]), MAX_PRECISION + 1))
+    if precision > MAX_PRECISION:
+        warnings.warn(f"the step {step} has more than {MAX_PRECISION} decimal places, grid points are rounded")
+        return MAX_PRECISION
+    return precision
+
+
+def infer_precision(values: np.ndarray, max_precision: int = MAX_PRECISION) -> int:
+    """
+    Returns the smallest number of decimal places that represents all values exactly.
+    Values that need more than max_precision decimal places will be rounded to max_precision.
+    :param values: an array of floats
+    :param max_precision: the maximum precision to return
+    :return: the precision
+    """
+    values = np.asarray(values, dtype=float)
+    for precision in range(max_precision):
+        scale = 10**precision
+        if np.array_equal(np.rint(values * scale) / scale, values):
+            return precision
+    return max_precision
+
+
+def _to_coordinate_array(points: Union[set, list, Iterable, np.ndarray]) -> np.ndarray:
+    """
+    Converts the supported point inputs of Grid into a float array of shape (n, 2) in (lon, lat) order.
+    """
+    if isinstance(points, np.ndarray):
+        return np.asarray(points, dtype=float).reshape(-1, 2)
+    if not points:
+        return np.empty((0, 2))
+    points = list(points)
+    if _is_instance(points[0], 'shapely.geometry', 'Point'):
+        return np.array([(p.x, p.y) for p in points], dtype=float)
+    elif isinstance(points[0], tuple):
+        return np.array(points, dtype=float)
+    else:
+        assert False
+
+
+def _warn_if_rounded(coordinates: np.ndarray, x: np.ndarray, y: np.ndarray, precision: int) -> None:
+    """
+    Warns if quantizing changed any coordinate by more than floating point noise.
+    """
+    scale = 10**precision
+    error = np.maximum(np.abs(x / scale - coordinates[:, 0]), np.abs(y / scale - coordinates[:, 1]))
+    rounded = np.flatnonzero(~(error <= _ROUNDING_TOLERANCE))
+    if len(rounded):
+        lon, lat = coordinates[rounded[0]].tolist()
+        warnings.warn(
+            f"{len(rounded)} grid points have more than {precision} decimal places and are rounded, e.g. ({lon}, {lat})"
+        )
+
+
+def _quantize(values: np.ndarray, precision: int) -> np.ndarray:
+    """
+    Converts degrees into an integer number of 10^-precision degrees.
+    """
+    return np.rint(np.asarray(values, dtype=float) * 10**precision).astype(np.int64)
+
+
+def _encode(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Packs quantized lon and lat values into keys that sort in (lon, lat) order.
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    if x.size and max(np.abs(x).max(), np.abs(y).max()) >= _COORDINATE_LIMIT:
+        raise ValueError("Grid coordinates are out of range for the lattice precision")
+    return (x << 32) | (y + _Y_OFFSET)
+
+
+def _decode(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Unpacks keys into quantized lon and lat values.
+    """
+    return keys >> 32, (keys & _Y_MASK) - _Y_OFFSET
+
+
+def _rescale(keys: np.ndarray, precision: int, new_precision: int) -> np.ndarray:
+    """
+    Converts keys from one lattice precision to another. Only converts to coarser lattices if the points are on it.
+    """
+    if precision == new_precision:
+        return keys
+    x, y = _decode(keys)
+    if new_precision > precision:
+        factor = 10 ** (new_precision - precision)
+        return _encode(x * factor, y * factor)
+    factor = 10 ** (precision - new_precision)
+    return _encode(x // factor, y // factor)
+
+
+def _step_units(step: float, precision: int) -> int:
+    """
+    Returns the step as an integer number of 10^-precision degrees, or 0 if the step is unknown.
+    """
+    return int(np.rint(step * 10**precision)) if step > 0 else 0
+
+
+def _on_lattice(x: np.ndarray, y: np.ndarray, step: int) -> bool:
+    """
+    Returns True if all quantized points are on a common lattice with the given spacing.
+    """
+    if step <= 0:
+        return False
+    rx = x % step
+    ry = y % step
+    return bool(np.all(rx == rx[0]) and np.all(ry == ry[0]))
+
+
+def _neighbour_offsets(connectivity: int) -> list:
+    if connectivity == 4:
+        return [(-1, 0), (1, 0), (0, -1), (0, 1)]
+    return [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+
+
+def _dilate_raster(
+    columns: np.ndarray, rows: np.ndarray, rings: int, connectivity: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Dilates lattice cells on a boolean occupancy raster.
+    :param columns: the zero based column index of each cell
+    :param rows: the zero based row index of each cell
+    :param rings: the number of rings to add
+    :param connectivity: 4 or 8
+    :return: the column and row indices of the dilated cells in (column, row) order, offset by -rings
+    """
+    raster = np.zeros((int(columns.max()) + 1 + 2 * rings, int(rows.max()) + 1 + 2 * rings), dtype=bool)
+    raster[columns + rings, rows + rings] = True
+
+    if connectivity == 8:
+        # a square structuring element is separable, so all rings are added with one pass along each axis
+        for axis in (0, 1):
+            dilated = raster.copy()
+            for shift in range(1, rings + 1):
+                _or_shifted(dilated, raster, shift, axis)
+            raster = dilated
+    else:
+        for _ in range(rings):
+            dilated = raster.copy()
+            for axis in (0, 1):
+                _or_shifted(dilated, raster, 1, axis)
+            raster = dilated
+
+    columns, rows = np.nonzero(raster)
+    return columns - rings, rows - rings
+
+
+def _or_shifted(target: np.ndarray, source: np.ndarray, shift: int, axis: int) -> None:
+    """
+    ORs source shifted by +shift and -shift along axis into target.
+    """
+    if axis == 0:
+        target[shift:] |= source[:-shift]
+        target[:-shift] |= source[shift:]
+    else:
+        target[:, shift:] |= source[:, :-shift]
+        target[:, :-shift] |= source[:, shift:]
+
+
+def _dilate_keys(keys: np.ndarray, step: int, rings: int, connectivity: int) -> np.ndarray:
+    """
+    Dilates a sorted key array one ring at a time. Only the points added by the previous ring can have missing
+    neighbours, so only those are expanded.
+    """
+    offsets = _neighbour_offsets(connectivity)
+    frontier = keys
+    for _ in range(rings):
+        x, y = _decode(frontier)
+        candidates = _unique_sorted(np.concatenate([_encode(x + dx * step, y + dy * step) for dx, dy in offsets]))
+        frontier = candidates[~_isin_sorted(candidates, keys)]
+        keys = _unique_sorted(np.concatenate((keys, frontier)))
+    return keys
+
+
+def _unique_sorted(keys: np.ndarray) -> np.ndarray:
+    """
+    Sorts keys and removes duplicates.
+    """
+    keys = np.sort(keys)
+    if len(keys) < 2:
+        return keys
+    keep = np.empty(len(keys), dtype=bool)
+    keep[0] = True
+    np.not_equal(keys[1:], keys[:-1], out=keep[1:])
+    return keys[keep]
+
+
+def _compatible_keys(grids: Sequence[Grid]) -> Tuple[int, List[np.ndarray]]:
+    """
+    Checks that grids have the same step and lattice origin, and returns their keys at a common precision.
+    Grids without points are compatible with any grid.
+    :param grids: a sequence of grids
+    :return: the common precision and the keys of each grid
+    """
+    if not len(grids):
+        raise ValueError("at least one grid is required")
+    step = grids[0].step
+    precision = max(grid.precision for grid in grids)
+    origins = set()
+    for grid in grids:
+        if grid.step != step:
+            raise ValueError(f"grids have different steps: {step} and {grid.step}")
+        if step > 0 and len(grid):
+            if grid.origin is None:
+                raise ValueError("grid points are not on a lattice with the grid step")
+            origins.add(tuple(round(value, precision) for value in grid.origin))
+    if len(origins) > 1:
+        raise ValueError(f"grids have different lattice origins: {sorted(origins)}")
+    return precision, [_rescale(grid._keys, grid.precision, precision) for grid in grids]
+
+
+def _positions(keys: np.ndarray, sorted_keys: np.ndarray) -> np.ndarray:
+    """
+    Returns the index of each key in sorted_keys, or -1 for keys that are not in sorted_keys.
+    """
+    if not len(sorted_keys):
+        return np.full(len(keys), -1, dtype=np.int64)
+    index = np.searchsorted(sorted_keys, keys)
+    index[index == len(sorted_keys)] = 0
+    index[sorted_keys[index] != keys] = -1
+    return index
+
+
+def _category_code(categories: tuple, value: Any) -> Tuple[int, tuple]:
+    """
+    Returns the index of value in categories, adding value to the categories if needed.
+    Values of different types are different categories, even if they compare equal.
+    """
+    for i, category in enumerate(categories):
+        if type(category) is type(value) and category == value:
+            return i, categories
+    return len(categories), categories + (value,)
+
+
+def _merge_columns(size: int, parts: List[Tuple[np.ndarray, Dict[str, AttributeColumn]]]) -> Dict[str, AttributeColumn]:
+    """
+    Merges the attribute columns of several grids into the columns of a grid with size points.
+    Parts are applied in order: a point that has any attribute in a part takes all its attributes from that part, the
+    same as merging per point attribute dictionaries with {**a, **b}.
+    :param size: the number of points of the new grid
+    :param parts: the index of each point of a grid in the new grid, and the attribute columns of that grid
+    :return: the merged columns
+    """
+    source = np.full(size, -1, dtype=np.int64)
+    for part, (positions, columns) in enumerate(parts):
+        if columns:
+            has_attributes = np.logical_or.reduce([column.codes >= 0 for column in columns.values()])
+            source[positions[has_attributes]] = part
+
+    merged: Dict[str, AttributeColumn] = {}
+    for part, (positions, columns) in enumerate(parts):
+        selected = source[positions] == part
+        for name, column in columns.items():
+            target = merged.get(name, AttributeColumn(np.full(size, -1, dtype=np.int32), ()))
+            categories = target.categories
+            recode = np.full(len(column.categories) + 1, -1, dtype=np.int32)
+            for i, value in enumerate(column.categories):
+                recode[i], categories = _category_code(categories, value)
+            target.codes[positions[selected]] = recode[column.codes[selected]]
+            merged[name] = AttributeColumn(target.codes, categories)
+    return merged
+
+
+def _to_lonlat(keys: np.ndarray, precision: int) -> np.ndarray:
+    """
+    Decodes keys into an array of shape (n, 2) with lon/lat rows.
+    """
+    x, y = _decode(keys)
+    return np.stack((x, y), axis=1) / 10**precision
+
+
+def _infer_step_units(x: np.ndarray, y: np.ndarray) -> int:
+    """
+    Returns the most common distance between neighbouring distinct coordinates, or 0 if there is none.
+    """
+    distances = np.concatenate((np.diff(np.unique(x)), np.diff(np.unique(y))))
+    return _most_common(distances) if len(distances) else 0
+
+
+def _most_common(values: np.ndarray) -> int:
+    distinct, counts = np.unique(values, return_counts=True)
+    return int(distinct[np.argmax(counts)]) if len(distinct) else 0
+
+
+def _on_common_lattice(a: Grid, b: Grid, step: Optional[float]) -> Tuple[Grid, Grid]:
+    """
+    Snaps grids with step -1 to the lattice of the other grid, or to a lattice inferred from the points of both.
+    Grids with a step are returned as they are.
+    """
+    if a.step > 0 and b.step > 0:
+        return a, b
+    reference = a if a.step > 0 else b if b.step > 0 else None
+    if step is None and reference is not None and reference.origin is not None:
+        step, origin = reference.step, reference.origin
+    else:
+        union = a.union(b)
+        if step is None and not _infer_step_units(*_decode(union._keys)):
+            # too few points to infer a lattice, they are compared as they are
+            return a, b
+        lattice = union.snap_to_lattice(step)
+        step, origin = lattice.step, lattice.origin
+    return tuple(grid if grid.step > 0 else grid.snap_to_lattice(step, origin) for grid in (a, b))
+
+
+def _isin_sorted(keys: np.ndarray, sorted_keys: np.ndarray) -> np.ndarray:
+    """
+    Returns a boolean mask of which keys are in sorted_keys.
+    """
+    if not len(sorted_keys):
+        return np.zeros(len(keys), dtype=bool)
+    index = np.searchsorted(sorted_keys, keys)
+    index[index == len(sorted_keys)] = 0
+    return sorted_keys[index] == keys
@@ -1,46 +1,86 @@
+import base64
 import csv
+import hashlib
 import io
+import json
+import lzma
+import os
+import struct
+import tempfile
 import zipfile
-from typing import Tuple, Union
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Optional, Tuple, Union
 
-import geopandas
-import pandas
-from geopandas import GeoDataFrame
-from nzshm_common.util import compress_string, decompress_string
-from shapely import wkt
-from shapely.geometry import Point
+import numpy as np
 
-from nzshm_grid_loc.grid import Grid, get_precision
+from nzshm_grid_loc.grid import AttributeColumn, Grid, GridDelta, _decode, _encode, _step_units, get_precision
+from nzshm_grid_loc.profiling import instrument
 
+# grid files only need NumPy, geopandas, pandas and shapely are imported by the polygon file functions that use them
+if TYPE_CHECKING:
+    from geopandas import GeoDataFrame
 
+GRID_FILE_EXTENSION = '.nzgrid'
+
+# binary grid files start with the magic bytes, the format version and the length of the JSON header
+_GRID_FILE_MAGIC = b'NZSHMGRD'
+_GRID_FILE_PREAMBLE = struct.Struct('<8sII')
+_GRID_FILE_VERSION = 1
+_GRID_FILE_ALIGNMENT = 64
+# the key of the type tag of attribute values that are not JSON types
+_CATEGORY_TYPE = '__type__'
+
+# the changes of grid delta files, in the order they are written
+_DELTA_CHANGES = ("removed", "changed", "added", "unchanged")
+
+# polygon files that get a GeoParquet sidecar, and the extension of the sidecar file
+_SIDECAR_SOURCES = ('.wkt.csv', '.wkt.csv.zip', '.geojson')
+SIDECAR_EXTENSION = '.parquet'
+_SIDECAR_METADATA_KEY = b'nzshm_grid_loc'
+
+# base64 embedded grids start with the magic bytes and the format version, followed by the LZMA compressed header and
+# point deltas. Older embedded grids are zip files.
+_EMBEDDED_MAGIC = b'NZGB'
+_EMBEDDED_VERSION = 1
+# mode, lat_first, precision, delta size, step, x0, y0, rows, step units, count
+_EMBEDDED_HEADER = struct.Struct('<BBBBdqqqqQ')
+_EMBEDDED_LATTICE = 0
+_EMBEDDED_KEYS = 1
+
+
+@instrument()
 def load_grid(file_name: str, lat_first=False) -> Grid:
     """
-    Loads a grid from a CSV file.
-    It is assumed there are not headers, and that the first two columns are the lat/lon values.
-    :param file_name: a path to a CSV file
-    :param lat_first: if true, it is assumed that the order is (lat, lon), otherwise (lon, lat)
+    Loads a grid from a CSV file or, if the file name ends with GRID_FILE_EXTENSION, from a binary grid file.
+    It is assumed CSV files have no headers, and that the first two columns are the lat/lon values.
+    Coordinates are stored with at most MAX_PRECISION (6) decimal places, coordinates with more are rounded with a
+    warning, so writing the grid again does not reproduce them.
+    :param file_name: a path to a CSV file or binary grid file
+    :param lat_first: if true, it is assumed that the order is (lat, lon), otherwise (lon, lat).
+        Ignored for binary files.
     :return: a Grid object
     """
-    points = []
+    if str(file_name).endswith(GRID_FILE_EXTENSION):
+        return load_binary_grid(file_name)
     with open(file_name, 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        if lat_first:
-            for row in reader:
-                points.append(Point(float(row[1]), float(row[0])))
-        else:
-            for row in reader:
-                points.append(Point(float(row[0]), float(row[1])))
+        rows = [(float(row[0]), float(row[1])) for row in csv.reader(csvfile)]
+    points = np.array(rows, dtype=float).reshape(-1, 2)
+    if lat_first:
+        points = points[:, ::-1]
     return Grid(-1, points)
 
 
+@instrument()
 def write_grid(grid: Grid, file_name: str, lat_first=False) -> None:
     """
-    Writes a grid to a CSV file.
+    Writes a grid to a CSV file or, if the file name ends with GRID_FILE_EXTENSION, to a binary grid file.
     :param grid: a grid object
     :param file_name: the file name
-    :param lat_first: if true, written as (lat, lon), otherwise (lon,lat)
+    :param lat_first: if true, written as (lat, lon), otherwise (lon,lat). Ignored for binary files.
     :return: None
     """
+    if str(file_name).endswith(GRID_FILE_EXTENSION):
+        write_binary_grid(grid, file_name)
+        return
     with open(file_name, 'w') as out:
         write_grid_to_file(grid, out, lat_first=lat_first)
 
@@ -53,56 +93,349 @@ def write_grid_to_file(grid: Grid, out, lat_first=False) -> None:
     :param lat_first: if true, written as (lat, lon), otherwise (lon,lat)
     :return: None
     """
-    writer = csv.writer(out)
-    for point in grid:
-        if lat_first:
-            writer.writerow([point.y, point.x])
-        else:
-            writer.writerow([point.x, point.y])
+    columns = ("lat", "lon") if lat_first else ("lon", "lat")
+    _write_csv_columns(out, [_csv_column(grid, col, None) for col in columns])
 
 
-def write_attr_grid(grid: Grid, file_name: str, columns=("lat", "lon")) -> None:
+@instrument()
+def write_grid_tiles(tiles: Iterable[Grid], file_name: str, lat_first=False) -> int:
     """
-    Writes a grid to a CSV file.
-    :param columns:
-    :param grid: a grid object
+    Writes grid tiles to a CSV file as they are generated, without holding the whole grid in memory.
+    The rows are grouped by tile, and sorted within each tile.
+    :param tiles: an iterable of grids, e.g. from tiling.iter_tiles
     :param file_name: the file name
     :param lat_first: if true, written as (lat, lon), otherwise (lon,lat)
-    :return: None
+    :return: the number of points written
     """
+    count = 0
     with open(file_name, 'w') as out:
-        write_attr_grid_to_file(grid, out, columns=columns)
+        for tile in tiles:
+            write_grid_to_file(tile, out, lat_first=lat_first)
+            count += len(tile)
+    return count
+
+
+@instrument()
+def write_grid_delta(delta: GridDelta, file_name: str, unchanged: bool = False) -> int:
+    """
+    Writes a GridDelta to a CSV file with a header and the columns change, lon and lat. change is "removed", "changed",
+    "added" or "unchanged", and the rows are in that order.
+    :param delta: the delta, see Grid.delta
+    :param file_name: the file name
+    :param unchanged: whether to also write the unchanged points
+    :return: the number of points written
+    """
+    changes = [change for change in _DELTA_CHANGES if unchanged or change != "unchanged"]
+    arrays = [getattr(delta, change) for change in changes]
+    lonlat = np.concatenate(arrays) if arrays else np.empty((0, 2))
+    labels = np.repeat(np.array(changes, dtype=object), [len(array) for array in arrays])
+    with open(file_name, 'w') as out:
+        csv.writer(out).writerow(("change", "lon", "lat"))
+        _write_csv_columns(out, [labels] + [_csv_float_column(lonlat[:, i], None) for i in (0, 1)])
+    return len(lonlat)
+
+
+def load_grid_delta(file_name: str) -> GridDelta:
+    """
+    Loads a GridDelta from a CSV file written by write_grid_delta. If the unchanged points were not written, the
+    unchanged array is empty.
+    :param file_name: the file name
+    :return: the delta
+    """
+    with open(file_name, 'r') as csvfile:
+        reader = csv.reader(csvfile)
+        if next(reader, None) != ["change", "lon", "lat"]:
+            raise ValueError(f"{file_name} is not a grid delta file")
+        rows = {change: [] for change in _DELTA_CHANGES}
+        for change, lon, lat in reader:
+            rows[change].append((float(lon), float(lat)))
+    return GridDelta(**{change: np.array(rows[change], dtype=float).reshape(-1, 2) for change in _DELTA_CHANGES})
+
+
+@instrument()
+def write_binary_grid(grid: Grid, file_name: str) -> None:
+    """
+    Writes a grid to a binary grid file that load_binary_grid can memory-map.
+    The file has a JSON header with the step, origin and precision of the grid, followed by the sorted int64 lattice
+    keys of the points and one int32 column of category codes per attribute.
+    Attribute values must be JSON types, tuples, dicts or NumPy scalars. Tuples and NumPy scalars are tagged with
+    their type in the header, so that they are loaded with the same type.
+    :param grid: a grid object
+    :param file_name: the file name
+    :return: None
+    """
+    keys = np.ascontiguousarray(grid._keys, dtype='<i8')
+    columns = {name: grid.column_codes(name) for name in grid.attribute_names}
+
+    header: Dict[str, Any] = {
+        'step': grid.step,
+        'precision': grid.precision,
+        'origin': grid.origin,
+        'count': len(keys),
+        'columns': [
+            {'name': name, 'categories': [_encode_category(category) for category in column.categories]}
+            for name, column in columns.items()
+        ],
+    }
+    # the offsets depend on the header length, so the header is encoded with room for them first
+    offset_width = 20
+    header['keys_offset'] = 0
+    for column in header['columns']:
+        column['offset'] = 0
+    header_length = len(json.dumps(header).encode()) + offset_width * (1 + len(columns))
+    offset = _align(_GRID_FILE_PREAMBLE.size + header_length)
+
+    header['keys_offset'] = offset
+    offset += keys.nbytes
+    for column in header['columns']:
+        offset = _align(offset)
+        column['offset'] = offset
+        offset += 4 * len(keys)
+    encoded = json.dumps(header).encode().ljust(header_length)
+
+    with open(file_name, 'wb') as out:
+        out.write(_GRID_FILE_PREAMBLE.pack(_GRID_FILE_MAGIC, _GRID_FILE_VERSION, header_length))
+        out.write(encoded)
+        _write_at(out, header['keys_offset'], keys)
+        for column in header['columns']:
+            _write_at(out, column['offset'], columns[column['name']].codes.astype('<i4'))
 
 
-def write_attr_grid_to_file(grid: Grid, out, columns=("lat", "lon")) -> None:
+@instrument()
+def load_binary_grid(file_name: str) -> Grid:
+    """
+    Loads a grid written by write_binary_grid. The lattice keys are memory-mapped, not read into memory.
+    :param file_name: the file name
+    :return: a Grid object
+    """
+    with open(file_name, 'rb') as f:
+        magic, version, header_length = _GRID_FILE_PREAMBLE.unpack(f.read(_GRID_FILE_PREAMBLE.size))
+        if magic != _GRID_FILE_MAGIC:
+            raise ValueError(f"{file_name} is not a binary grid file")
+        if version != _GRID_FILE_VERSION:
+            raise ValueError(f"unsupported binary grid file version {version}")
+        header = json.loads(f.read(header_length))
+
+    count = header['count']
+    keys = _map_array(file_name, '<i8', header['keys_offset'], count)
+    columns = {
+        column['name']: AttributeColumn(
+            _map_array(file_name, '<i4', column['offset'], count),
+            tuple(_decode_category(category) for category in column['categories']),
+        )
+        for column in header['columns']
+    }
+    return Grid._from_keys(header['step'], header['precision'], keys, columns)
+
+
+def _map_array(file_name: str, dtype: str, offset: int, count: int) -> np.ndarray:
+    if not count:
+        # numpy can't memory-map empty arrays
+        return np.empty(0, dtype=dtype)
+    return np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+
+def _align(offset: int) -> int:
+    return -(-offset // _GRID_FILE_ALIGNMENT) * _GRID_FILE_ALIGNMENT
+
+
+def _write_at(out, offset: int, data: np.ndarray) -> None:
+    out.write(b'\0' * (offset - out.tell()))
+    out.write(data.tobytes())
+
+
+def _encode_category(value: Any) -> Any:
+    """
+    Returns a JSON value for an attribute value. Tuples, dicts and NumPy scalars become objects with a type tag.
+    """
+    if isinstance(value, np.generic) and value.dtype.kind in 'biufU':
+        # before the JSON types, NumPy float64 and str_ values are also floats and strings
+        return {_CATEGORY_TYPE: 'numpy', 'dtype': value.dtype.str, 'value': value.item()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [_encode_category(item) for item in value]
+    if isinstance(value, tuple):
+        return {_CATEGORY_TYPE: 'tuple', 'items': [_encode_category(item) for item in value]}
+    if isinstance(value, dict) and all(isinstance(key, str) for key in value):
+        return {_CATEGORY_TYPE: 'dict', 'items': {key: _encode_category(item) for key, item in value.items()}}
+    raise TypeError(f"attribute values of type {type(value).__name__} can't be written to a binary grid file")
+
+
+def _decode_category(value: Any) -> Any:
+    """
+    Returns the attribute value of a JSON value written by _encode_category.
+    """
+    if isinstance(value, list):
+        return [_decode_category(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if value[_CATEGORY_TYPE] == 'tuple':
+        return tuple(_decode_category(item) for item in value['items'])
+    if value[_CATEGORY_TYPE] == 'dict':
+        return {key: _decode_category(item) for key, item in value['items'].items()}
+    return np.dtype(value['dtype']).type(value['value'])
+
+
+@instrument()
+def write_attr_grid(
+    grid: Grid, file_name: str, columns=("lat", "lon"), format: str = "csv", float_precision: Optional[int] = None
+) -> None:
+    """
+    Writes a grid with attributes to a CSV or Parquet file.
+    :param grid: a grid object
+    :param file_name: the file name
+    :param columns: a list of column headers. Will also be used to look up any attributes
+    :param format: "csv" or "parquet". Parquet files need pyarrow to be installed.
+    :param float_precision: the number of decimal places of floats in CSV files. If None, floats are written the
+        same way as csv.writer writes them.
+    :return: None
+    """
+    if format == "parquet":
+        write_attr_grid_to_parquet(grid, file_name, columns=columns)
+    elif format == "csv":
+        with open(file_name, 'w') as out:
+            write_attr_grid_to_file(grid, out, columns=columns, float_precision=float_precision)
+    else:
+        raise ValueError(f"unsupported format {format}")
+
+
+def write_attr_grid_to_file(grid: Grid, out, columns=("lat", "lon"), float_precision: Optional[int] = None) -> None:
     """
     Writes a grid to a CSV file.
     :param grid: a grid object
     :param out: a file name or a file
     :param columns: a list of column headers. Will also be used to look up any attributes
+    :param float_precision: the number of decimal places of floats. If None, floats are written the same way as
+        csv.writer writes them.
+    :return: None
+    """
+    csv.writer(out).writerow(columns)
+    _write_csv_columns(out, [_csv_column(grid, col, float_precision) for col in columns])
+
+
+def write_attr_grid_to_parquet(grid: Grid, file_name: str, columns=("lat", "lon")) -> None:
+    """
+    Writes a grid to a Parquet file. Attributes are stored as dictionary encoded columns, points without the attribute
+    are null. Requires pyarrow.
+    :param grid: a grid object
+    :param file_name: the file name
+    :param columns: a list of column names. Will also be used to look up any attributes
     :return: None
     """
-    writer = csv.writer(out)
-    writer.writerow(columns)
-    for point in grid:
-        row = []
-        attrs = grid.get_attributes(point)
-        for col in columns:
-            if col == "lat" or col == "latitude":
-                row.append(point.y)
-            elif col == "lon" or col == "longitude":
-                row.append(point.x)
-            else:
-                row.append(attrs.get(col, ""))
-        writer.writerow(row)
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("writing Parquet files requires pyarrow") from e
+
+    lons, lats = grid.to_numpy().T
+    arrays = []
+    for col in columns:
+        if col in _LAT_COLUMNS:
+            arrays.append(pyarrow.array(lats))
+        elif col in _LON_COLUMNS:
+            arrays.append(pyarrow.array(lons))
+        elif col in grid.attribute_names:
+            codes, categories = grid.column_codes(col)
+            try:
+                dictionary = pyarrow.array(categories)
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                dictionary = pyarrow.array([str(category) for category in categories])
+            indices = pyarrow.array(np.maximum(codes, 0).astype(np.int32), mask=np.asarray(codes) < 0)
+            arrays.append(pyarrow.DictionaryArray.from_arrays(indices, dictionary))
+        else:
+            arrays.append(pyarrow.nulls(len(grid)))
+    pyarrow.parquet.write_table(pyarrow.table(arrays, names=list(columns)), file_name)
+
+
+_LAT_COLUMNS = ("lat", "latitude")
+_LON_COLUMNS = ("lon", "longitude")
+
+# the number of CSV rows that are joined into a string before writing
+_CSV_CHUNK_SIZE = 1 << 16
+
+
+def _csv_column(grid: Grid, col: str, float_precision: Optional[int]) -> np.ndarray:
+    """
+    Returns the CSV encoded fields of a column as an object array of strings.
+    Each distinct value is only formatted once.
+    """
+    lons, lats = grid.to_numpy().T
+    if col in _LAT_COLUMNS or col in _LON_COLUMNS:
+        return _csv_float_column(lats if col in _LAT_COLUMNS else lons, float_precision)
+    if col not in grid.attribute_names:
+        return np.full(len(grid), "", dtype=object)
+    codes, categories = grid.column_codes(col)
+    fields = [_csv_field(category, float_precision) for category in categories] + [""]
+    return np.array(fields, dtype=object)[codes]
+
+
+def _csv_float_column(values: np.ndarray, float_precision: Optional[int]) -> np.ndarray:
+    """
+    Returns the CSV encoded fields of a float array as an object array of strings.
+    """
+    distinct, inverse = _unique_inverse(values)
+    fields = [_csv_field(value, float_precision) for value in distinct.tolist()]
+    return np.array(fields, dtype=object)[inverse]
+
+
+def _csv_field(value: Any, float_precision: Optional[int]) -> str:
+    """
+    Encodes a single value the same way csv.writer does, including quoting.
+    """
+    if float_precision is not None and isinstance(value, float):
+        value = f"{value:.{float_precision}f}"
+    line = io.StringIO()
+    # a leading empty field, so that an empty value isn't quoted the way csv.writer quotes empty rows
+    csv.writer(line).writerow(["", value])
+    return line.getvalue()[1 : -len(csv.excel.lineterminator)]
 
 
-def load_polygon_file(file_name: str) -> GeoDataFrame:
+def _write_csv_columns(out, columns: list) -> None:
+    """
+    Joins columns of encoded CSV fields into rows and writes them in chunks.
+    """
+    if not columns or not len(columns[0]):
+        return
+    terminator = csv.excel.lineterminator
+    for start in range(0, len(columns[0]), _CSV_CHUNK_SIZE):
+        rows = columns[0][start : start + _CSV_CHUNK_SIZE]
+        for column in columns[1:]:
+            rows = rows + "," + column[start : start + _CSV_CHUNK_SIZE]
+        if len(columns) == 1:
+            # csv.writer quotes rows that consist of a single empty field
+            rows = np.where(rows == "", '""', rows)
+        out.write(terminator.join(rows.tolist()) + terminator)
+
+
+def _unique_inverse(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the distinct values and the index of each value in them.
+    """
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    starts = np.empty(len(values), dtype=bool)
+    starts[:1] = True
+    np.not_equal(sorted_values[1:], sorted_values[:-1], out=starts[1:])
+    inverse = np.empty(len(values), dtype=np.int64)
+    inverse[order] = np.cumsum(starts) - 1
+    return sorted_values[starts], inverse
+
+
+@instrument()
+def load_polygon_file(file_name: str, sidecar: bool = False) -> 'GeoDataFrame':
     """
     Loads a polygon file into a GeodataFrame. Can load everything that geopandas can read plus .wkt.csv and .wkt.csv.zip
     :param file_name: path to a geometry file
+    :param sidecar: if True, .wkt.csv(.zip) and .geojson files are read from a GeoParquet sidecar file, which is
+        written to the 'regions' folder of the grid cache directory the first time the file is loaded, and used as long
+        as the file does not change. Requires pyarrow, without it the file is always parsed.
     :return: a GeoDataFrame
     """
+    if sidecar and file_name.endswith(_SIDECAR_SOURCES):
+        return _load_with_sidecar(file_name)
+
     file: Union[str, io.BytesIO] = file_name
     if file_name.endswith('.zip'):
         file_name, file = load_zip(file_name)
@@ -110,9 +443,113 @@ def load_polygon_file(file_name: str) -> GeoDataFrame:
     if file_name.endswith(".wkt.csv"):
         return load_wkt_csv(file)
     else:
+        import geopandas
+
         return geopandas.read_file(file)
 
 
+def _load_with_sidecar(file_name: str) -> 'GeoDataFrame':
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return load_polygon_file(file_name)
+
+    stat = os.stat(file_name)
+    digest = None
+    try:
+        table = pyarrow.parquet.read_table(_sidecar_path(file_name))
+        source = json.loads((table.schema.metadata or {})[_SIDECAR_METADATA_KEY])
+    except (OSError, KeyError, ValueError, pyarrow.ArrowException):
+        source = None
+    if source is not None and source['size'] == stat.st_size:
+        if source['mtime_ns'] == stat.st_mtime_ns:
+            return _table_to_gdf(table, source['crs'])
+        # the file was touched, for example by a checkout, but may still be the same
+        digest = _sha256(file_name)
+        if source['sha256'] == digest:
+            gdf = _table_to_gdf(table, source['crs'])
+            _write_sidecar(gdf, file_name, stat, digest)
+            return gdf
+
+    gdf = load_polygon_file(file_name)
+    _write_sidecar(gdf, file_name, stat, digest or _sha256(file_name))
+    return gdf
+
+
+def _sidecar_path(file_name: str) -> str:
+    """
+    Returns the sidecar path of a polygon file in the cache directory, named after the hash of the file's real path.
+    The sidecar is never written next to the file, which may be part of an installed package.
+    """
+    from nzshm_grid_loc.cache import default_cache_dir
+
+    name = hashlib.sha256(os.path.realpath(file_name).encode()).hexdigest() + SIDECAR_EXTENSION
+    return str(default_cache_dir() / 'regions' / name)
+
+
+def _write_sidecar(gdf: 'GeoDataFrame', file_name: str, stat: os.stat_result, digest: str) -> None:
+    import pandas
+    import pyarrow
+    import pyarrow.parquet
+    from shapely import to_wkb
+
+    crs = gdf.crs.to_string() if gdf.crs is not None else None
+    df = pandas.DataFrame(gdf, copy=False)
+    df[gdf.geometry.name] = to_wkb(gdf.geometry.values)
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    geo = {
+        'version': '1.0.0',
+        'primary_column': gdf.geometry.name,
+        'columns': {
+            gdf.geometry.name: {
+                'encoding': 'WKB',
+                'geometry_types': [],
+                'crs': gdf.crs.to_json_dict() if gdf.crs is not None else None,
+            }
+        },
+    }
+    source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest, 'crs': crs}
+    table = table.replace_schema_metadata(
+        {
+            **(table.schema.metadata or {}),
+            b'geo': json.dumps(geo).encode(),
+            _SIDECAR_METADATA_KEY: json.dumps(source).encode(),
+        }
+    )
+
+    path = _sidecar_path(file_name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so that other processes never read a partly written sidecar
+        handle, temp_name = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(handle)
+    except OSError:
+        return
+    try:
+        pyarrow.parquet.write_table(table, temp_name)
+        os.replace(temp_name, path)
+    except OSError:
+        pass
+    finally:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+
+
+def _table_to_gdf(table, crs: Optional[str]) -> 'GeoDataFrame':
+    from geopandas import GeoDataFrame
+    from shapely import from_wkb
+
+    geometry_column = json.loads(table.schema.metadata[b'geo'])['primary_column']
+    df = table.to_pandas()
+    df[geometry_column] = from_wkb(df[geometry_column].to_numpy())
+    return GeoDataFrame(df, geometry=geometry_column, crs=crs)
+
+
+def _sha256(file_name: str) -> str:
+    with open(file_name, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
 def load_zip(file_name: str) -> Tuple[str, io.BytesIO]:
     """
     Extracts a file from a zip file. The file that is extracted must have a file name equal to the name of the zip file
@@ -147,13 +584,17 @@ def load_wkt_csv(file_name_or_file):
     :param file_name_or_file:
     :return:
     """
+    import geopandas
+    import pandas
+    from shapely import from_wkt
+
     df = pandas.read_csv(file_name_or_file)
-    df['geometry'] = df['geometry'].apply(wkt.loads)
-    gdf = geopandas.GeoDataFrame(df, crs='epsg:4326')
+    df['geometry'] = from_wkt(df['geometry'].to_numpy(dtype=object))
+    gdf = geopandas.GeoDataFrame(df, geometry='geometry', crs='epsg:4326')
     return gdf
 
 
-def gdf_to_wkt_zip(gdf: GeoDataFrame, file_out: str, tolerance: float):
+def gdf_to_wkt_zip(gdf: 'GeoDataFrame', file_out: str, tolerance: float):
     """
     Helper function to write a GeoDataFrame to a CSV containing WKT shapes.
     :param gdf:
@@ -185,28 +626,124 @@ def print_b64_as_py(b64: str, width=60) -> None:
     print(result)
 
 
-def grid_to_base64(grid: Grid, lat_first=False) -> None:
+def grid_to_base64(grid: Grid, lat_first=False, legacy=False) -> None:
     """
-    Takes a grid and prints a python definition of a base64-encoded zipped version of it.
+    Takes a grid and prints a python definition of a base64-encoded compressed version of it, see grid_to_base64_str.
     :param grid: the grid
-    :param lat_first: whether to print latitude first
+    :param lat_first: whether latlon_from_base64_zip returns latitude first
+    :param legacy: if True, the grid is written as zipped CSV text, which versions of this package without the
+        binary encoding can decode
     :return: None
     """
-    plain_grid = io.StringIO()
-    write_grid_to_file(grid, plain_grid, lat_first=lat_first)
-    encoded = compress_string(plain_grid.getvalue())
+    if legacy:
+        plain_grid = io.StringIO()
+        write_grid_to_file(grid, plain_grid, lat_first=lat_first)
+        from nzshm_common.util import compress_string
+
+        encoded = compress_string(plain_grid.getvalue())
+    else:
+        encoded = grid_to_base64_str(grid, lat_first=lat_first)
     print_b64_as_py(encoded)
 
 
+def grid_to_base64_str(grid: Grid, lat_first=False) -> str:
+    """
+    Encodes the points of a grid, without attributes, as a base64 string.
+    The encoding starts with a header with the step, precision and lattice origin of the grid. If the points are on a
+    lattice, they are numbered column by column within their bounding box and the differences between consecutive
+    numbers are stored, otherwise the differences between their sorted lattice keys. The differences are stored in the
+    smallest unsigned integer type that fits them and compressed with LZMA.
+    :param grid: the grid
+    :param lat_first: whether latlon_from_base64_zip returns latitude first
+    :return: the base64 string
+    """
+    keys = np.asarray(grid._keys)
+    x, y = _decode(keys)
+    step = _step_units(grid.step, grid.precision) if grid.step > 0 else 0
+    if len(keys) and step and grid.origin is not None:
+        mode = _EMBEDDED_LATTICE
+        x0, y0 = int(x.min()), int(y.min())
+        rows = int((y.max() - y0) // step) + 1
+        # keys are sorted by x, then y, so the numbers increase
+        numbers = ((x - x0) // step).astype(np.uint64) * np.uint64(rows) + ((y - y0) // step).astype(np.uint64)
+    else:
+        mode = _EMBEDDED_KEYS
+        x0 = y0 = rows = 0
+        numbers = keys.view(np.uint64)
+    deltas = np.diff(numbers, prepend=np.uint64(0))
+    dtype = np.dtype(np.uint8)
+    for candidate in (np.uint16, np.uint32, np.uint64):
+        if len(deltas) and deltas.max() > np.iinfo(dtype).max:
+            dtype = np.dtype(candidate)
+    header = _EMBEDDED_HEADER.pack(
+        mode, lat_first, grid.precision, dtype.itemsize, grid.step, x0, y0, rows, step, len(keys)
+    )
+    body = lzma.compress(header + deltas.astype(dtype.newbyteorder('<')).tobytes())
+    return base64.b64encode(_EMBEDDED_MAGIC + bytes([_EMBEDDED_VERSION]) + body).decode('ascii')
+
+
+def grid_from_base64(b64_data: str) -> Grid:
+    """
+    Decodes a grid from a string made by grid_to_base64_str, or by older versions of grid_to_base64. The points of
+    older zipped CSV strings are assumed to be lon/lat and the grid has step -1.
+    :param b64_data: a base64 string
+    :return: the grid
+    """
+    data = base64.b64decode(b64_data)
+    if not data.startswith(_EMBEDDED_MAGIC):
+        return Grid(-1, _legacy_coordinates(data))
+    header, deltas = _read_embedded(data)
+    mode, _, precision, _, step, x0, y0, rows, step_units, count = header
+    numbers = np.cumsum(deltas, dtype=np.uint64)
+    if mode == _EMBEDDED_LATTICE:
+        columns, rows_ = np.divmod(numbers, np.uint64(rows))
+        keys = _encode(x0 + columns.astype(np.int64) * step_units, y0 + rows_.astype(np.int64) * step_units)
+    else:
+        keys = numbers.view(np.int64)
+    return Grid._from_keys(step, precision, keys)
+
+
+def coordinates_from_base64(b64_data: str) -> np.ndarray:
+    """
+    Decodes the points of a string made by grid_to_base64_str or grid_to_base64.
+    :param b64_data: a base64 string
+    :return: an array of shape (n, 2), in lat/lon order if the grid was encoded with lat_first, otherwise lon/lat
+    """
+    data = base64.b64decode(b64_data)
+    if not data.startswith(_EMBEDDED_MAGIC):
+        return _legacy_coordinates(data)
+    lat_first = _read_embedded(data)[0][1]
+    coordinates = grid_from_base64(b64_data).to_numpy()
+    return coordinates[:, ::-1] if lat_first else coordinates
+
+
+def _read_embedded(data: bytes) -> Tuple[tuple, np.ndarray]:
+    version = data[len(_EMBEDDED_MAGIC)]
+    if version != _EMBEDDED_VERSION:
+        raise ValueError(f"unsupported embedded grid version {version}")
+    body = lzma.decompress(data[len(_EMBEDDED_MAGIC) + 1 :])
+    header = _EMBEDDED_HEADER.unpack_from(body)
+    dtype = np.dtype(f'<u{header[3]}')
+    deltas = np.frombuffer(body, dtype=dtype, count=header[-1], offset=_EMBEDDED_HEADER.size)
+    return header, deltas
+
+
+def _legacy_coordinates(data: bytes) -> np.ndarray:
+    """
+    Parses the zipped CSV text of older versions of grid_to_base64.
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        text = zf.read("0").decode("utf-8")
+    rows = [(float(row[0]), float(row[1])) for row in csv.reader(io.StringIO(text))]
+    return np.array(rows, dtype=float).reshape(-1, 2)
+
+
 def latlon_from_base64_zip(b64_data: str) -> list:
     """
-    Takes a zipped and base64-encoded string and returns a list of lat/lons
-    (or lon/lats, depending on how the data was written)
-    :param b64_data: a zipped and base64-encoded string
+    Takes a base64-encoded string made by grid_to_base64 and returns a list of lat/lons
+    (or lon/lats, depending on how the data was written). Use coordinates_from_base64 or grid_from_base64 to get
+    arrays or a grid instead.
+    :param b64_data: a base64-encoded string
     :return: a list of lat/lon pairs
     """
-    data = decompress_string(b64_data)
-    result = []
-    for row in csv.reader(io.StringIO(data)):
-        result.append((float(row[0]), float(row[1])))
-    return result
+    return [tuple(row) for row in coordinates_from_base64(b64_data).tolist()]
@@ -0,0 +1,221 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+import shapely
+from geopandas import GeoDataFrame
+
+from nzshm_grid_loc.clip import _contains, region_geometries
+from nzshm_grid_loc.profiling import instrument
+
+# lattice points closer than this many degrees to a polygon edge are tested exactly
+BOUNDARY_TOLERANCE = 1e-9
+
+# the number of region masks kept by region_mask
+MASK_CACHE_SIZE = 8
+
+# region masks, keyed by geometry hash and lattice, least recently used first
+_mask_cache: 'OrderedDict[tuple, RegionMask]' = OrderedDict()
+_mask_cache_lock = threading.Lock()
+
+
+class RegionMask:
+    """
+    A region rasterized on a lattice. Each lattice point in the bounding box of the region is classified as inside or
+    outside with a scanline pass over the polygon edges. Only points within BOUNDARY_TOLERANCE of an edge, where the
+    scanline result can't be trusted, and points in holes of invalid polygons are tested exactly. For valid polygons,
+    the result is the same as clip.contains_mask for points on the lattice.
+    """
+
+    def __init__(self, geometries: np.ndarray, precision: int, step: int, origin: Tuple[int, int], workers: int = 1):
+        """
+        Rasterizes a region.
+        :param geometries: a shapely array of polygons, see clip.region_geometries
+        :param precision: the lattice precision, coordinates are in 10^-precision degrees
+        :param step: the lattice spacing in 10^-precision degrees
+        :param origin: the x and y residue of the lattice points modulo step
+        :param workers: the number of processes that test the points near edges exactly, see clip.contains_mask
+        """
+        self.precision = precision
+        self.step = step
+        self.scale = 10**precision
+        if len(geometries):
+            min_x, min_y, max_x, max_y = shapely.total_bounds(geometries)
+        else:
+            min_x = min_y = max_x = max_y = 0.0
+        self.x0, columns = self._axis(min_x, max_x, origin[0])
+        self.y0, rows = self._axis(min_y, max_y, origin[1])
+        self.inside = np.zeros((columns, rows), dtype=bool)
+        self.boundary_count = 0
+        if len(geometries):
+            self._rasterize(geometries, workers)
+
+    @staticmethod
+    def cells_for(geometries: np.ndarray, precision: int, step: int) -> int:
+        """
+        Returns the approximate number of raster cells of a region mask, without creating it.
+        """
+        if not len(geometries):
+            return 0
+        min_x, min_y, max_x, max_y = shapely.total_bounds(geometries) * 10**precision
+        return int(((max_x - min_x) // step + 2) * ((max_y - min_y) // step + 2))
+
+    def _axis(self, low: float, high: float, residue: int) -> Tuple[int, int]:
+        # one lattice line too many on each side is harmless, one too few would lose points
+        first = int(np.floor((low * self.scale - residue) / self.step)) * self.step + residue
+        last = int(np.ceil((high * self.scale - residue) / self.step)) * self.step + residue
+        return first, (last - first) // self.step + 1
+
+    def _rasterize(self, geometries: np.ndarray, workers: int) -> None:
+        columns, rows = self.inside.shape
+        xs = (self.x0 + np.arange(columns, dtype=np.int64) * self.step) / self.scale
+        ys = (self.y0 + np.arange(rows, dtype=np.int64) * self.step) / self.scale
+
+        # every edge of every ring, with the index of its ring
+        parts = shapely.get_parts(geometries)
+        rings, ring_part = shapely.get_rings(parts, return_index=True)
+        coordinates, coordinate_ring = shapely.get_coordinates(rings, return_index=True)
+        same_ring = coordinate_ring[1:] == coordinate_ring[:-1]
+        x1, y1 = coordinates[:-1][same_ring].T
+        x2, y2 = coordinates[1:][same_ring].T
+        edge_ring = coordinate_ring[:-1][same_ring]
+
+        boundary = np.zeros((rows, columns), dtype=bool)
+        self._mark_vertices(boundary, xs, ys, coordinates)
+        self._mark_horizontal_edges(boundary, xs, ys, x1, y1, x2, y2)
+
+        # the rows each edge crosses, half-open in y so that a vertex on a row is counted once
+        sloped = y1 != y2
+        x1, y1, x2, y2, edge_ring = x1[sloped], y1[sloped], x2[sloped], y2[sloped], edge_ring[sloped]
+        first_row = np.searchsorted(ys, np.minimum(y1, y2), side='left')
+        end_row = np.searchsorted(ys, np.maximum(y1, y2), side='left')
+        counts = end_row - first_row
+        edge = np.repeat(np.arange(len(x1)), counts)
+        row = first_row[edge] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        crossing = x1[edge] + (ys[row] - y1[edge]) * (x2[edge] - x1[edge]) / (y2[edge] - y1[edge])
+
+        # lattice points near a crossing are on or close to an edge
+        position = (crossing * self.scale - self.x0) / self.step
+        nearest = np.clip(np.rint(position).astype(np.int64), 0, columns - 1)
+        near = np.abs(xs[nearest] - crossing) <= BOUNDARY_TOLERANCE
+        boundary[row[near], nearest[near]] = True
+
+        # within each ring and row, points between the 1st and 2nd, 3rd and 4th... crossing are inside the ring. Each
+        # row crosses a ring an even number of times, so after sorting the pairs are at even positions.
+        order = np.lexsort((crossing, row, edge_ring[edge]))
+        interval_ring = edge_ring[edge][order][::2]
+        row = row[order][::2]
+        position = position[order]
+        start = np.clip(np.floor(position[::2]).astype(np.int64) + 1, 0, columns)
+        end = np.clip(np.ceil(position[1::2]).astype(np.int64), 0, columns)
+
+        # a polygon contains the points inside its shell that are not inside one of its holes. Counting the shells and
+        # holes that cover each point gives the same result, as long as a point is in at most one hole and that hole
+        # is inside its shell. Other points are tested exactly.
+        shell = np.r_[True, ring_part[1:] != ring_part[:-1]]
+        shells = shapely.polygons(rings[shell])[np.cumsum(shell) - 1]
+        contained = shell | (shapely.is_valid(shells) & shapely.covers(shells, rings))
+        kind = np.where(shell, 0, np.where(contained, 1, 2))[interval_ring]
+        coverage = np.zeros((kind.max(initial=1) + 1, rows, columns + 1), dtype=np.int32)
+        np.add.at(coverage, (kind, row, start), 1)
+        np.add.at(coverage, (kind, row, end), -1)
+        counts = np.cumsum(coverage[:, :, :-1], axis=2)
+        inside = counts[0] > np.minimum(counts[1], 1)
+        boundary |= counts[1] > 1
+        if len(counts) > 2:
+            boundary |= counts[2] > 0
+
+        row_index, column_index = np.nonzero(boundary)
+        # the points are in row order, so the partitions of the workers are strips of rows
+        inside[row_index, column_index] = _contains(geometries, xs[column_index], ys[row_index], workers=workers)
+        self.inside = np.ascontiguousarray(inside.T)
+        self.boundary_count = len(row_index)
+
+    def _mark_vertices(self, boundary, xs, ys, coordinates) -> None:
+        # a vertex at the top or bottom of a ring is not crossed by the scanline of its row, but points on it are on
+        # the boundary
+        column = np.rint((coordinates[:, 0] * self.scale - self.x0) / self.step).astype(np.int64)
+        row = np.rint((coordinates[:, 1] * self.scale - self.y0) / self.step).astype(np.int64)
+        column = np.clip(column, 0, len(xs) - 1)
+        row = np.clip(row, 0, len(ys) - 1)
+        near = (np.abs(xs[column] - coordinates[:, 0]) <= BOUNDARY_TOLERANCE) & (
+            np.abs(ys[row] - coordinates[:, 1]) <= BOUNDARY_TOLERANCE
+        )
+        boundary[row[near], column[near]] = True
+
+    @staticmethod
+    def _mark_horizontal_edges(boundary, xs, ys, x1, y1, x2, y2) -> None:
+        # the scanline does not cross edges that lie on a row, all points on them are on the boundary
+        flat = (y1 == y2) & (x1 != x2)
+        row = np.searchsorted(ys, y1[flat])
+        on_row = row < len(ys)
+        on_row[on_row] = ys[row[on_row]] == y1[flat][on_row]
+        low = np.minimum(x1, x2)[flat][on_row] - BOUNDARY_TOLERANCE
+        high = np.maximum(x1, x2)[flat][on_row] + BOUNDARY_TOLERANCE
+        for r, start, end in zip(row[on_row], np.searchsorted(xs, low), np.searchsorted(xs, high, side='right')):
+            boundary[r, start:end] = True
+
+    def contains(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Tests which lattice points are inside the region.
+        :param x: the longitudes of the points in 10^-precision degrees, on the lattice
+        :param y: the latitudes of the points in 10^-precision degrees, on the lattice
+        :return: a boolean array that is True for points inside the region
+        """
+        columns = (np.asarray(x) - self.x0) // self.step
+        rows = (np.asarray(y) - self.y0) // self.step
+        valid = (columns >= 0) & (columns < self.inside.shape[0]) & (rows >= 0) & (rows < self.inside.shape[1])
+        mask = np.zeros(len(columns), dtype=bool)
+        mask[valid] = self.inside[columns[valid], rows[valid]]
+        return mask
+
+
+@instrument()
+def region_mask(
+    gdf: GeoDataFrame,
+    precision: int,
+    step: int,
+    origin: Tuple[int, int],
+    max_cells: Optional[int] = None,
+    workers: int = 1,
+) -> Optional[RegionMask]:
+    """
+    Returns the region mask of gdf on a lattice. Masks are cached per process, so that clipping or annotating several
+    grids on the same lattice with the same region only rasterizes it once.
+    :param gdf: a GeoDataFrame of polygons
+    :param precision: the lattice precision, coordinates are in 10^-precision degrees
+    :param step: the lattice spacing in 10^-precision degrees
+    :param origin: the x and y residue of the lattice points modulo step
+    :param max_cells: if the mask is not cached and would have more cells than this, None is returned
+    :param workers: the number of processes that test the points near edges exactly if the mask is not cached. The
+        mask is the same for any number of workers.
+    :return: the mask, or None
+    """
+    geometries = region_geometries(gdf)
+    digest = hashlib.sha256(b''.join(shapely.to_wkb(geometries).tolist())).hexdigest()
+    key = (digest, precision, step, origin)
+    with _mask_cache_lock:
+        mask = _mask_cache.get(key)
+        if mask is not None:
+            _mask_cache.move_to_end(key)
+            return mask
+
+    if max_cells is not None and RegionMask.cells_for(geometries, precision, step) > max_cells:
+        return None
+    mask = RegionMask(geometries, precision, step, origin, workers)
+    with _mask_cache_lock:
+        _mask_cache[key] = mask
+        while len(_mask_cache) > MASK_CACHE_SIZE:
+            _mask_cache.popitem(last=False)
+    return mask
+
+
+def clear_mask_cache() -> None:
+    """
+    Removes all region masks from the cache.
+    :return: None
+    """
+    with _mask_cache_lock:
+        _mask_cache.clear()
@@ -1,10 +1,15 @@
 """Main module."""
-from typing import Union
+from typing import TYPE_CHECKING, Any, Dict, Optional, Sequence, Tuple, Union
 
-from nzshm_grid_loc.geography import Regions
+from nzshm_grid_loc.cache import GridCache, cached_grid, region_digest
+from nzshm_grid_loc.geography import Regions, load_cached_polygon_file
 from nzshm_grid_loc.grid import Grid
-from nzshm_grid_loc.io import load_grid, write_grid
-from nzshm_grid_loc.plot_grid import Plot
+from nzshm_grid_loc.io import load_grid, write_grid, write_grid_tiles
+from nzshm_grid_loc.tiling import TILE_SIZE, iter_tiles
+
+# geopandas and matplotlib are imported by the functions that use them
+if TYPE_CHECKING:
+    from geopandas import GeoDataFrame
 
 
 def generate_grid(
@@ -15,35 +20,135 @@ def generate_grid(
     lon_min=166,
     lon_max=179,
     neighbours=2,
-    clip=Regions.NZ_SMALL.load(),
+    clip: Optional['GeoDataFrame'] = None,
+    workers: int = 1,
+    cache: Union[bool, GridCache] = False,
 ) -> Grid:
     """
     Generate a grid for NZ
-    :param clip:
     :param file_name: file name for the grid to be stored under
     :param step: step size for the new grid
     :param lat_min:
     :param lat_max:
     :param lon_min:
     :param lon_max:
-    :param neighbours: number of neighbour iterations
-    :param clip: clipping geometry, must be GeoDataFrame of polygons
+    :param neighbours: number of rings of neighbours to add
+    :param clip: clipping geometry, must be GeoDataFrame of polygons. Defaults to Regions.NZ_SMALL
+    :param workers: the number of processes used to clip the grid, see Grid.intersection
+    :param cache: False to always generate the grid, True to use the default GridCache, or a GridCache. The grid is
+        not cached by default, use build_grid to build grids that are cached by default
     :return: None
     """
 
-    grid = Grid.for_bounds(lat_min, lat_max, lon_min, lon_max, step)
-    grid = grid.intersection(clip)
-    for n in range(neighbours):
-        grid = grid.add_neighbours()
+    def build() -> Grid:
+        region = Regions.NZ_SMALL.load() if clip is None else clip
+        grid = Grid.for_bounds(lat_min, lat_max, lon_min, lon_max, step)
+        grid = grid.intersection(region, workers=workers)
+        return grid.add_neighbours(rings=neighbours)
+
+    grid = cached_grid(
+        build,
+        cache,
+        product='generate_grid',
+        step=step,
+        bounds=[lat_min, lat_max, lon_min, lon_max],
+        neighbours=neighbours,
+        clip=region_digest(Regions.NZ_SMALL if clip is None else clip),
+    )
     write_grid(grid, file_name)
     return grid
 
 
-def diff_grids(grid_a: Union[str, Grid], grid_b: Union[str, Grid]) -> None:
+def build_grid(
+    step: float,
+    region: Union[Regions, str, 'GeoDataFrame'] = Regions.NZ_SMALL,
+    neighbours: int = 1,
+    annotations: Sequence[Tuple[str, Any, Union[Regions, str, 'GeoDataFrame', None]]] = (),
+    cache: Union[bool, GridCache] = True,
+) -> Grid:
+    """
+    Builds a grid for a region, adds neighbours and annotates it.
+    Finished grids are kept in a GridCache, so that building the same grid again only loads it.
+    :param step: step size for the new grid
+    :param region: the region to cover, a Regions member, the file name of a polygon file or a GeoDataFrame
+    :param neighbours: number of rings of neighbours to add
+    :param annotations: (name, value, clip) tuples that are passed to Grid.annotate in order. clip is a region like
+        region, or None to annotate all points
+    :param cache: False to always build the grid, True to use the default GridCache, or a GridCache
+    :return: the grid
+    """
+
+    def build() -> Grid:
+        grid = Grid.for_polygon(step, load_region(region)).add_neighbours(rings=neighbours)
+        for name, value, clip in annotations:
+            grid = grid.annotate(name, value, clip=None if clip is None else load_region(clip))
+        return grid
+
+    return cached_grid(build, cache, **build_grid_inputs(step, region, neighbours, annotations))
+
+
+def build_grid_inputs(
+    step: float,
+    region: Union[Regions, str, 'GeoDataFrame'],
+    neighbours: int,
+    annotations: Sequence[Tuple[str, Any, Union[Regions, str, 'GeoDataFrame', None]]],
+) -> Dict[str, Any]:
+    """
+    Returns the cache inputs of a grid made by build_grid, so that other ways of building the same grid share its
+    cache entry.
+    :param step: step size of the grid
+    :param region: the region the grid covers
+    :param neighbours: number of rings of neighbours
+    :param annotations: (name, value, clip) tuples, see build_grid
+    :return: the inputs for GridCache.key
+    """
+    return dict(
+        product='build_grid',
+        step=step,
+        region=region_digest(region),
+        neighbours=neighbours,
+        annotations=[[name, value, None if clip is None else region_digest(clip)] for name, value, clip in annotations],
+    )
+
+
+def generate_grid_tiled(
+    file_name: str,
+    step: float,
+    lat_min=-48,
+    lat_max=-34,
+    lon_min=166,
+    lon_max=179,
+    neighbours=2,
+    clip: Optional['GeoDataFrame'] = None,
+    tile_size: int = TILE_SIZE,
+) -> int:
+    """
+    Generate a grid for NZ like generate_grid, but tile by tile, writing each tile to the file as soon as it is done.
+    Use this for steps that are too fine to hold the whole bounding box in memory.
+    :param file_name: file name for the grid to be stored under
+    :param step: step size for the new grid
+    :param lat_min:
+    :param lat_max:
+    :param lon_min:
+    :param lon_max:
+    :param neighbours: number of rings of neighbours to add
+    :param clip: clipping geometry, must be GeoDataFrame of polygons. Defaults to Regions.NZ_SMALL
+    :param tile_size: the number of lattice rows and columns of a tile
+    :return: the number of grid points
+    """
+    if clip is None:
+        clip = Regions.NZ_SMALL.load()
+
+    tiles = iter_tiles(step, clip, lat_min, lat_max, lon_min, lon_max, neighbours, tile_size)
+    return write_grid_tiles(tiles, file_name)
+
+
+def diff_grids(grid_a: Union[str, Grid], grid_b: Union[str, Grid], file_name: Optional[str] = None) -> None:
     """
     Load two grids and create a visual diff
     :param grid_a: a grid or a file name of a grid file
     :param grid_b: a grid or a file name of a grid file
+    :param file_name: if given, the diff is saved to this image file instead of shown, which works without a display
     :return: None
     """
     grid = grid_a if isinstance(grid_a, Grid) else load_grid(grid_a)
@@ -59,9 +164,27 @@ def diff_grids(grid_a: Union[str, Grid], grid_b: Union[str, Grid]) -> None:
     print("in a but not b  : " + str(len(grid_diff1)))
     print("in b but not a  : " + str(len(grid_diff2)))
 
-    plot = Plot()
+    from nzshm_grid_loc.plot_grid import Plot
+
+    plot = Plot(headless=file_name is not None)
     plot.add_geoDataFrame(Regions.NZ_SMALL.load())
     plot.add_grid(grid_intersection, color='y')
     plot.add_grid(grid_diff1, color='r')
     plot.add_grid(grid_diff2, color='g')
-    plot.show()
+    if file_name is None:
+        plot.show()
+    else:
+        plot.save(file_name)
+
+
+def load_region(region: Union[Regions, str, 'GeoDataFrame']) -> 'GeoDataFrame':
+    """
+    Loads a region given as a Regions member or the file name of a polygon file. Both are only read once per process.
+    :param region: a Regions member, the file name of a polygon file or a GeoDataFrame, which is returned as it is
+    :return: a GeoDataFrame
+    """
+    if isinstance(region, Regions):
+        return region.load()
+    if isinstance(region, str):
+        return load_cached_polygon_file(region)
+    return region
@@ -1,51 +1,184 @@
-import matplotlib.pyplot as plt
+from typing import Optional, Sequence, Tuple
+
+import matplotlib
+import numpy as np
 from geopandas import GeoDataFrame
+from matplotlib.colors import to_rgba
+from matplotlib.figure import Figure
+from matplotlib.patches import Patch
 
 from nzshm_grid_loc.grid import Grid
 
+# grids with more points than this are drawn as a raster unless add_grid is told otherwise
+RASTER_THRESHOLD = 20000
+
+# the color of points without a value in add_attribute
+MISSING_COLOR = 'lightgrey'
+
+# matplotlib.pyplot is only imported by plots that are not headless, so that importing this module or making headless
+# plots does not select a backend
+
 
 def set_plot_formatting():
     # set up plot formatting
     SMALL_SIZE = 12
     MEDIUM_SIZE = 16
     BIGGER_SIZE = 25
-    plt.rc('font', size=SMALL_SIZE)  # controls default text sizes
-    plt.rc('axes', titlesize=MEDIUM_SIZE)  # fontsize of the axes title
-    plt.rc('axes', labelsize=MEDIUM_SIZE)  # fontsize of the x and y labels
-    plt.rc('xtick', labelsize=SMALL_SIZE)  # fontsize of the tick labels
-    plt.rc('ytick', labelsize=SMALL_SIZE)  # fontsize of the tick labels
-    plt.rc('legend', fontsize=SMALL_SIZE)  # legend fontsize
-    plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
+    matplotlib.rc('font', size=SMALL_SIZE)  # controls default text sizes
+    matplotlib.rc('axes', titlesize=MEDIUM_SIZE)  # fontsize of the axes title
+    matplotlib.rc('axes', labelsize=MEDIUM_SIZE)  # fontsize of the x and y labels
+    matplotlib.rc('xtick', labelsize=SMALL_SIZE)  # fontsize of the tick labels
+    matplotlib.rc('ytick', labelsize=SMALL_SIZE)  # fontsize of the tick labels
+    matplotlib.rc('legend', fontsize=SMALL_SIZE)  # legend fontsize
+    matplotlib.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
 
 
 class Plot:
     """
     Helper class to draw plots for debugging in equirectangular projection
     https://en.wikipedia.org/wiki/Equirectangular_projection
+    Large grids are drawn as rasters: their points are binned into cells the size of a screen pixel, or of a grid
+    step if that is larger, and the cells are drawn with one imshow call instead of one marker per point.
     """
 
-    def __init__(self, lon_min=163, lon_max=180, lat_min=-50, lat_max=-32):
+    def __init__(self, lon_min=163, lon_max=180, lat_min=-50, lat_max=-32, headless=False):
+        """
+        Creates a map.
+        :param lon_min: the minimum longitude shown
+        :param lon_max: the maximum longitude shown
+        :param lat_min: the minimum latitude shown
+        :param lat_max: the maximum latitude shown
+        :param headless: if True, the figure is not managed by pyplot and can only be saved, not shown. Use this to
+            make plots without a display, e.g. in CI, and to avoid keeping figures open in long-running processes.
+        """
         self.lon_lim = [lon_min, lon_max]
         self.lat_lim = [lat_min, lat_max]
         set_plot_formatting()
-        self.fig, self.ax = plt.subplots(1, 1)
+        if headless:
+            self.fig = Figure()
+            self.ax = self.fig.subplots(1, 1)
+        else:
+            import matplotlib.pyplot as plt
+
+            self.fig, self.ax = plt.subplots(1, 1)
         self.fig.set_facecolor('white')
         self.ax.set_xlim(self.lon_lim)
         self.ax.set_ylim(self.lat_lim)
 
-    def add_grid(self, grid: Grid, color='r') -> None:
+    def add_grid(self, grid: Grid, color='r', raster: Optional[bool] = None) -> None:
         """
         Adds the points of a grid to the map.
         :param grid: the grid
         :param color: a matplotlib color
+        :param raster: True to draw the grid as a raster, False to draw a marker per point. By default, grids with more
+            than RASTER_THRESHOLD points are drawn as rasters.
+        :return: None
+        """
+        if not self._use_raster(grid, raster):
+            coordinates = grid.to_numpy()
+            self.ax.plot(coordinates[:, 0], coordinates[:, 1], '.', color=color)
+            return
+        cells, shape, extent = self._cells(grid)
+        image = np.zeros((shape[0] * shape[1], 4))
+        image[cells] = to_rgba(color)
+        self._show_raster(image.reshape(*shape, 4), extent)
+
+    def add_density(self, grid: Grid, cmap='viridis', colorbar=True) -> None:
+        """
+        Adds a raster of the number of grid points per cell to the map. Cells without points are not drawn.
+        :param grid: the grid
+        :param cmap: a matplotlib colormap
+        :param colorbar: whether to add a colorbar
         :return: None
         """
-        x = []
-        y = []
-        for p in grid:
-            x.append(p.x)
-            y.append(p.y)
-        self.ax.plot(x, y, '.', color=color)
+        cells, shape, extent = self._cells(grid)
+        counts = np.bincount(cells, minlength=shape[0] * shape[1]).reshape(shape)
+        image = self._show_raster(np.ma.masked_equal(counts, 0), extent, cmap=cmap)
+        if colorbar:
+            self.fig.colorbar(image, ax=self.ax, label='points per cell')
+
+    def add_attribute(
+        self, grid: Grid, name: str, colors: Optional[Sequence] = None, raster: Optional[bool] = None, legend=True
+    ) -> None:
+        """
+        Adds the points of a grid to the map, colored by the value of an attribute. Points without the attribute are
+        drawn in MISSING_COLOR. In a raster, a cell with points of several values shows the value that was first set
+        on the grid last.
+        :param grid: the grid
+        :param name: the name of the attribute
+        :param colors: matplotlib colors for the values of the attribute, in the order they were first set. By default
+            the colors of the tab10 colormap are used.
+        :param raster: see add_grid
+        :param legend: whether to add a legend of the values
+        :return: None
+        """
+        codes, categories = grid.column_codes(name)
+        if colors is None:
+            colors = [matplotlib.colormaps['tab10'](i % 10) for i in range(len(categories))]
+        if len(colors) < len(categories):
+            raise ValueError(f"{len(categories)} colors are needed for the values of {name}")
+        # one color per code, code -1 is the last entry
+        palette = np.array([to_rgba(color) for color in [*colors[: len(categories)], MISSING_COLOR]])
+
+        if self._use_raster(grid, raster):
+            cells, shape, extent = self._cells(grid)
+            cell_codes = np.full(shape[0] * shape[1], -2)
+            np.maximum.at(cell_codes, cells, np.asarray(codes))
+            image = np.zeros((len(cell_codes), 4))
+            drawn = cell_codes > -2
+            image[drawn] = palette[cell_codes[drawn]]
+            self._show_raster(image.reshape(*shape, 4), extent)
+        else:
+            lons, lats = grid.to_numpy().T
+            for code in np.unique(codes):
+                selected = codes == code
+                self.ax.plot(lons[selected], lats[selected], '.', color=palette[code])
+
+        if legend:
+            labels = [str(category) for category in categories]
+            if np.any(np.asarray(codes) < 0):
+                labels.append('not set')
+            handles = [Patch(color=palette[i if i < len(categories) else -1]) for i in range(len(labels))]
+            self.ax.legend(handles, labels, title=name)
+
+    def _use_raster(self, grid: Grid, raster: Optional[bool]) -> bool:
+        return len(grid) > RASTER_THRESHOLD if raster is None else raster
+
+    def _cells(self, grid: Grid) -> Tuple[np.ndarray, Tuple[int, int], list]:
+        """
+        Bins the points of a grid that are inside the map into raster cells.
+        :return: the flat cell index of each point inside the map, the (rows, columns) shape of the raster and its
+            extent for imshow
+        """
+        # the size of the axes in pixels when the figure is drawn or saved
+        bbox = self.ax.get_window_extent()
+        cell_size = max(
+            (self.lon_lim[1] - self.lon_lim[0]) / max(bbox.width, 1),
+            (self.lat_lim[1] - self.lat_lim[0]) / max(bbox.height, 1),
+            grid.step if grid.step > 0 else 0,
+        )
+        columns = int(np.ceil((self.lon_lim[1] - self.lon_lim[0]) / cell_size))
+        rows = int(np.ceil((self.lat_lim[1] - self.lat_lim[0]) / cell_size))
+
+        lons, lats = grid.to_numpy().T
+        # lattice points are in the middle of their cells when the cells are one step wide
+        column = np.floor((lons - self.lon_lim[0]) / cell_size + 0.5).astype(np.int64)
+        row = np.floor((lats - self.lat_lim[0]) / cell_size + 0.5).astype(np.int64)
+        inside = (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+        extent = [
+            self.lon_lim[0] - cell_size / 2,
+            self.lon_lim[0] + (columns - 0.5) * cell_size,
+            self.lat_lim[0] - cell_size / 2,
+            self.lat_lim[0] + (rows - 0.5) * cell_size,
+        ]
+        return row[inside] * columns + column[inside], (rows, columns), extent
+
+    def _show_raster(self, image: np.ndarray, extent: list, **kwargs):
+        shown = self.ax.imshow(image, extent=extent, origin='lower', interpolation='nearest', aspect='auto', **kwargs)
+        # imshow changes the limits to the extent of the image
+        self.ax.set_xlim(self.lon_lim)
+        self.ax.set_ylim(self.lat_lim)
+        return shown
 
     def add_geoDataFrame(self, df: GeoDataFrame, color='k') -> None:
         """
@@ -65,3 +198,12 @@ class Plot:
         :return: None
         """
         self.fig.show()
+
+    def save(self, file_name: str, dpi: Optional[float] = None) -> None:
+        """
+        Saves the map to an image file, e.g. a PNG. Works without a display.
+        :param file_name: the file name, its extension sets the format
+        :param dpi: the resolution, the figure's by default
+        :return: None
+        """
+        self.fig.savefig(file_name, dpi=dpi)
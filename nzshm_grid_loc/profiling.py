@@ -0,0 +1,292 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+
+# environment variables that profile the whole process and write the report to a file when it exits
+PROFILE_VARIABLE = 'NZSHM_GRID_LOC_PROFILE'
+TRACE_VARIABLE = 'NZSHM_GRID_LOC_TRACE'
+
+# the span fields that are shown as arguments of trace events
+_TRACE_ARGS = ('points_in', 'points_out', 'predicates', 'peak_bytes')
+
+# the profile that spans are recorded in, None when profiling is off
+_active: Optional['Profile'] = None
+
+
+class Span:
+    """
+    One call of an instrumented function.
+    """
+
+    __slots__ = (
+        'name',
+        'start',
+        'seconds',
+        'points_in',
+        'points_out',
+        'predicates',
+        'peak_bytes',
+        'depth',
+        'thread',
+        '_memory_start',
+        '_memory_peak',
+    )
+
+    def __init__(self, name: str, start: float, depth: int, thread: int):
+        self.name = name
+        self.start = start
+        self.seconds = 0.0
+        self.points_in: Optional[int] = None
+        self.points_out: Optional[int] = None
+        self.predicates = 0
+        self.peak_bytes: Optional[int] = None
+        self.depth = depth
+        self.thread = thread
+        self._memory_start = 0
+        self._memory_peak = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'start': self.start,
+            'seconds': self.seconds,
+            'points_in': self.points_in,
+            'points_out': self.points_out,
+            'predicates': self.predicates,
+            'peak_bytes': self.peak_bytes,
+            'depth': self.depth,
+            'thread': self.thread,
+        }
+
+
+class Profile:
+    """
+    The spans recorded while profiling, in the order they finished.
+    """
+
+    def __init__(self, memory: bool):
+        self.memory = memory
+        self.spans: List[Span] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> List[Span]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter(self, name: str) -> Span:
+        stack = self._stack()
+        span = Span(name, time.perf_counter() - self._origin, len(stack), threading.get_ident())
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # the peak is reset for each span, so the enclosing span keeps track of the peak before it
+                stack[-1]._memory_peak = max(stack[-1]._memory_peak, peak)
+            tracemalloc.reset_peak()
+            span._memory_start = current
+        stack.append(span)
+        return span
+
+    def _exit(self, span: Span) -> None:
+        span.seconds = time.perf_counter() - self._origin - span.start
+        stack = self._stack()
+        stack.pop()
+        if self.memory:
+            peak = max(span._memory_peak, tracemalloc.get_traced_memory()[1])
+            span.peak_bytes = peak - span._memory_start
+            if stack:
+                stack[-1]._memory_peak = max(stack[-1]._memory_peak, peak)
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the totals per instrumented function: the number of calls, the time, points and predicates summed
+        over all calls, and the largest peak allocation of a call.
+        """
+        summary: Dict[str, Dict[str, Any]] = {}
+        for span in self.spans:
+            total = summary.setdefault(
+                span.name,
+                {'calls': 0, 'seconds': 0.0, 'points_in': 0, 'points_out': 0, 'predicates': 0, 'peak_bytes': None},
+            )
+            total['calls'] += 1
+            total['seconds'] += span.seconds
+            total['points_in'] += span.points_in or 0
+            total['points_out'] += span.points_out or 0
+            total['predicates'] += span.predicates
+            if span.peak_bytes is not None:
+                total['peak_bytes'] = max(total['peak_bytes'] or 0, span.peak_bytes)
+        return summary
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Returns the profile as a JSON serializable dictionary with the summary and all spans, sorted by start time.
+        Times are in seconds since profiling started.
+        """
+        spans = sorted(self.spans, key=lambda span: span.start)
+        return {'summary': self.summary(), 'spans': [span.to_dict() for span in spans]}
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """
+        Returns the profile in the Chrome trace event format, which chrome://tracing and Perfetto can show.
+        """
+        pid = os.getpid()
+        events = []
+        for span in sorted(self.spans, key=lambda span: span.start):
+            args = {key: getattr(span, key) for key in _TRACE_ARGS}
+            events.append(
+                {
+                    'name': span.name,
+                    'ph': 'X',
+                    'ts': span.start * 1e6,
+                    'dur': span.seconds * 1e6,
+                    'pid': pid,
+                    'tid': span.thread,
+                    'args': {key: value for key, value in args.items() if value is not None},
+                }
+            )
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_json(self, file_name: str) -> None:
+        """
+        Writes the report to a JSON file.
+        :param file_name: the file name
+        :return: None
+        """
+        with open(file_name, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_chrome_trace(self, file_name: str) -> None:
+        """
+        Writes the profile to a file in the Chrome trace event format.
+        :param file_name: the file name
+        :return: None
+        """
+        with open(file_name, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+@contextmanager
+def profile(memory: Optional[bool] = None) -> Iterator[Profile]:
+    """
+    Records the instrumented grid operations that run inside the context.
+    Spans are recorded for all threads of the process, but not for worker processes, so predicates tested in a process
+    pool are not counted.
+    :param memory: if True, tracemalloc is started if it is not running, and the peak allocation of each span is
+        recorded. If None, peaks are recorded if tracemalloc is already running, e.g. with PYTHONTRACEMALLOC=1.
+        tracemalloc slows down allocations, so times are only comparable between runs with the same setting.
+    :return: a context manager that gives the Profile
+    """
+    global _active
+    started = memory is True and not tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+    if started:
+        tracemalloc.start()
+    # reset_peak is new in Python 3.9, without it peaks can't be measured per span
+    result = Profile(memory=tracemalloc.is_tracing() and memory is not False and hasattr(tracemalloc, 'reset_peak'))
+    previous = _active
+    _active = result
+    try:
+        yield result
+    finally:
+        _active = previous
+        if started:
+            tracemalloc.stop()
+
+
+def instrument(name: Optional[str] = None) -> Callable[[Callable], Callable]:
+    """
+    Decorates a function so that its calls are recorded while profiling. The points in are the points of the grids
+    passed to the function, the points out are the points of the grids it returns, or the number of True values of a
+    boolean array it returns.
+    When profiling is off, the only cost is one check of a global variable per call.
+    :param name: the name of the spans, the qualified name of the function by default
+    :return: the decorator
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        span_name = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            active = _active
+            if active is None:
+                return fn(*args, **kwargs)
+            span = active._enter(span_name)
+            try:
+                span.points_in = _count_points(list(args) + list(kwargs.values()))
+                result = fn(*args, **kwargs)
+                span.points_out = _count_points([result], masks=True)
+                return result
+            finally:
+                active._exit(span)
+
+        return wrapper
+
+    return decorator
+
+
+def count_predicates(count: int) -> None:
+    """
+    Adds to the number of exact point-in-polygon tests of the innermost span of the current thread.
+    :param count: the number of tests
+    :return: None
+    """
+    active = _active
+    if active is not None:
+        stack = active._stack()
+        if stack:
+            stack[-1].predicates += count
+
+
+def _count_points(values: List[Any], masks: bool = False) -> Optional[int]:
+    # grid imports this module
+    from nzshm_grid_loc.grid import Grid
+
+    count = None
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            points = _count_points(list(value))
+        elif isinstance(value, dict):
+            points = _count_points(list(value.values()))
+        elif isinstance(value, Grid):
+            points = len(value)
+        elif masks and isinstance(value, np.ndarray) and value.dtype == bool:
+            points = int(np.count_nonzero(value))
+        else:
+            points = None
+        if points is not None:
+            count = (count or 0) + points
+    return count
+
+
+def _profile_from_environment() -> None:
+    json_file = os.environ.get(PROFILE_VARIABLE)
+    trace_file = os.environ.get(TRACE_VARIABLE)
+    if not (json_file or trace_file):
+        return
+    context = profile()
+    result = context.__enter__()
+
+    def write():
+        context.__exit__(None, None, None)
+        if json_file:
+            result.write_json(json_file)
+        if trace_file:
+            result.write_chrome_trace(trace_file)
+
+    atexit.register(write)
+
+
+_profile_from_environment()
@@ -0,0 +1,137 @@
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import shapely
+from geopandas import GeoDataFrame
+
+from nzshm_grid_loc.clip import _RegionIndex, region_geometries
+from nzshm_grid_loc.grid import Grid, _encode, _quantize, _step_units, get_precision
+from nzshm_grid_loc.mask import BOUNDARY_TOLERANCE
+from nzshm_grid_loc.profiling import instrument
+
+
+class _Level:
+    """
+    The lattice of Grid.for_polygon for one step, and which of its points are inside the region.
+    """
+
+    def __init__(self, step: float, total_bounds: np.ndarray):
+        self.step = step
+        self.precision = get_precision(step)
+        self.step_units = _step_units(step, self.precision)
+        bounds = [int(value / step) * step for value in total_bounds]
+        self.xs = np.unique(_quantize(np.arange(bounds[0], bounds[2] + step, step), self.precision))
+        self.ys = np.unique(_quantize(np.arange(bounds[1], bounds[3] + step, step), self.precision))
+        self.inside = np.zeros((len(self.xs), len(self.ys)), dtype=bool)
+
+    def grid(self) -> Grid:
+        x, y = np.meshgrid(self.xs, self.ys, indexing='ij')
+        return Grid._from_keys(self.step, self.precision, _encode(x[self.inside], y[self.inside]))
+
+    def uniform_boxes(self, segments: np.ndarray) -> np.ndarray:
+        """
+        Finds the boxes between four neighbouring lattice points that no polygon edge passes through. Everything in
+        such a box is inside the region if its corners are, and outside if they are not.
+        :param segments: an (n, 4) array of x1, y1, x2, y2 of the polygon edges
+        :return: a boolean array with one element per box, indexed by its lower left corner
+        """
+        scale = 10**self.precision
+        segments = _split(segments, self.step)
+        columns = self._box_range(segments[:, [0, 2]], self.xs, scale)
+        rows = self._box_range(segments[:, [1, 3]], self.ys, scale)
+        overlaps = (columns[0] <= columns[1]) & (rows[0] <= rows[1])
+        first_column, last_column = columns[:, overlaps]
+        first_row, last_row = rows[:, overlaps]
+
+        # mark the boxes overlapped by the bounding box of each edge, and sum the marks with a 2D prefix sum
+        marks = np.zeros((len(self.xs), len(self.ys)), dtype=np.int32)
+        np.add.at(marks, (first_column, first_row), 1)
+        np.add.at(marks, (last_column + 1, first_row), -1)
+        np.add.at(marks, (first_column, last_row + 1), -1)
+        np.add.at(marks, (last_column + 1, last_row + 1), 1)
+        crossed = np.cumsum(np.cumsum(marks, axis=0), axis=1)
+        return crossed[:-1, :-1] == 0
+
+    @staticmethod
+    def _box_range(ends: np.ndarray, lattice: np.ndarray, scale: int) -> np.ndarray:
+        # the first and last box that the closed interval between the ends overlaps, widened by the tolerance so
+        # that rounding can only add boxes
+        step = lattice[1] - lattice[0] if len(lattice) > 1 else 1
+        low = (ends.min(axis=1) - BOUNDARY_TOLERANCE) * scale - lattice[0]
+        high = (ends.max(axis=1) + BOUNDARY_TOLERANCE) * scale - lattice[0]
+        first = np.maximum(np.ceil(low / step).astype(np.int64) - 1, 0)
+        last = np.minimum(np.floor(high / step).astype(np.int64), len(lattice) - 2)
+        return np.stack([first, last])
+
+
+@instrument()
+def build_pyramid(steps: Sequence[float], gdf: GeoDataFrame) -> Dict[float, Grid]:
+    """
+    Creates Grid.for_polygon(step, gdf) for several steps, sharing the work between them.
+    The coarsest grid is clipped point by point. Each finer grid is derived from the next coarser one: fine points in a
+    box between four coarse points that no polygon edge passes through are inside the region if the corners of the box
+    are, so only the points in boxes along the region's edges are tested.
+    Use Grid.decimate to get coarser grids that are on the lattice of a finer one without building them.
+    :param steps: the distances between grid points in degrees
+    :param gdf: a GeoDataFrame with polygons
+    :return: a dictionary of step to grid, from the coarsest to the finest step
+    """
+    geometries = region_geometries(gdf)
+    index = _RegionIndex(geometries)
+    segments = _segments(geometries)
+
+    grids = {}
+    coarse: Optional[_Level] = None
+    for step in sorted(set(steps), reverse=True):
+        level = _Level(step, gdf.total_bounds)
+        _classify(level, coarse, index, segments)
+        grids[step] = level.grid()
+        coarse = level
+    return grids
+
+
+def _segments(geometries: np.ndarray) -> np.ndarray:
+    """
+    Returns the edges of all rings of the geometries as an (n, 4) array of x1, y1, x2, y2.
+    """
+    rings = shapely.get_rings(shapely.get_parts(geometries))
+    coordinates, ring = shapely.get_coordinates(rings, return_index=True)
+    same_ring = ring[1:] == ring[:-1]
+    return np.hstack([coordinates[:-1][same_ring], coordinates[1:][same_ring]])
+
+
+def _split(segments: np.ndarray, length: float) -> np.ndarray:
+    """
+    Splits segments into pieces no longer than length in x and y, so that their bounding boxes fit them tightly.
+    """
+    pieces = np.maximum(np.ceil(np.abs(segments[:, 2:] - segments[:, :2]).max(axis=1) / length).astype(np.int64), 1)
+    segment = np.repeat(np.arange(len(segments)), pieces)
+    piece = np.arange(len(segment)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    start, end = segments[segment, :2], segments[segment, 2:]
+    fraction = (piece / pieces[segment])[:, None]
+    next_fraction = ((piece + 1) / pieces[segment])[:, None]
+    return np.hstack([start + (end - start) * fraction, start + (end - start) * next_fraction])
+
+
+def _classify(level: _Level, coarse: Optional[_Level], index: _RegionIndex, segments: np.ndarray) -> None:
+    x, y = np.meshgrid(level.xs, level.ys, indexing='ij')
+    scale = 10**level.precision
+    exact = np.ones(x.shape, dtype=bool)
+
+    if coarse is not None and len(coarse.xs) > 1 and len(coarse.ys) > 1:
+        # the coarse box of each fine point, in the units of the finer precision
+        precision = max(level.precision, coarse.precision)
+        fine_factor = 10 ** (precision - level.precision)
+        coarse_factor = 10 ** (precision - coarse.precision)
+        box_step = coarse.step_units * coarse_factor
+        column = (x * fine_factor - coarse.xs[0] * coarse_factor) // box_step
+        row = (y * fine_factor - coarse.ys[0] * coarse_factor) // box_step
+        in_window = (column >= 0) & (column < len(coarse.xs) - 1) & (row >= 0) & (row < len(coarse.ys) - 1)
+
+        uniform = coarse.uniform_boxes(segments)
+        known = in_window.copy()
+        known[in_window] = uniform[column[in_window], row[in_window]]
+        level.inside[known] = coarse.inside[column[known], row[known]]
+        exact = ~known
+
+    level.inside[exact] = index.contains(x[exact] / scale, y[exact] / scale)
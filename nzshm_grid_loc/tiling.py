@@ -0,0 +1,94 @@
+from typing import TYPE_CHECKING, Iterator, Tuple
+
+import numpy as np
+
+from nzshm_grid_loc.grid import Grid, _decode, _encode, _quantize, get_precision
+
+if TYPE_CHECKING:
+    from geopandas import GeoDataFrame
+
+# the default number of lattice rows and columns of a tile
+TILE_SIZE = 512
+
+
+def iter_tiles(
+    step: float,
+    clip: 'GeoDataFrame',
+    lat_min: float,
+    lat_max: float,
+    lon_min: float,
+    lon_max: float,
+    neighbours: int = 0,
+    tile_size: int = TILE_SIZE,
+) -> Iterator[Grid]:
+    """
+    Generates a grid tile by tile, so that memory use is bounded by the tile size rather than the grid size.
+    The union of all tiles is the same as
+    Grid.for_bounds(lat_min, lat_max, lon_min, lon_max, step).intersection(clip).add_neighbours(rings=neighbours)
+    Tiles do not overlap and are generated column by column, from west to east and south to north.
+    :param step: distance between grid points in degrees
+    :param clip: a GeoDataFrame with polygons
+    :param lat_min: the minimum latitude
+    :param lat_max: the maximum latitude
+    :param lon_min: the minimum longitude
+    :param lon_max: the maximum longitude
+    :param neighbours: number of rings of neighbours to add
+    :param tile_size: the number of lattice rows and columns of a tile
+    :return: an iterator of grids
+    """
+    from nzshm_grid_loc.clip import _RegionIndex, region_geometries
+
+    if tile_size < 1:
+        raise ValueError("tile_size must be positive")
+    precision = get_precision(step)
+    lons = _quantize(np.arange(lon_min, lon_max, step), precision)
+    lats = _quantize(np.arange(lat_min, lat_max, step), precision)
+    scale = 10**precision
+    # the region is prepared and indexed once for all tiles
+    index = _RegionIndex(region_geometries(clip))
+
+    for column in range(0, len(lons), tile_size):
+        lon_window, x_range = _tile_window(lons, column, tile_size, neighbours)
+        for row in range(0, len(lats), tile_size):
+            lat_window, y_range = _tile_window(lats, row, tile_size, neighbours)
+
+            # clip the tile plus a halo of neighbours rows and columns, so that the neighbours of points just outside
+            # the tile are added as well
+            lon_grid, lat_grid = np.meshgrid(lon_window, lat_window, indexing='ij')
+            x = lon_grid.ravel()
+            y = lat_grid.ravel()
+            inside = index.contains(x / scale, y / scale)
+            tile = Grid._from_keys(step, precision, _encode(x[inside], y[inside])).add_neighbours(rings=neighbours)
+
+            x, y = _decode(tile._keys)
+            core = (x >= x_range[0]) & (x < x_range[1]) & (y >= y_range[0]) & (y < y_range[1])
+            if np.any(core):
+                yield tile._subset(core)
+
+
+def iter_polygon_tiles(
+    step: float, gdf: 'GeoDataFrame', neighbours: int = 0, tile_size: int = TILE_SIZE
+) -> Iterator[Grid]:
+    """
+    Generates the grid of Grid.for_polygon tile by tile, see iter_tiles.
+    :param step: distance between grid points in degrees
+    :param gdf: a GeoDataFrame with polygons
+    :param neighbours: number of rings of neighbours to add
+    :param tile_size: the number of lattice rows and columns of a tile
+    :return: an iterator of grids
+    """
+    bounds = [int(value / step) * step for value in gdf.total_bounds]
+    return iter_tiles(step, gdf, bounds[1], bounds[3] + step, bounds[0], bounds[2] + step, neighbours, tile_size)
+
+
+def _tile_window(values: np.ndarray, start: int, tile_size: int, halo: int) -> Tuple[np.ndarray, Tuple[float, float]]:
+    """
+    Returns the lattice values of a tile including its halo, and the range of quantized values the tile owns.
+    The first and last tiles own everything below and above them, which is where neighbours outside the bounding box
+    end up.
+    """
+    end = min(start + tile_size, len(values))
+    window = values[max(start - halo, 0) : end + halo]
+    low = values[start] if start > 0 else -np.inf
+    high = values[end] if end < len(values) else np.inf
+    return window, (low, high)
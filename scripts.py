@@ -1,6 +1,6 @@
 from nzshm_grid_loc.geography import Regions
-from nzshm_grid_loc.grid import Grid
 from nzshm_grid_loc.io import write_attr_grid
+from nzshm_grid_loc.nzshm_grid_loc import build_grid
 
 
 def nz_backarc_02deg_1n():
@@ -8,11 +8,12 @@ def nz_backarc_02deg_1n():
     Create backarc2_02deg_1n.csv file for OQ
     :return:
     """
-    grid = Grid \
-        .for_polygon(0.2, Regions.NZ_SMALL.load()) \
-        .add_neighbours() \
-        .annotate("backarc", "0") \
-        .annotate("backarc", "1", clip=Regions.BACKARC.load())
+    grid = build_grid(
+        0.2,
+        Regions.NZ_SMALL,
+        neighbours=1,
+        annotations=[("backarc", "0", None), ("backarc", "1", Regions.BACKARC)],
+    )
 
     write_attr_grid(grid, "backarc2_02deg_1n.csv", ["lon", "lat", "backarc"])
 
@@ -22,10 +23,11 @@ def nz_backarc_01deg_1n():
     Create backarc2_01deg_1n.csv file for OQ
     :return:
     """
-    grid = Grid \
-        .for_polygon(0.1, Regions.NZ_SMALL.load()) \
-        .add_neighbours() \
-        .annotate("backarc", "0") \
-        .annotate("backarc", "1", clip=Regions.BACKARC.load())
+    grid = build_grid(
+        0.1,
+        Regions.NZ_SMALL,
+        neighbours=1,
+        annotations=[("backarc", "0", None), ("backarc", "1", Regions.BACKARC)],
+    )
 
     write_attr_grid(grid, "backarc2_01deg_1n.csv", ["lon", "lat", "backarc"])
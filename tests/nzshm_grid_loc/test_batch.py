@@ -0,0 +1,141 @@
+import os
+
+import pytest
+
+from nzshm_grid_loc import batch
+from nzshm_grid_loc.batch import Product, build_products, load_manifest, main, plan
+from nzshm_grid_loc.cache import GridCache
+from nzshm_grid_loc.geography import Regions
+from nzshm_grid_loc.grid import Grid
+from nzshm_grid_loc.io import load_grid
+from nzshm_grid_loc.nzshm_grid_loc import build_grid
+
+MANIFEST = """
+[defaults]
+region = "WLG"
+neighbours = 1
+
+[[products]]
+output = "out/wlg.csv"
+step = 0.1
+neighbours = 0
+
+[[products]]
+name = "backarc"
+output = "out/backarc.csv"
+step = 0.1
+columns = ["lon", "lat", "backarc"]
+annotations = [
+    { name = "backarc", value = "0" },
+    { name = "backarc", value = "1", clip = "square.wkt.csv" },
+]
+
+[[products]]
+name = "plain"
+output = "out/plain.nzgrid"
+step = 0.1
+annotations = [{ name = "backarc", value = "0" }]
+
+[[products]]
+name = "fine"
+output = "fine.parquet"
+step = 0.05
+region = "square.wkt.csv"
+"""
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    square = "POLYGON((174.6 -41.5,175 -41.5,175 -41,174.6 -41,174.6 -41.5))"
+    (tmp_path / "square.wkt.csv").write_text(f'name,geometry\na,"{square}"')
+    (tmp_path / "manifest.toml").write_text(MANIFEST)
+    return tmp_path / "manifest.toml"
+
+
+def test_load_manifest(manifest, tmp_path):
+    products = load_manifest(str(manifest))
+    assert ["wlg.csv", "backarc", "plain", "fine"] == [product.name for product in products]
+    square = str(tmp_path / "square.wkt.csv")
+    assert Product("wlg.csv", str(tmp_path / "out/wlg.csv"), 0.1, Regions.WLG, 0) == products[0]
+    assert (("backarc", "0", None), ("backarc", "1", square)) == products[1].annotations
+    assert ("lon", "lat", "backarc") == products[1].columns
+    assert ["csv", "csv", "nzgrid", "parquet"] == [product.format for product in products]
+    assert square == products[3].region
+
+    groups = plan(products)
+    assert [["fine"], ["wlg.csv", "backarc", "plain"]] == [[product.name for product in group] for group in groups]
+
+
+def test_load_yaml_manifest(tmp_path):
+    manifest = tmp_path / "manifest.yaml"
+    manifest.write_text("products:\n  - output: nz.csv\n    step: 0.5\n")
+    assert [Product("nz.csv", str(tmp_path / "nz.csv"), 0.5, Regions.NZ_SMALL)] == load_manifest(str(manifest))
+
+
+def test_load_manifest_errors(tmp_path):
+    manifest = tmp_path / "manifest.toml"
+    for text in [
+        '[[products]]\noutput = "a.csv"\nstep = 0.1\nstpe = 0.2',
+        '[[products]]\noutput = "a.csv"',
+        '[[products]]\noutput = "a.txt"\nstep = 0.1\nformat = "txt"',
+        '[[products]]\noutput = "a.csv"\nstep = 0.1\n[[products]]\noutput = "a.csv"\nstep = 0.2',
+    ]:
+        manifest.write_text(text)
+        with pytest.raises(ValueError):
+            load_manifest(str(manifest))
+    with pytest.raises(ValueError):
+        load_manifest(str(tmp_path / "manifest.json"))
+
+
+def test_build_products(manifest, tmp_path, monkeypatch):
+    clipped = []
+    for_polygon = Grid.for_polygon
+    monkeypatch.setattr(Grid, "for_polygon", lambda step, gdf: clipped.append(step) or for_polygon(step, gdf))
+    products = load_manifest(str(manifest))
+    cache = GridCache(tmp_path / "cache")
+
+    written = list(build_products(products, cache=cache))
+    assert ["fine", "wlg.csv", "backarc", "plain"] == [product.name for product, _ in written]
+    # the clipped WLG grid, and the grid with neighbours and the first annotation, are shared
+    assert [0.05, 0.1] == clipped
+
+    wlg = Grid.for_polygon(0.1, Regions.WLG.load())
+    assert wlg.points == load_grid(str(tmp_path / "out/wlg.csv")).points
+    assert wlg.add_neighbours().points == load_grid(str(tmp_path / "out/plain.nzgrid")).points
+    assert len(wlg) == dict(written)[products[0]]
+
+    annotated = build_grid(0.1, Regions.WLG, 1, products[1].annotations, cache=False)
+    with open(tmp_path / "out/backarc.csv") as f:
+        rows = f.read().splitlines()
+    assert "lon,lat,backarc" == rows[0]
+    assert sorted(rows[1:]) == sorted(f"{p.x},{p.y},{annotated.get_attributes(p)['backarc']}" for p in annotated)
+    assert {"0", "1"} == {row.split(",")[2] for row in rows[1:]}
+
+    # build_grid uses the same cache entries
+    clipped.clear()
+    assert list(annotated) == list(build_grid(0.1, Regions.WLG, 1, products[1].annotations, cache=cache))
+    list(build_products(products, cache=cache))
+    assert [] == clipped
+
+
+def test_build_products_in_process_pool(manifest, tmp_path):
+    products = load_manifest(str(manifest))
+    written = dict(build_products(products, workers=2, cache=False))
+    assert set(products) == set(written)
+    for product in products:
+        assert os.path.exists(product.output)
+    assert len(Grid.for_polygon(0.1, Regions.WLG.load())) == written[products[0]]
+
+
+def test_main(manifest, tmp_path, capsys):
+    assert 0 == main([str(manifest), "--dry-run"])
+    assert "WLG 0.1\n    wlg.csv -> " in capsys.readouterr().out
+    assert not os.path.exists(tmp_path / "out")
+
+    assert 0 == main([str(manifest), "--no-cache", "--select", "plain"])
+    assert "plain: " in capsys.readouterr().out
+    assert ["plain.nzgrid"] == os.listdir(tmp_path / "out")
+
+    with pytest.raises(SystemExit):
+        main([str(manifest), "--select", "missing"])
+    assert batch.FORMATS == ("csv", "parquet", "nzgrid")
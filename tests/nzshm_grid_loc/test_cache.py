@@ -0,0 +1,114 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from nzshm_grid_loc.cache import GridCache, cached_grid, region_digest
+from nzshm_grid_loc.geography import Regions
+from nzshm_grid_loc.grid import Grid
+from nzshm_grid_loc.nzshm_grid_loc import build_grid, generate_grid
+
+
+def test_cached_grid(tmp_path):
+    cache = GridCache(tmp_path)
+    builds = []
+
+    def build():
+        builds.append(1)
+        return Grid(0.1, {(1, 2), (1.1, 2)}, {(1, 2): {"a": "x"}})
+
+    grid = cached_grid(build, cache, step=0.1)
+    cached = cached_grid(build, cache, step=0.1)
+    assert len(builds) == 1
+    assert list(grid) == list(cached)
+    assert grid.attributes == cached.attributes
+
+    cached_grid(build, cache, step=0.2)
+    assert len(builds) == 2
+
+    cached_grid(build, False, step=0.1)
+    assert len(builds) == 3
+
+
+def test_cached_grid_attribute_types(tmp_path):
+    cache = GridCache(tmp_path)
+    grid = Grid(0.1, {(1, 2)}, {(1, 2): {"tuple": (1, "a"), "int": np.int64(3)}})
+
+    cached_grid(lambda: grid, cache, step=0.1)
+    cached = cached_grid(lambda: None, cache, step=0.1)
+    assert {"tuple": (1, "a"), "int": np.int64(3)} == cached.get_attributes((1, 2))
+    assert type(cached.get_attributes((1, 2))["int"]) is np.int64
+
+
+def test_cached_grid_not_serializable(tmp_path):
+    cache = GridCache(tmp_path)
+    grid = Grid(0.1, {(1, 2)}, {(1, 2): {"a": {1}}})
+
+    # the grid can't be written
+    with pytest.warns(UserWarning, match="could not write grid"):
+        assert grid is cached_grid(lambda: grid, cache, step=0.1)
+    assert not list(tmp_path.iterdir())
+
+    # the inputs can't be turned into a key
+    with pytest.warns(UserWarning, match="could not create a grid cache key"):
+        assert grid is cached_grid(lambda: grid, cache, value=np.int64(1))
+    assert not list(tmp_path.iterdir())
+
+
+def test_cache_eviction(tmp_path):
+    cache = GridCache(tmp_path, max_bytes=0)
+    cache.put(cache.key(step=0.1), Grid(0.1, {(1, 2)}))
+    assert cache.get(cache.key(step=0.1)) is None
+
+    cache = GridCache(tmp_path)
+    for age, step in enumerate([0.1, 0.2, 0.3]):
+        cache.put(cache.key(step=step), Grid(step, {(1, 2)}))
+        os.utime(tmp_path / (cache.key(step=step) + ".nzgrid"), (1000 + age, 1000 + age))
+    size = sum(path.stat().st_size for path in tmp_path.iterdir())
+    # using an entry makes it the most recently used one
+    cache.get(cache.key(step=0.1))
+    cache.max_bytes = size - 1
+    cache.put(cache.key(step=0.4), Grid(0.4, {(1, 2)}))
+    assert cache.get(cache.key(step=0.1)) is not None
+    assert cache.get(cache.key(step=0.2)) is None
+
+    cache.clear()
+    assert not list(tmp_path.iterdir())
+
+
+def test_region_digest(tmp_path):
+    region_file = tmp_path / "region.geojson"
+    shutil.copy(Regions.WLG.value, region_file)
+    digest = region_digest(str(region_file))
+    assert digest == region_digest(Regions.WLG)
+    assert digest == region_digest(str(region_file))
+
+    region_file.write_text(region_file.read_text().replace("174.", "174.0"))
+    assert digest != region_digest(str(region_file))
+
+
+def test_build_grid(tmp_path):
+    cache = GridCache(tmp_path)
+    annotations = [("wlg", "0", None), ("wlg", "1", Regions.WLG)]
+
+    expected = Grid.for_polygon(0.05, Regions.NZ_SMALL.load()).add_neighbours()
+    expected = expected.annotate("wlg", "0").annotate("wlg", "1", clip=Regions.WLG.load())
+
+    for _ in range(2):
+        grid = build_grid(0.05, Regions.NZ_SMALL, neighbours=1, annotations=annotations, cache=cache)
+        assert grid.points == expected.points
+        assert grid.attributes == expected.attributes
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_generate_grid_is_not_cached_by_default(tmp_path, monkeypatch):
+    cache = tmp_path / "cache"
+    monkeypatch.setenv("NZSHM_GRID_LOC_CACHE", str(cache))
+    file_name = str(tmp_path / "grid.csv")
+    generate_grid(file_name, 0.1, -41.5, -41, 174.5, 175, neighbours=0, clip=Regions.WLG.load())
+    assert not (cache.exists() and any(cache.glob("*.nzgrid")))
+
+    grid = generate_grid(file_name, 0.1, -41.5, -41, 174.5, 175, neighbours=0, clip=Regions.WLG.load(), cache=True)
+    assert 1 == len(list(cache.glob("*.nzgrid")))
+    assert list(grid) == list(generate_grid(file_name, 0.1, -41.5, -41, 174.5, 175, 0, Regions.WLG.load(), cache=True))
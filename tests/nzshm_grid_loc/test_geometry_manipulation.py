@@ -0,0 +1,83 @@
+import shapely
+from geopandas import GeoDataFrame
+from shapely.geometry import MultiPolygon, Polygon, box
+
+from nzshm_grid_loc import geometry_manipulation
+from nzshm_grid_loc.geometry_manipulation import clear_cache, remove_holes, remove_holes_from_nz, simplify_shape
+from nzshm_grid_loc.io import load_polygon_file
+
+square = [(170, -45), (172, -45), (172, -43), (170, -43)]
+hole = [(170.5, -44.5), (171, -44.5), (171, -44), (170.5, -44)]
+with_hole = Polygon(square, [hole])
+
+
+def test_remove_holes():
+    assert Polygon(square).equals(remove_holes(with_hole))
+    assert 0 == len(remove_holes(with_hole).interiors)
+
+    multi = remove_holes(MultiPolygon([with_hole, box(173, -45, 174, -44)]))
+    assert "MultiPolygon" == multi.geom_type
+    assert [0, 0] == [len(poly.interiors) for poly in multi.geoms]
+
+    gdf = GeoDataFrame({"name": ["a", "b"]}, geometry=[with_hole, box(173, -45, 174, -44)], crs="EPSG:4326")
+    gdf = remove_holes(gdf)
+    assert [0, 0] == [len(poly.interiors) for poly in gdf.geometry]
+    assert "EPSG:4326" == gdf.crs
+    assert ["a", "b"] == list(gdf["name"])
+
+
+def test_remove_holes_from_nz():
+    clear_cache()
+    # two polygons that touch at their corners enclose a hole that is not an interior ring
+    nz = GeoDataFrame(
+        {"name": ["a", "b", "c"]},
+        geometry=[
+            Polygon([(170, -45), (172, -45), (172, -44), (171, -44), (171, -43), (170, -43)]),
+            Polygon([(171, -44), (172, -44), (172, -43), (171, -43)]).difference(box(171.2, -43.8, 171.8, -43.2)),
+            with_hole,
+        ],
+        crs="EPSG:4326",
+    )
+    merged = remove_holes_from_nz(nz)
+    assert 1 == len(merged)
+    assert "a" == merged["name"][0]
+    assert merged.geometry[0].equals(Polygon(square))
+
+    parallel = remove_holes_from_nz(nz, workers=2)
+    assert parallel.geometry[0].equals(merged.geometry[0])
+
+
+def test_remove_holes_from_nz_is_cached(monkeypatch):
+    clear_cache()
+    nz = GeoDataFrame(geometry=[with_hole], crs="EPSG:4326")
+    calls = []
+    union_all = shapely.union_all
+    monkeypatch.setattr(geometry_manipulation.shapely, "union_all", lambda *args: calls.append(1) or union_all(*args))
+    first = remove_holes_from_nz(nz)
+    count = len(calls)
+    assert first.geometry[0].equals(remove_holes_from_nz(nz).geometry[0])
+    assert count == len(calls)
+
+
+def test_simplify_shape(tmp_path):
+    clear_cache()
+    shapes = GeoDataFrame(
+        {"id": [1, 2, 3]},
+        geometry=[box(170, -45, 172, -43), box(173, -42, 173.5, -41.5), box(174, -41, 174.01, -40.99)],
+        crs="EPSG:4326",
+    )
+    file_in = str(tmp_path / "shapes.shp")
+    shapes.to_file(file_in)
+    file_out = str(tmp_path / "small.wkt.csv")
+
+    simplified = simplify_shape(file_in, tolerance=0.1, max_rows=2, visual_check=False, file_out=file_out)
+    assert [1, 2] == list(simplified["id"])
+    for original, shape in zip(shapes.geometry, simplified.geometry):
+        assert shape.contains(original)
+    assert 2 == len(load_polygon_file(file_out + ".zip"))
+
+    parallel = simplify_shape(file_in, tolerance=0.1, max_rows=2, visual_check=False, file_out=file_out, workers=2)
+    assert all(a.equals(b) for a, b in zip(simplified.geometry, parallel.geometry))
+    # the cached shapes are not buffered by earlier calls
+    finer = simplify_shape(file_in, tolerance=0.01, max_rows=2, visual_check=False, file_out=file_out)
+    assert finer.geometry[0].area < simplified.geometry[0].area
@@ -1,8 +1,14 @@
+import pickle
+
+import numpy as np
 import pytest
 from geopandas import GeoDataFrame
 from shapely.geometry import Point, Polygon
 
+from nzshm_grid_loc import clip
 from nzshm_grid_loc.grid import Grid
+from nzshm_grid_loc.io import load_grid, write_binary_grid
+from nzshm_grid_loc.mask import clear_mask_cache
 
 a = Point(1, 2)
 b = Point(2, 3)
@@ -39,6 +45,13 @@ def test_grid_union_gdf():
     result = grid_a.union(gdf)
     assert list(grid_a.union(grid_b)) == list(result)
 
+    # the region is added on the lattice of the grid
+    shifted = Grid(0.5, [(0.25, 0.25)])
+    result = shifted.union(gdf)
+    assert (0.25, 0.25) == result.origin
+    lattice = Grid(0.5, [(x, y) for x in np.arange(3.25, 6, 0.5) for y in np.arange(3.25, 8, 0.5)])
+    assert shifted.points | lattice.intersection(gdf).points == result.points
+
 
 def test_grid_difference():
     grid_a = Grid(1, [a, b, c])
@@ -136,3 +149,281 @@ def test_annotate():
     assert {"a": 1} == grid_b.get_attributes(a)
     assert {"a": 2} == grid_b.get_attributes(d)
     assert {"a": 2} == grid_b.get_attributes((d.x, d.y))
+
+
+def test_make_grid_matches_rounded_ranges():
+    grid = Grid.for_bounds(-47.13, -46.5, 166.07, 166.4, 0.03)
+    expected = set()
+    for lat in np.arange(-47.13, -46.5, 0.03):
+        for lon in np.arange(166.07, 166.4, 0.03):
+            expected.add((round(lon, 2), round(lat, 2)))
+    assert expected == grid.points
+
+
+def test_grid_keeps_point_precision():
+    grid = Grid(0.5, [(1.25, 3.5), (2, 3)])
+    assert 2 == grid.precision
+    assert {(1.25, 3.5), (2.0, 3.0)} == grid.points
+
+    grid = Grid(0.5, [(1, 2)]).union(Grid(0.01, [(1.01, 2)]))
+    assert 0.5 == grid.step
+    assert {(1.0, 2.0), (1.01, 2.0)} == grid.points
+
+
+def test_points_are_cached():
+    grid = Grid.for_bounds(0, 0.2, 0, 0.2, 0.1)
+    assert {(0.0, 0.0), (0.0, 0.1), (0.1, 0.0), (0.1, 0.1)} == grid.points
+    assert grid.points is grid.points
+    assert grid.points == pickle.loads(pickle.dumps(grid)).points
+
+
+def test_step_precision_is_limited():
+    with pytest.warns(UserWarning, match="more than 6 decimal places"):
+        grid = Grid(0.1234567, [(1, 2)])
+    assert 6 == grid.precision
+    with pytest.warns(UserWarning, match="more than 6 decimal places"):
+        assert 6 == Grid(1e-07, [(1, 2)]).precision
+    with pytest.warns(UserWarning, match="more than 6 decimal places"):
+        assert 6 == Grid.for_bounds(0, 1e-06, 0, 1e-06, 1e-07).precision
+    assert 5 == Grid(1e-05, [(1, 2)]).precision
+
+
+def test_grid_origin():
+    assert (0.0, 0.0) == Grid.for_bounds(-48, -46, 166, 168, 0.1).origin
+    assert (0.05, 0.0) == Grid(0.1, [(166.05, -40), (166.15, -40.1)]).origin
+    assert Grid(0.1, [(166.05, -40), (166.1, -40)]).origin is None
+    assert Grid(-1, [(166.05, -40)]).origin is None
+
+
+def test_grid_clip_boundary():
+    square = GeoDataFrame(geometry=[Polygon([[0, 0], [2, 0], [2, 2], [0, 2]])])
+    grid = Grid.for_bounds(0, 3, 0, 3, 1)
+    assert [Point(1, 1)] == list(grid.intersection(square))
+    assert 8 == len(grid.difference(square))
+
+
+@pytest.mark.parametrize("points", [[(3, 3), (3, 4), (7, 1)], [(3, 3), (60, 40)]])
+def test_grid_neighbour_rings(points):
+    grid = Grid(1, points)
+    expected = grid.add_neighbours().add_neighbours().add_neighbours()
+    assert list(expected) == list(grid.add_neighbours(rings=3))
+    assert list(grid) == list(grid.add_neighbours(rings=0))
+
+
+def test_grid_neighbour_rings_off_lattice():
+    # the points keep their offset from the lattice of the step, neighbours are not rounded to the step's decimals
+    grid = Grid(0.1, [(0.15, 0.2)])
+    rings = grid.add_neighbours(rings=2)
+    assert rings.points == grid.add_neighbours().add_neighbours().points
+    assert {(x, y) for x in [-0.05, 0.05, 0.15, 0.25, 0.35] for y in [0.0, 0.1, 0.2, 0.3, 0.4]} == rings.points
+
+
+def test_grid_neighbours_4_connected():
+    grid = Grid(1, [c])
+    n_1 = grid.add_neighbours(connectivity=4)
+    expected = [Point(x, y) for x, y in [[2, 3], [3, 2], [3, 3], [3, 4], [4, 3]]]
+    assert expected == list(n_1)
+    assert list(n_1.add_neighbours(connectivity=4)) == list(grid.add_neighbours(rings=2, connectivity=4))
+    with pytest.raises(ValueError):
+        grid.add_neighbours(connectivity=6)
+
+
+def test_annotate_columns():
+    grid = Grid(1, [a, b, c, d]).annotate("a", "x").annotate("a", "y", clip=gdf).annotate("b", 1, clip=gdf)
+    assert ["a", "b"] == grid.attribute_names
+    assert ["x", "x", "x", "y"] == grid.column("a").tolist()
+    assert [0, 0, 0, 1] == grid.column("b", default=0).tolist()
+    assert [None] * 4 == grid.column("c").tolist()
+    codes, categories = grid.column_codes("a")
+    assert ("x", "y") == categories
+    assert [0, 0, 0, 1] == codes.tolist()
+    assert ([-1] * 4, ()) == (grid.column_codes("c").codes.tolist(), grid.column_codes("c").categories)
+    assert {(4.0, 5.0): {"a": "y", "b": 1}} == {p: v for p, v in grid.attributes.items() if "b" in v}
+
+
+def test_attributes_follow_points():
+    grid_a = Grid(1, [a, b, c], {(1, 2): {"a": 1}, (3, 3): {"a": 1, "b": 2}, (9, 9): {"a": 3}})
+    grid_b = Grid(1, [c, d], {(3, 3): {"a": 2}})
+    assert {(1.0, 2.0): {"a": 1}, (3.0, 3.0): {"a": 1, "b": 2}} == grid_a.attributes
+
+    union = grid_a.union(grid_b)
+    assert {"a": 1} == union.get_attributes(a)
+    assert {"a": 2} == union.get_attributes(c)
+    assert {} == union.get_attributes(d)
+    assert {"a": 1, "b": 2} == grid_b.union(grid_a).get_attributes(c)
+
+    assert {"a": 1} == grid_a.difference(grid_b).get_attributes(a)
+    assert {"a": 1} == grid_a.add_neighbours().get_attributes(a)
+    assert {} == grid_a.add_neighbours().get_attributes((0, 1))
+
+
+def test_parallel_clip():
+    grid = Grid.for_bounds(0, 10, 0, 10, 0.25)
+    assert list(grid.intersection(gdf)) == list(grid.intersection(gdf, workers=2))
+    assert list(grid.difference(gdf)) == list(grid.difference(gdf, workers=2))
+    assert list(Grid.for_polygon(0.25, gdf)) == list(Grid.for_polygon(0.25, gdf, workers=3))
+
+
+def test_parallel_clip_uses_pool(monkeypatch):
+    pools = []
+
+    class RecordingPool(clip.ProcessPoolExecutor):
+        def __init__(self, max_workers, **kwargs):
+            pools.append(max_workers)
+            super().__init__(max_workers, **kwargs)
+
+    monkeypatch.setattr(clip, "ProcessPoolExecutor", RecordingPool)
+    clear_mask_cache()
+    serial = list(Grid.for_polygon(0.25, gdf))
+    assert [] == pools
+    # the region is rasterized again, and the points near its edges are tested in the pool
+    clear_mask_cache()
+    assert serial == list(Grid.for_polygon(0.25, gdf, workers=2))
+    assert [2] == pools
+
+
+def test_snap():
+    grid = Grid.for_bounds(-41.5, -41, 174.5, 175, 0.1)
+    lons, lats = grid.snap(np.array([174.76, 174.04, np.nan]), np.array([-41.29, -41.26, -41.2]))
+    np.testing.assert_array_equal([174.8, 174.0, np.nan], lons)
+    np.testing.assert_array_equal([-41.3, -41.3, np.nan], lats)
+
+    shifted = Grid(0.1, [(0.05, 0.05), (0.15, 0.05)])
+    assert ([0.15], [0.05]) == tuple(v.tolist() for v in shifted.snap([0.13], [0.02]))
+    with pytest.raises(ValueError):
+        Grid(-1, [(0.05, 0.05)]).snap([0.1], [0.1])
+
+
+def test_contains_points():
+    grid = Grid.for_bounds(-41.5, -41, 174.5, 175, 0.1)
+    lons = np.array([174.8, 174.81, 175.0, np.nan])
+    lats = np.array([-41.3, -41.3, -41.3, -41.3])
+    assert [True, False, False, False] == grid.contains_points(lons, lats).tolist()
+    assert [True, True, False, False] == grid.contains_points(lons, lats, snap=True).tolist()
+
+
+def test_array_views():
+    grid = Grid(1, [d, a, c]).annotate("a", "x", clip=gdf)
+    coordinates = grid.to_numpy()
+    assert [[1, 2], [3, 3], [4, 5]] == coordinates.tolist()
+    assert np.shares_memory(coordinates, grid.to_numpy())
+    with pytest.raises(ValueError):
+        coordinates[0, 0] = 0
+
+    assert [a, c, d] == grid.to_geoseries().to_list()
+    frame = grid.to_geodataframe()
+    assert ["lon", "lat", "a", "geometry"] == list(frame.columns)
+    assert [a, c, d] == frame.geometry.to_list()
+    assert ["x"] == frame["a"].dropna().to_list()
+
+
+def test_union_all():
+    grids = [Grid(1, [a, b]).annotate("x", 1), Grid(1, [b, c]), Grid(1, [c, d]).annotate("x", 3)]
+    result = Grid.union_all(grids)
+    assert [a, b, c, d] == list(result)
+    assert [1, 1, 3, 3] == result.column("x").tolist()
+    expected = grids[0].union(grids[1]).union(grids[2])
+    assert list(expected) == list(result)
+    assert expected.attributes == result.attributes
+
+
+def test_intersect_all():
+    grids = [Grid(1, [a, b, c]).annotate("x", 1), Grid(1, [b, c, d]).annotate("x", 2), Grid(1, [c, d])]
+    result = Grid.intersect_all(grids)
+    assert [c] == list(result)
+    assert {"x": 1} == result.get_attributes(c)
+
+
+def test_set_operations_check_lattice():
+    with pytest.raises(ValueError):
+        Grid.union_all([Grid(0.1, [(0, 0)]), Grid(0.2, [(0, 0)])])
+    with pytest.raises(ValueError):
+        Grid.intersect_all([Grid(0.1, [(0, 0)]), Grid(0.1, [(0.05, 0)])])
+    with pytest.raises(ValueError):
+        Grid.union_all([])
+
+
+def test_decimate():
+    grid = Grid.for_bounds(0, 1, 0, 1, 0.1).annotate("a", "1")
+    decimated = grid.decimate(5)
+    assert 0.5 == decimated.step
+    assert {(0.0, 0.0), (0.0, 0.5), (0.5, 0.0), (0.5, 0.5)} == decimated.points
+    assert {"a": "1"} == decimated.get_attributes((0.5, 0.5))
+    assert grid.points == grid.decimate(1).points
+
+    shifted = Grid(0.1, grid.to_numpy() + 0.05)
+    assert {(0.05, 0.05), (0.05, 0.55), (0.55, 0.05), (0.55, 0.55)} == shifted.decimate(5).points
+
+    with pytest.raises(ValueError):
+        grid.decimate(0)
+
+
+def test_snap_to_lattice():
+    grid = Grid(-1, [(0.05, 0.05), (0.15, 0.05), (0.25, 0.15)], {(0.15, 0.05): {"a": "1"}})
+    snapped = grid.snap_to_lattice()
+    assert 0.1 == snapped.step
+    assert (0.05, 0.05) == snapped.origin
+    assert grid.points == snapped.points
+
+    coarse = grid.snap_to_lattice(0.2, origin=(0, 0))
+    assert 0.2 == coarse.step
+    assert {(0.0, 0.0), (0.2, 0.0), (0.2, 0.2)} == coarse.points
+    assert {"a": "1"} == coarse.get_attributes((0.2, 0.0))
+
+    # the first point that snaps to a lattice point keeps its attributes
+    merged = Grid(-1, [(0.05, 0), (0.06, 0)], {(0.06, 0): {"a": "1"}}).snap_to_lattice(0.2, origin=(0, 0))
+    assert {(0.0, 0.0)} == merged.points
+    assert {} == merged.get_attributes((0.0, 0.0))
+
+    with pytest.raises(ValueError):
+        Grid(-1, [(1, 2)]).snap_to_lattice()
+
+
+def test_delta():
+    old = Grid.for_bounds(0, 0.2, 0, 0.2, 0.1).annotate("a", "1")
+    new = old.difference(Grid(0.1, [(0.0, 0.0)])).union(Grid(0.1, [(0.3, 0.0)]))
+    new = new.annotate("a", "2", clip=GeoDataFrame(geometry=[Polygon([(0.05, -1), (0.15, -1), (0.15, 1), (0.05, 1)])]))
+
+    delta = old.delta(new)
+    assert [[0.3, 0.0]] == delta.added.tolist()
+    assert [[0.0, 0.0]] == delta.removed.tolist()
+    assert [[0.1, 0.0], [0.1, 0.1]] == delta.changed.tolist()
+    assert [[0.0, 0.1]] == delta.unchanged.tolist()
+
+    # attributes that are only set in one grid are changes
+    assert 4 == len(old.delta(Grid.for_bounds(0, 0.2, 0, 0.2, 0.1)).changed)
+
+
+def test_delta_of_csv_grids():
+    grid = Grid.for_bounds(-41.5, -41, 174.5, 175, 0.1)
+    # an offset that is kept by the grid, so that the points are not on the lattice of grid
+    csv_grid = Grid(-1, grid.to_numpy() + 3e-6)
+    assert 6 == csv_grid.precision
+    assert not grid.points & csv_grid.points
+    for delta in grid.delta(csv_grid), csv_grid.delta(grid):
+        assert 0 == len(delta.added) + len(delta.removed) + len(delta.changed)
+        assert len(grid) == len(delta.unchanged)
+
+    shifted = Grid(-1, grid.to_numpy()[1:] + [0.1, 0])
+    delta = Grid(-1, grid.to_numpy()).delta(shifted)
+    assert 5 == len(delta.added)
+    assert 6 == len(delta.removed)
+
+    with pytest.warns(UserWarning):
+        noisy = Grid(-1, grid.to_numpy() + np.random.default_rng(1).uniform(-0.01, 0.01, (len(grid), 2)))
+    assert len(grid) == len(Grid(-1, grid.to_numpy()).delta(noisy, step=0.1).unchanged)
+
+
+@pytest.mark.parametrize("origin_computed", [False, True])
+def test_pickle(tmp_path, origin_computed):
+    grid = Grid.for_bounds(-41.5, -41, 174.5, 175, 0.1).annotate("a", "1")
+    if origin_computed:
+        assert (0.0, 0.0) == grid.origin
+    grid = pickle.loads(pickle.dumps(grid))
+    assert (0.0, 0.0) == grid.origin
+    lons, lats = grid.snap(np.array([174.62]), np.array([-41.33]))
+    assert [174.6, -41.3] == [lons[0], lats[0]]
+
+    tmp_file = str(tmp_path / "grid.nzgrid")
+    write_binary_grid(grid, tmp_file)
+    assert list(grid) == list(load_grid(tmp_file))
@@ -1,17 +1,28 @@
 import io
+import os
+import shutil
 from pathlib import Path
 
+import numpy as np
+import pytest
 from shapely.geometry import Point
 from nzshm_common.util import compress_string
 from nzshm_grid_loc.grid import Grid
 from nzshm_grid_loc.io import (
     load_grid,
     write_grid,
+    write_attr_grid,
     write_zip,
     load_zip,
     load_wkt_csv,
+    load_polygon_file,
     write_grid_to_file,
     latlon_from_base64_zip,
+    grid_to_base64_str,
+    grid_from_base64,
+    coordinates_from_base64,
+    write_grid_delta,
+    load_grid_delta,
 )
 
 temp_file_count = 0
@@ -76,3 +87,164 @@ def test_base64zip():
     base64_zip = compress_string(out_file.getvalue())
     actual = latlon_from_base64_zip(base64_zip)
     assert expected == actual
+
+
+def test_base64_binary():
+    grid = Grid.for_bounds(-41.5, -41, 174.5, 175, 0.1).union(Grid.for_bounds(-45, -44.5, 170, 170.2, 0.1))
+    encoded = grid_to_base64_str(grid)
+    actual = grid_from_base64(encoded)
+    assert list(grid) == list(actual)
+    assert 0.1 == actual.step
+    assert 1 == actual.precision
+    assert grid.to_numpy().tolist() == coordinates_from_base64(encoded).tolist()
+
+    lat_first = grid_to_base64_str(grid, lat_first=True)
+    assert [(lat, lon) for lon, lat in grid.to_numpy().tolist()] == latlon_from_base64_zip(lat_first)
+
+    # smaller than the zipped CSV
+    out_file = io.StringIO()
+    write_grid_to_file(grid, out_file)
+    assert len(encoded) < len(compress_string(out_file.getvalue()))
+
+
+def test_base64_binary_off_lattice():
+    grid = Grid(-1, [(170.123, -40.5), (171, -41.25), (-170.5, 50)])
+    actual = grid_from_base64(grid_to_base64_str(grid))
+    assert list(grid) == list(actual)
+    assert -1 == actual.step
+
+    assert [] == list(grid_from_base64(grid_to_base64_str(Grid(0.1, []))))
+
+
+def test_base64_legacy():
+    grid = Grid(1, [(1, 2), (3, 4)])
+    out_file = io.StringIO()
+    write_grid_to_file(grid, out_file)
+    legacy = compress_string(out_file.getvalue())
+    assert np.array_equal([[1, 2], [3, 4]], coordinates_from_base64(legacy))
+    assert list(grid) == list(grid_from_base64(legacy))
+
+
+def test_read_write_binary(tmp_path):
+    tmp_file = tmp_path / "grid.nzgrid"
+    grid = Grid.for_bounds(-41.5, -41, 174.5, 175, 0.1).annotate("backarc", "0").annotate("index", 1, clip=None)
+
+    write_grid(grid, str(tmp_file))
+    actual = load_grid(str(tmp_file))
+    assert list(grid) == list(actual)
+    assert 0.1 == actual.step
+    assert 1 == actual.precision
+    assert {"backarc": "0", "index": 1} == actual.get_attributes(Point(174.8, -41.2))
+
+    write_grid(Grid(1, []), str(tmp_file))
+    assert [] == list(load_grid(str(tmp_file)))
+
+
+def test_write_attr_csv(tmp_path):
+    tmp_file = tmp_path / "attr.csv"
+    grid = Grid(1, [a, b]).annotate("name", 'x,"y"', clip=None).annotate("value", 0.25)
+    grid = grid.union(Grid(1, [c]))
+
+    write_attr_grid(grid, str(tmp_file), ["lon", "lat", "name", "value", "missing"])
+    expected = 'lon,lat,name,value,missing\n1.0,2.0,"x,""y""",0.25,\n2.0,1.0,,,\n3.0,4.0,"x,""y""",0.25,\n'
+    assert expected == tmp_file.read_text()
+
+    write_attr_grid(grid, str(tmp_file), ["latitude", "longitude", "value"], float_precision=3)
+    assert "latitude,longitude,value\n2.000,1.000,0.250\n1.000,2.000,\n4.000,3.000,0.250\n" == tmp_file.read_text()
+
+
+def test_write_attr_parquet(tmp_path):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    tmp_file = tmp_path / "attr.parquet"
+    grid = Grid(1, [a, b, c]).annotate("backarc", "1", clip=None).union(Grid(1, [d]))
+
+    write_attr_grid(grid, str(tmp_file), ["lon", "lat", "backarc"], format="parquet")
+    table = pyarrow_parquet.read_table(str(tmp_file)).to_pydict()
+    assert [1.0, 2.0, 3.0, 4.0] == table["lon"]
+    assert [2.0, 1.0, 4.0, 3.0] == table["lat"]
+    assert ["1", "1", "1", None] == table["backarc"]
+
+
+def test_load_polygon_file_sidecar(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow.parquet")
+    cache = tmp_path / "cache"
+    monkeypatch.setenv("NZSHM_GRID_LOC_CACHE", str(cache))
+    source = tmp_path / "region.wkt.csv"
+    source.write_text('name,geometry\na,"POLYGON((0 0,1 0,1 1,0 0))"\n')
+
+    gdf = load_polygon_file(str(source), sidecar=True)
+    # the sidecar is only written to the cache directory, never next to the file
+    assert ["cache", source.name] == sorted(path.name for path in tmp_path.iterdir())
+    (sidecar,) = (cache / "regions").iterdir()
+    loaded = load_polygon_file(str(source), sidecar=True)
+    assert gdf.geometry.to_list() == loaded.geometry.to_list()
+    assert ["a"] == loaded["name"].to_list()
+    assert gdf.crs == loaded.crs
+
+    # a touched file with the same content still uses the sidecar
+    sidecar_mtime = sidecar.stat().st_mtime_ns
+    os.utime(source, ns=(1, 1))
+    assert gdf.geometry.to_list() == load_polygon_file(str(source), sidecar=True).geometry.to_list()
+    assert sidecar.stat().st_mtime_ns != sidecar_mtime
+
+    # a changed file is parsed again
+    source.write_text('name,geometry\nb,"POLYGON((0 0,2 0,2 2,0 0))"\n')
+    assert ["b"] == load_polygon_file(str(source), sidecar=True)["name"].to_list()
+    assert ["b"] == load_polygon_file(str(source), sidecar=True)["name"].to_list()
+
+
+def test_load_polygon_file_sidecar_unwritable_cache(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow.parquet")
+    cache = tmp_path / "cache"
+    cache.write_text("not a directory")
+    monkeypatch.setenv("NZSHM_GRID_LOC_CACHE", str(cache))
+    source = tmp_path / "region.geojson"
+    shutil.copy(Path(__file__).parents[2] / "nzshm_grid_loc" / "resources" / "wellington.geojson", source)
+
+    # the file is parsed every time if the sidecar can't be written
+    gdf = load_polygon_file(str(source), sidecar=True)
+    assert gdf.geometry.to_list() == load_polygon_file(str(source), sidecar=True).geometry.to_list()
+    assert ["cache", source.name] == sorted(path.name for path in tmp_path.iterdir())
+
+
+def test_write_grid_delta(tmp_path):
+    tmp_file = str(tmp_path / "delta.csv")
+    old = Grid.for_bounds(0, 0.3, 0, 0.2, 0.1)
+    new = Grid.for_bounds(0, 0.2, 0, 0.3, 0.1).union(Grid(0.1, [(0.0, 0.0)]).annotate("a", "1"))
+    delta = old.delta(new)
+
+    assert 5 == write_grid_delta(delta, tmp_file)
+    with open(tmp_file) as f:
+        assert "change,lon,lat" == f.readline().strip()
+        assert "removed,0.0,0.2" == f.readline().strip()
+    actual = load_grid_delta(tmp_file)
+    for change in ("added", "removed", "changed"):
+        assert getattr(delta, change).tolist() == getattr(actual, change).tolist()
+    assert (0, 2) == actual.unchanged.shape
+
+    assert 8 == write_grid_delta(delta, tmp_file, unchanged=True)
+    assert delta.unchanged.tolist() == load_grid_delta(tmp_file).unchanged.tolist()
+
+
+def test_load_grid_rounds_to_max_precision(tmp_path):
+    tmp_file = tmp_path / "grid.csv"
+    tmp_file.write_text("172.1234567,-41.5\n172.5,-41.25\n")
+    with pytest.warns(UserWarning, match="1 grid points have more than 6 decimal places"):
+        grid = load_grid(str(tmp_file))
+    assert [[172.123457, -41.5], [172.5, -41.25]] == grid.to_numpy().tolist()
+
+
+def test_read_write_binary_attribute_types(tmp_path):
+    tmp_file = tmp_path / "grid.nzgrid"
+    values = [(1, "a"), np.int64(2), np.float64(0.5), np.str_("b"), np.bool_(True), {"a": (1, 2)}, [1, 2], 3, None]
+    grid = Grid.for_bounds(0, 1, 0, 1, 0.1)
+    for i, value in enumerate(values):
+        grid = grid.annotate(str(i), value)
+
+    write_grid(grid, str(tmp_file))
+    actual = load_grid(str(tmp_file)).get_attributes((0.5, 0.5))
+    assert values == [actual[str(i)] for i in range(len(values))]
+    assert [type(value) for value in values] == [type(actual[str(i)]) for i in range(len(values))]
+
+    with pytest.raises(TypeError):
+        write_grid(grid.annotate("set", {1}), str(tmp_file))
@@ -0,0 +1,52 @@
+import numpy as np
+from geopandas import GeoDataFrame
+from shapely.geometry import MultiPolygon, Polygon, box
+
+from nzshm_grid_loc.clip import contains_mask, region_geometries
+from nzshm_grid_loc.grid import Grid, _decode
+from nzshm_grid_loc.mask import RegionMask, clear_mask_cache, region_mask
+
+# vertices and horizontal edges on lattice points, a hole, and overlapping polygons
+shapes = GeoDataFrame(
+    geometry=[
+        Polygon([(0, 0), (2, 0), (2, 1), (1, 2), (0, 1)], [[(0.5, 0.5), (1.5, 0.5), (1, 1.2)]]),
+        MultiPolygon([box(1.5, 1.5, 3, 3), box(3.5, 0, 3.9, 0.4)]),
+        Polygon([(2.1, -1), (2.95, 0.05), (2.2, 0.8)]),
+    ]
+)
+
+
+def test_region_mask():
+    for step in [0.1, 0.05, 0.03]:
+        grid = Grid.for_bounds(-1, 4, -1, 5, step)
+        x, y = _decode(grid._keys)
+        units = int(round(step * 10**grid.precision))
+        mask = RegionMask(region_geometries(shapes), grid.precision, units, (int(x[0] % units), int(y[0] % units)))
+        assert mask.boundary_count > 0
+        np.testing.assert_array_equal(contains_mask(shapes, *grid._coordinates()), mask.contains(x, y))
+
+
+def test_grid_clip_with_region_mask():
+    clear_mask_cache()
+    # the same lattice shifted by half a step
+    points = Grid.for_bounds(-1, 4, -1, 5, 0.1).to_numpy() + [0.05, 0]
+    grid = Grid(0.1, points)
+    expected = contains_mask(shapes, *grid._coordinates())
+
+    assert grid.intersection(shapes).points == grid._subset(expected).points
+    assert grid.difference(shapes).points == grid._subset(~expected).points
+    annotated = grid.annotate("shape", "1", clip=shapes)
+    np.testing.assert_array_equal(expected, annotated.column("shape") == "1")
+
+    # the mask is rasterized once for the lattice
+    mask = region_mask(shapes, 6, 100000, (50000, 0))
+    assert mask is not None
+    assert mask is region_mask(shapes, 6, 100000, (50000, 0))
+
+
+def test_region_mask_max_cells():
+    clear_mask_cache()
+    assert region_mask(shapes, 3, 10, (0, 0), max_cells=100) is None
+    assert region_mask(shapes, 3, 10, (0, 0)) is not None
+    # cached masks are returned regardless of their size
+    assert region_mask(shapes, 3, 10, (0, 0), max_cells=100) is not None
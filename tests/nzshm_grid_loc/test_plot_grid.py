@@ -0,0 +1,92 @@
+import subprocess
+import sys
+
+import matplotlib.image
+import numpy as np
+import pytest
+
+from nzshm_grid_loc import plot_grid
+from nzshm_grid_loc.geography import Regions
+from nzshm_grid_loc.grid import Grid
+from nzshm_grid_loc.nzshm_grid_loc import diff_grids
+from nzshm_grid_loc.plot_grid import Plot
+
+
+def colors(file_name):
+    image = matplotlib.image.imread(file_name).astype(float)
+    return set(map(tuple, np.round(image[:, :, :3].reshape(-1, 3), 2).tolist()))
+
+
+def test_add_grid_raster(tmp_path):
+    grid = Grid.for_bounds(-42, -40, 172, 176, 0.01)
+    plot = Plot(headless=True)
+    plot.add_grid(grid, color='r')
+    assert 1 == len(plot.ax.images)
+    assert 0 == len(plot.ax.lines)
+    assert [163, 180] == list(plot.ax.get_xlim())
+
+    plot.add_grid(Grid.for_bounds(-42, -40, 172, 176, 0.5), raster=True)
+    image = plot.ax.images[-1].get_array()
+    # cells are one step wide when the step is larger than a pixel
+    assert (36, 34, 4) == image.shape
+    assert 4 * 8 == (image[:, :, 3] > 0).sum()
+
+    plot.add_grid(Grid.for_bounds(-42, -40, 172, 176, 0.5), color='b')
+    assert 1 == len(plot.ax.lines)
+
+    plot.save(tmp_path / "grid.png")
+    assert (1.0, 0.0, 0.0) in colors(tmp_path / "grid.png")
+
+
+def test_headless_plot_does_not_import_pyplot(tmp_path):
+    code = f"""
+import sys
+from nzshm_grid_loc.grid import Grid
+from nzshm_grid_loc.plot_grid import Plot
+
+grid = Grid.for_bounds(-42, -40, 172, 176, 0.1).annotate("a", "1")
+plot = Plot(headless=True)
+plot.add_grid(grid)
+plot.add_attribute(grid, "a")
+plot.save({str(tmp_path / "grid.png")!r})
+print("matplotlib.pyplot" in sys.modules)
+"""
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert "False" == result.stdout.strip()
+
+
+def test_add_density():
+    plot = Plot(headless=True)
+    plot.add_density(Grid.for_bounds(-42, -40, 172, 176, 0.01))
+    counts = plot.ax.images[0].get_array()
+    assert 200 * 400 == counts.sum()
+    assert counts.mask.any()
+    assert 2 == len(plot.fig.axes)
+
+
+def test_add_attribute(tmp_path, monkeypatch):
+    grid = Grid.for_bounds(-42, -40, 172, 176, 0.1)
+    grid = grid.annotate("half", "west").annotate("half", "east", clip=Regions.WLG.load())
+    grid = grid.union(Grid.for_bounds(-44, -43, 172, 173, 0.1))
+    for raster in [True, False]:
+        plot = Plot(headless=True)
+        plot.add_attribute(grid, "half", colors=['r', 'b'], raster=raster)
+        assert ["west", "east", "not set"] == [text.get_text() for text in plot.ax.get_legend().get_texts()]
+        plot.save(tmp_path / "attribute.png")
+        found = colors(tmp_path / "attribute.png")
+        assert {(1.0, 0.0, 0.0), (0.0, 0.0, 1.0), (0.83, 0.83, 0.83)} <= found
+
+    with pytest.raises(ValueError):
+        Plot(headless=True).add_attribute(grid, "half", colors=['r'])
+
+    monkeypatch.setattr(plot_grid, "RASTER_THRESHOLD", 10)
+    plot = Plot(headless=True)
+    plot.add_attribute(grid, "missing", legend=False)
+    assert 1 == len(plot.ax.images)
+
+
+def test_diff_grids(tmp_path):
+    grid_a = Grid.for_bounds(-42, -40, 172, 176, 0.01)
+    grid_b = Grid.for_bounds(-41, -39, 172, 176, 0.01)
+    diff_grids(grid_a, grid_b, str(tmp_path / "diff.png"))
+    assert {(1.0, 0.0, 0.0), (0.0, 0.5, 0.0), (0.75, 0.75, 0.0)} <= colors(tmp_path / "diff.png")
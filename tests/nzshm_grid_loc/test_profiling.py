@@ -0,0 +1,95 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+from geopandas import GeoDataFrame
+from shapely.geometry import box
+
+from nzshm_grid_loc import profiling
+from nzshm_grid_loc.clip import contains_mask
+from nzshm_grid_loc.grid import Grid
+from nzshm_grid_loc.io import load_grid, write_grid
+from nzshm_grid_loc.profiling import profile
+
+square = GeoDataFrame(geometry=[box(0.05, 0.05, 0.55, 0.55)])
+
+
+def test_profile(tmp_path):
+    grid = Grid.for_bounds(0, 1, 0, 1, 0.1)
+    assert profiling._active is None
+    with profile() as result:
+        assert profiling._active is result
+        clipped = grid.intersection(square)
+        neighbours = clipped.add_neighbours()
+        write_grid(neighbours, tmp_path / "grid.nzgrid")
+        load_grid(tmp_path / "grid.nzgrid")
+        contains_mask(square, np.array([0.1, 0.2, 0.7]), np.array([0.1, 0.2, 0.7]))
+    assert profiling._active is None
+
+    summary = result.summary()
+    assert {
+        "Grid.intersection",
+        "Grid._contains_mask",
+        "Grid.add_neighbours",
+        "write_grid",
+        "write_binary_grid",
+        "load_grid",
+        "load_binary_grid",
+        "contains_mask",
+    } <= set(summary)
+    assert {"calls": 1, "points_in": 100, "points_out": 25} == {
+        key: summary["Grid.intersection"][key] for key in ["calls", "points_in", "points_out"]
+    }
+    assert 49 == summary["Grid.add_neighbours"]["points_out"]
+    assert 49 == summary["load_grid"]["points_out"]
+    assert 2 == summary["contains_mask"]["points_out"]
+    # the point outside the bounding box of the square is not tested
+    assert 2 == summary["contains_mask"]["predicates"]
+    assert summary["Grid.intersection"]["peak_bytes"] is None
+
+    spans = result.report()["spans"]
+    assert ["Grid.intersection", "Grid._contains_mask"] == [span["name"] for span in spans[:2]]
+    assert [0, 1] == [span["depth"] for span in spans[:2]]
+    assert spans[0]["seconds"] >= spans[1]["seconds"]
+
+    events = result.chrome_trace()["traceEvents"]
+    assert len(spans) == len(events)
+    assert {"name": "Grid.intersection", "ph": "X"} == {key: events[0][key] for key in ["name", "ph"]}
+    assert {"points_in": 100, "points_out": 25, "predicates": 0} == events[0]["args"]
+
+    result.write_json(tmp_path / "report.json")
+    result.write_chrome_trace(tmp_path / "trace.json")
+    with open(tmp_path / "report.json") as f:
+        assert result.report() == json.load(f)
+
+
+def test_profile_memory():
+    with profile(memory=True) as result:
+        Grid.for_bounds(0, 10, 0, 10, 0.01).add_neighbours()
+    summary = result.summary()
+    # the 1M int64 lattice keys
+    assert summary["Grid.for_bounds"]["peak_bytes"] > 8_000_000
+    assert summary["Grid.add_neighbours"]["peak_bytes"] > 0
+
+
+def test_profile_off():
+    with profile() as result:
+        pass
+    Grid.for_bounds(0, 1, 0, 1, 0.1)
+    assert [] == result.spans
+
+
+def test_profile_from_environment(tmp_path):
+    env = {
+        **os.environ,
+        profiling.PROFILE_VARIABLE: str(tmp_path / "report.json"),
+        profiling.TRACE_VARIABLE: str(tmp_path / "trace.json"),
+    }
+    code = "from nzshm_grid_loc.grid import Grid; Grid.for_bounds(0, 1, 0, 1, 0.1)"
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+    with open(tmp_path / "report.json") as f:
+        assert 100 == json.load(f)["summary"]["Grid.for_bounds"]["points_out"]
+    with open(tmp_path / "trace.json") as f:
+        assert "Grid.for_bounds" == json.load(f)["traceEvents"][0]["name"]
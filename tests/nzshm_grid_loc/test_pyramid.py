@@ -0,0 +1,22 @@
+from geopandas import GeoDataFrame
+from shapely.geometry import MultiPolygon, Polygon, box
+
+from nzshm_grid_loc.geography import Regions
+from nzshm_grid_loc.grid import Grid
+from nzshm_grid_loc.pyramid import build_pyramid
+
+
+def test_build_pyramid():
+    shapes = GeoDataFrame(
+        geometry=[
+            Polygon([(0, 0), (2, 0), (2, 1), (1, 2), (0, 1)], [[(0.5, 0.5), (1.5, 0.5), (1, 1.2)]]),
+            MultiPolygon([box(1.5, 1.5, 3, 3), box(3.5, 0, 3.9, 0.4)]),
+        ]
+    )
+    for gdf in [shapes, Regions.BACKARC.load()]:
+        steps = [0.03, 0.5, 0.2, 0.1, 0.05]
+        grids = build_pyramid(steps, gdf)
+        assert sorted(steps, reverse=True) == list(grids)
+        for step in steps:
+            assert Grid.for_polygon(step, gdf).points == grids[step].points
+            assert step == grids[step].step
@@ -0,0 +1,41 @@
+import pytest
+from geopandas import GeoDataFrame
+from shapely.geometry import Polygon
+
+from nzshm_grid_loc import clip
+from nzshm_grid_loc.grid import Grid
+from nzshm_grid_loc.io import load_grid, write_grid_tiles
+from nzshm_grid_loc.tiling import iter_polygon_tiles, iter_tiles
+
+poly = Polygon([[0.25, 0.25], [3.3, 0.5], [2.75, 2.5], [1.5, 3.5], [0.5, 2]])
+gdf = GeoDataFrame(geometry=[poly])
+
+
+@pytest.mark.parametrize("neighbours, tile_size", [(0, 3), (1, 1), (2, 4), (2, 100)])
+def test_tiles_match_grid(neighbours, tile_size):
+    expected = Grid.for_bounds(0, 4, 0, 4, 0.25).intersection(gdf).add_neighbours(rings=neighbours)
+    tiles = list(iter_tiles(0.25, gdf, 0, 4, 0, 4, neighbours, tile_size))
+    assert sum(len(tile) for tile in tiles) == len(expected)
+    assert expected.points == set().union(*(tile.points for tile in tiles))
+
+
+def test_tiles_index_region_once(monkeypatch):
+    indexes = []
+
+    class RecordingIndex(clip._RegionIndex):
+        def __init__(self, geometries):
+            indexes.append(len(geometries))
+            super().__init__(geometries)
+
+    monkeypatch.setattr(clip, "_RegionIndex", RecordingIndex)
+    assert 4 < len(list(iter_tiles(0.25, gdf, 0, 4, 0, 4, tile_size=2)))
+    assert [1] == indexes
+
+
+def test_polygon_tiles(tmp_path):
+    tmp_file = tmp_path / "tiles.csv"
+    expected = Grid.for_polygon(0.1, gdf).add_neighbours()
+
+    count = write_grid_tiles(iter_polygon_tiles(0.1, gdf, neighbours=1, tile_size=8), str(tmp_file))
+    assert len(expected) == count
+    assert list(expected) == list(load_grid(str(tmp_file)))
@@ -0,0 +1,54 @@
+"""Tests for the comparison of `benchmarks/run.py`."""
+import importlib.util
+import os
+
+import pytest
+
+RUN_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'run.py')
+
+
+@pytest.fixture(scope='module')
+def run():
+    spec = importlib.util.spec_from_file_location('benchmarks_run', RUN_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_compare(run):
+    baseline = {'a': {'seconds': 1.0, 'peak_bytes': 100}, 'b': {'seconds': 1.0, 'peak_bytes': 100}}
+    results = {'a': {'seconds': 1.1, 'peak_bytes': 100}, 'b': {'seconds': 2.0, 'peak_bytes': 300}}
+    assert [('b', 'seconds is 2.00 times the baseline'), ('b', 'peak_bytes is 3.00 times the baseline')] == run.compare(
+        results, baseline, 1.5, 0.01
+    )
+
+
+def test_compare_fails_on_errors_and_missing_benchmarks(run):
+    baseline = {'a': {'seconds': 1.0, 'peak_bytes': 100}, 'b': {'seconds': 1.0, 'peak_bytes': 100}}
+    results = {'a': {'error': 'ValueError: broken'}, 'c': {'error': 'ValueError: new and broken'}}
+    assert [
+        ('b', 'is missing'),
+        ('a', 'failed: ValueError: broken'),
+        ('c', 'failed: ValueError: new and broken'),
+    ] == run.compare(results, baseline, 1.5, 0.01)
+
+
+def test_compare_only_selected_benchmarks(run, tmp_path, capsys):
+    baseline = str(tmp_path / 'baseline.json')
+    assert 0 == run.main(['--select', 'for_bounds', '--steps', '0.5', '--repeat', '1', '--save', baseline])
+    assert 0 == run.main(['--select', 'for_bounds', '--steps', '0.5', '--repeat', '1', '--compare', baseline])
+    # for_bounds[0.5] is not selected in a run with another step, so it is not missing
+    assert 0 == run.main(['--select', 'for_bounds', '--steps', '0.2', '--repeat', '1', '--compare', baseline])
+    assert 'regression' not in capsys.readouterr().out
+
+
+def test_main_fails_on_errors(run, tmp_path, monkeypatch, capsys):
+    baseline = str(tmp_path / 'baseline.json')
+    assert 0 == run.main(['--select', 'for_bounds', '--steps', '0.5', '--repeat', '1', '--save', baseline])
+
+    def broken(step, tmp_dir):
+        raise ValueError('broken')
+
+    monkeypatch.setitem(run.STEP_BENCHMARKS, 'for_bounds', broken)
+    assert 1 == run.main(['--select', 'for_bounds', '--steps', '0.5', '--repeat', '1', '--compare', baseline])
+    assert 'regression: for_bounds[0.5] failed: ValueError: broken' in capsys.readouterr().out
@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 """Tests for `nzshm_grid_loc` package."""
+import os
+import subprocess
+import sys
+
 from geopandas import GeoDataFrame
 
+from nzshm_grid_loc.io import load_polygon_file
+
 
 def test_main_module_import():
     import nzshm_grid_loc as ngl
@@ -20,3 +26,72 @@ def test_load_region():
 
     nzsmall = ngl.Regions.NZ_SMALL.load()
     assert isinstance(nzsmall, GeoDataFrame)
+
+
+def test_import_does_not_load_regions():
+    code = "import nzshm_grid_loc.nzshm_grid_loc, nzshm_grid_loc.geography as g, sys; " "sys.exit(len(g._region_cache))"
+    assert 0 == subprocess.run([sys.executable, "-c", code]).returncode
+
+
+def test_region_cache(tmp_path, monkeypatch):
+    import nzshm_grid_loc.geography as geography
+
+    loads = []
+    monkeypatch.setattr(geography, "load_polygon_file", lambda f, **kwargs: loads.append(f) or load_polygon_file(f))
+    region_file = tmp_path / "region.wkt.csv"
+    region_file.write_text('name,geometry\na,"POLYGON((0 0,1 0,1 1,0 0))"')
+
+    first = geography.load_cached_polygon_file(str(region_file))
+    second = geography.load_cached_polygon_file(str(region_file))
+    assert 1 == len(loads)
+    assert first.geometry[0] is second.geometry[0]
+
+    second["geometry"] = None
+    assert geography.load_cached_polygon_file(str(region_file)).geometry[0] is not None
+
+    stat = os.stat(region_file)
+    os.utime(region_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    geography.load_cached_polygon_file(str(region_file))
+    assert 2 == len(loads)
+
+    geography.Regions.clear_cache()
+    geography.load_cached_polygon_file(str(region_file))
+    assert 3 == len(loads)
+
+
+def test_core_import_only_needs_numpy(tmp_path):
+    # grids, grid files and the main module work without loading the polygon and plotting dependencies
+    code = f"""
+import sys
+import numpy as np
+import nzshm_grid_loc
+from nzshm_grid_loc.grid import Grid
+from nzshm_grid_loc.io import load_grid, write_grid
+import nzshm_grid_loc.nzshm_grid_loc
+
+grid = Grid.for_bounds(0, 1, 0, 1, 0.1).add_neighbours().annotate("a", "1")
+for name in ["grid.csv", "grid.nzgrid"]:
+    write_grid(grid, {str(tmp_path)!r} + "/" + name)
+    assert len(grid) == len(load_grid({str(tmp_path)!r} + "/" + name))
+grid.snap(np.array([0.52]), np.array([0.31]))
+loaded = sorted(m for m in sys.modules if m.split(".")[0] in ("geopandas", "pandas", "shapely", "matplotlib"))
+print(", ".join(loaded))
+"""
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert "" == result.stdout.strip()
+
+
+def test_import_time():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import nzshm_grid_loc.nzshm_grid_loc"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # lines of "import time: self [us] | cumulative | module", nested imports are indented
+    cumulative = {}
+    for line in result.stderr.splitlines()[1:]:
+        _, total, module = line.split("|")
+        cumulative[module.strip()] = int(total)
+    # a fraction of the time it took when geopandas was imported with the package
+    assert cumulative["nzshm_grid_loc.nzshm_grid_loc"] - cumulative["numpy"] < 250_000